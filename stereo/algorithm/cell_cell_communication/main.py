@@ -8,9 +8,9 @@ from tqdm import tqdm
 import numpy as np
 import pandas as pd
 import numpy_groupies as npg
-from functools import partial
 from sqlalchemy import create_engine
-from multiprocessing.pool import Pool
+from joblib import Parallel, delayed
+from scipy.sparse import csr_matrix
 
 # module in self project
 from stereo.log_manager import logger
@@ -97,7 +97,7 @@ class CellCellCommunication(AlgorithmBase):
         :param separator_interaction: separator of interactions used in the result and plots, e.g. '_'.
         :param iterations: number of iterations for the 'statistical' analysis type.
         :param threshold: threshold of percentage of gene expression, above which being considered as significant.
-        :param processes: number of processes used for doing the statistical analysis, on notebook just only support one process.
+        :param processes: number of threads used for doing the statistical analysis.
         :param pvalue: the cut-point of p-value, below which being considered significant.
         :param result_precision: result precision for the results, default=3.
         :param output_path: the path of directory to save the result files, set it to output the result to files.
@@ -225,9 +225,7 @@ class CellCellCommunication(AlgorithmBase):
                                                                interactions_filtered,
                                                                cluster_interactions,
                                                                complex_composition_filtered,
-                                                               real_mean_analysis,
-                                                               processes,
-                                                               separator_cluster)
+                                                               processes)
             result_pvalues = self.build_pvalue_result(real_mean_analysis,
                                                       real_percents_analysis,
                                                       statistical_mean_analysis,
@@ -931,73 +929,126 @@ class CellCellCommunication(AlgorithmBase):
             interactions: pd.DataFrame,
             cluster_interactions: list,
             complex_composition: pd.DataFrame,
-            real_mean_analysis: pd.DataFrame,
-            processes: int,
-            separator: str
-        ) -> list:
+            processes: int
+        ) -> np.ndarray:
         """
-        Shuffles meta and calculates the means for each and saves it in a list.
+        Shuffles meta and calculates the means for each shuffle, counts how many times the shuffled mean of each
+        interaction and cluster combination is bigger than the real one.
 
-        Runs it in a multiple processes to run it faster
+        The counts are converted to a float32 matrix and the complex compositions to index arrays once, the cluster
+        means of a batch of shuffled labels are computed at once by multiplying the counts with a sparse one-hot
+        matrix, the batches run in `processes` threads sharing the same counts matrix.
 
-        Note that on notebook just only support one process
+        Returns
+        -------
+        np.ndarray
+            The fraction of shuffles whose mean is bigger than the real mean, interactions as rows and
+            cluster combinations as columns.
         """
-        statistical_analysis_thread = partial(self._statistical_analysis,
-                                            cluster_interactions,
-                                            counts,
-                                            interactions,
-                                            meta,
-                                            complex_composition,
-                                            separator,
-                                            real_mean_analysis)
-        if processes > 1:
-            with Pool(processes=processes) as pool:
-                results = pool.map(statistical_analysis_thread, range(iterations))
-        else:
-            results = [statistical_analysis_thread(i) for i in tqdm(range(iterations), desc='statistical analysis', ncols=100)]
-        return results
-
-    def _statistical_analysis(
+        engine = self._build_shuffle_engine(meta, counts, interactions, cluster_interactions, complex_composition)
+        n_rows, n_clusters = engine['n_rows'], engine['n_clusters']
+        n_interactions, n_combinations = len(interactions), len(cluster_interactions)
+        # bound the memory of the intermediate arrays of each batch to about 256M
+        per_shuffle = max(n_rows * n_clusters, n_interactions * n_combinations, 1) * 4
+        batch_size = int(max(1, min(iterations, (1 << 28) // per_shuffle)))
+        batches = [min(batch_size, iterations - start) for start in range(0, iterations, batch_size)]
+        seeds = np.random.randint(0, np.iinfo(np.int32).max, size=len(batches))
+
+        real_means = self._shuffled_batch_means(engine, engine['labels'][np.newaxis, :])[0]
+        exceed_count = np.zeros((n_interactions, n_combinations), dtype=np.int64)
+        n_jobs = max(1, processes)
+        with tqdm(total=iterations, desc='statistical analysis', ncols=100) as pbar:
+            for start in range(0, len(batches), n_jobs):
+                results = Parallel(n_jobs=n_jobs, backend='threading')(
+                    delayed(self._shuffled_batch_exceed)(engine, real_means, size, seed)
+                    for size, seed in zip(batches[start:start + n_jobs], seeds[start:start + n_jobs])
+                )
+                for result in results:
+                    exceed_count += result
+                pbar.update(sum(batches[start:start + n_jobs]))
+        return exceed_count / iterations
+
+    def _build_shuffle_engine(
             self,
-            cluster_interactions: list,
+            meta: pd.DataFrame,
             counts: pd.DataFrame,
             interactions: pd.DataFrame,
-            meta: pd.DataFrame,
-            complex_composition: pd.DataFrame,
-            separator: str,
-            real_mean_analysis: pd.DataFrame,
-            iteration_number: int
-    ):
+            cluster_interactions: list,
+            complex_composition: pd.DataFrame
+        ) -> dict:
         """
-        Shuffles meta dataset and calculates the means
+        Precompute the arrays shared by all the shuffles.
         """
+        cell_type = meta['cell_type'].astype('category')
+        cluster_names = cell_type.cat.categories
+        labels = cell_type.cat.codes.values.astype(np.int64)
+        cluster_sizes = np.bincount(labels, minlength=len(cluster_names)).astype(np.float32)
 
-        def shuffle_meta(meta: pd.DataFrame) -> pd.DataFrame:
-            """
-            Get a randomly shuffled copy of the input meta.
-            """
-            meta_copy = meta.copy()
-            labels = list(meta_copy['cell_type'].values)
-            np.random.shuffle(labels)
-            meta_copy['cell_type'] = labels
-            return meta_copy
-
-        shuffled_meta = shuffle_meta(meta)
-        shuffled_clusters = self.build_clusters(shuffled_meta, counts, complex_composition, skip_percent=True)
-        shuffled_mean_analysis = self.mean_analysis(interactions,
-                                                    shuffled_clusters,
-                                                    cluster_interactions,
-                                                    separator)
-
-        result_mean_analysis = np.packbits(shuffled_mean_analysis.values > real_mean_analysis.values, axis=None)
-        return result_mean_analysis
+        row_names = counts.index
+        if not complex_composition.empty:
+            complexes = complex_composition.sort_values('complex_multidata_id', kind='stable')
+            complex_ids, complex_offsets = np.unique(complexes['complex_multidata_id'].values, return_index=True)
+            complex_proteins = row_names.get_indexer(complexes['protein_multidata_id'].values)
+            row_names = row_names.append(pd.Index(complex_ids))
+        else:
+            complex_offsets, complex_proteins = np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+        return {
+            'counts': csr_matrix(counts.values.astype(np.float32)),
+            'labels': labels,
+            'n_clusters': len(cluster_names),
+            'cluster_sizes': cluster_sizes,
+            'n_rows': len(row_names),
+            'complex_offsets': complex_offsets,
+            'complex_proteins': complex_proteins,
+            'gene1_rows': row_names.get_indexer(interactions['multidata_1_id'].values),
+            'gene2_rows': row_names.get_indexer(interactions['multidata_2_id'].values),
+            'cluster1_codes': cluster_names.get_indexer(cluster_interactions[:, 0]),
+            'cluster2_codes': cluster_names.get_indexer(cluster_interactions[:, 1]),
+        }
+
+    def _shuffled_batch_means(self, engine: dict, labels: np.ndarray) -> np.ndarray:
+        """
+        Calculates the interaction means for a batch of label vectors of shape (n_shuffles, n_cells).
+
+        Returns an array of shape (n_shuffles, n_interactions, n_cluster_combinations).
+        """
+        n_shuffles, n_cells = labels.shape
+        n_clusters = engine['n_clusters']
+        one_hot = csr_matrix(
+            (np.ones(n_cells * n_shuffles, dtype=np.float32),
+             (np.repeat(np.arange(n_cells), n_shuffles),
+              (labels.T + np.arange(n_shuffles) * n_clusters).ravel())),
+            shape=(n_cells, n_shuffles * n_clusters),
+            dtype=np.float32
+        )
+        # proteins as rows, (shuffle, cluster) as columns, the sums are divided by the sizes afterwards so that
+        # the equal sums of different shuffles give the same means, as the ties of the real means must not count
+        cluster_means = (engine['counts'] @ one_hot).toarray() / np.tile(engine['cluster_sizes'], n_shuffles)
+        if engine['complex_offsets'].size > 0:
+            complex_means = np.minimum.reduceat(cluster_means[engine['complex_proteins']], engine['complex_offsets'],
+                                                axis=0)
+            cluster_means = np.vstack([cluster_means, complex_means])
+        cluster_means = cluster_means.reshape(engine['n_rows'], n_shuffles, n_clusters).transpose(1, 0, 2)
+
+        x = cluster_means[:, engine['gene1_rows']][:, :, engine['cluster1_codes']]
+        y = cluster_means[:, engine['gene2_rows']][:, :, engine['cluster2_codes']]
+        return (x > 0) * (y > 0) * (x + y) / 2
+
+    def _shuffled_batch_exceed(self, engine: dict, real_means: np.ndarray, n_shuffles: int, seed: int) -> np.ndarray:
+        """
+        Shuffles the labels `n_shuffles` times and counts how many times the shuffled means are bigger than the real.
+        """
+        rng = np.random.default_rng(seed)
+        labels = np.stack([rng.permutation(engine['labels']) for _ in range(n_shuffles)])
+        shuffled_means = self._shuffled_batch_means(engine, labels)
+        return (shuffled_means > real_means).sum(axis=0)
 
-    
     def build_pvalue_result(
             self,
             real_mean_analysis: pd.DataFrame,
             real_percents_analysis: pd.DataFrame,
-            statistical_mean_analysis: list,
+            statistical_mean_analysis: np.ndarray,
             base_result: pd.DataFrame
     ) -> pd.DataFrame:
         """
@@ -1015,8 +1066,8 @@ class CellCellCommunication(AlgorithmBase):
             Means cluster analyisis
         real_percents_analysis: pd.DataFrame
             Percents cluster analyisis
-        statistical_mean_analysis: list
-            Statitstical means analyisis
+        statistical_mean_analysis: np.ndarray
+            Statitstical means analyisis, the fractions returned by `shuffled_analysis`
         base_result: pd.DataFrame
             Contains the index and columns that will be used by the returned object
 
@@ -1026,13 +1077,7 @@ class CellCellCommunication(AlgorithmBase):
             A DataFrame with interactions as rows and cluster combinations as columns.
         """
         logger.info('Building Pvalues result')
-        percent_result = np.zeros(real_mean_analysis.shape)
-        result_size = percent_result.size
-        result_shape = percent_result.shape
-
-        for statistical_mean in statistical_mean_analysis:
-            percent_result += np.unpackbits(statistical_mean, axis=None)[:result_size].reshape(result_shape)
-        percent_result /= len(statistical_mean_analysis)
+        percent_result = statistical_mean_analysis.astype(np.float64)
 
         mask = (real_mean_analysis.values == 0) | (real_percents_analysis == 0)
 
@@ -1,6 +1,7 @@
+from typing import Optional, Union
+
 import numpy as np
 import scipy.sparse as sp
-from scipy.spatial import distance
 from sklearn.neighbors import NearestNeighbors
 from ..log_manager import logger
 from ..utils.time_consume import TimeConsume
@@ -15,41 +16,61 @@ def _gaussan_weight(dis, a=1, b=0, c=12500):
 
 def _sp_graph_weight(arr, a=1, b=0, c=12500):
     out = arr.copy()
-    row, col = np.nonzero(arr)
-    for ro, co in zip(row, col):
-        out[ro, co] = _gaussan_weight(arr[ro, co], a=a, b=b, c=c)
+    out.data = _gaussan_weight(out.data, a=a, b=b, c=c).astype(out.dtype)
     return out
 
 def gaussian_smooth(pca_exp_matrix: np.ndarray,
-                    raw_exp_matrix: np.ndarray,
+                    raw_exp_matrix: Union[np.ndarray, sp.spmatrix],
                     cells_position: np.ndarray,
                     n_neighbors: int = 10,
                     smooth_threshold: float = 90,
                     a: float = 1,
                     b: float = 0,
-                    n_jobs: int = 10):
+                    n_jobs: int = 10,
+                    chunk_size: Optional[int] = None):
+    """
+    Smooth the expression of each cell by the gaussian weighted expression of its nearest neighbors in PCA space,
+    the weights are only computed for the kNN edges, so the memory is O(n * k) instead of O(n * n).
+
+    :param pca_exp_matrix: the PCA result, shape (n_cells, n_pcs).
+    :param raw_exp_matrix: the raw expression matrix, if it is sparse, the result is a csr_matrix.
+    :param cells_position: the spatial position of cells.
+    :param n_neighbors: the number of nearest neighbors.
+    :param smooth_threshold: the percentile of the spatial distances of edges used to derive the gaussian variance.
+    :param chunk_size: the number of cells of each chunk when multiplying the weights with the raw expression,
+                    `None` means computing the product at once.
+    :return: the smoothed expression matrix.
+    """
     if sp.issparse(pca_exp_matrix):
         pca_exp_matrix = pca_exp_matrix.toarray()
-    if sp.issparse(raw_exp_matrix):
-        raw_exp_matrix = raw_exp_matrix.toarray()
     tc = TimeConsume()
     tk = tc.start()
-    Euc_distance = distance.cdist(cells_position, cells_position).astype(np.float32)
-    logger.info(f'distance.cdist: {tc.get_time_consumed(tk)}')
-
     nbrs = NearestNeighbors(n_neighbors=n_neighbors, algorithm='ball_tree', n_jobs=n_jobs).fit(pca_exp_matrix)
     logger.info(f'NearestNeighbors.fit: {tc.get_time_consumed(tk)}')
 
-    adjecent_matrice = nbrs.kneighbors_graph(pca_exp_matrix).astype(np.float32).toarray()
-    logger.info(f'kneighbors_graph: {tc.get_time_consumed(tk, restart=False)}')
-    aa = np.multiply(adjecent_matrice, Euc_distance)  ## 自己和自己的距离为0
-    aa_nonzero = aa[np.nonzero(aa)]
-    # aa = aa.tocsr()
-    dist_threshold = np.percentile(aa_nonzero, smooth_threshold)
+    adjecent_matrice = nbrs.kneighbors_graph(pca_exp_matrix).tocsr()
+    logger.info(f'kneighbors_graph: {tc.get_time_consumed(tk)}')
+    # spatial distances of the kNN edges only, an edge with zero distance (the cell itself) takes no weight
+    rows = np.repeat(np.arange(adjecent_matrice.shape[0]), np.diff(adjecent_matrice.indptr))
+    cols = adjecent_matrice.indices
+    position = np.asarray(cells_position, dtype=np.float64)
+    dist = np.sqrt(np.sum((position[rows] - position[cols]) ** 2, axis=1)).astype(np.float32)
+    nonzero = dist != 0
+    aa = sp.csr_matrix((dist[nonzero], (rows[nonzero], cols[nonzero])), shape=adjecent_matrice.shape)
+    logger.info(f'distance of edges: {tc.get_time_consumed(tk, restart=False)}')
+    dist_threshold = np.percentile(aa.data, smooth_threshold)
     c = _gaussan_c(dist_threshold)
     ##### smoothing
     gauss_weight = _sp_graph_weight(aa, a, b, c)
-    temp_nor_para = np.squeeze(np.asarray(np.sum(gauss_weight, axis=1)))
+    temp_nor_para = np.asarray(gauss_weight.sum(axis=1)).reshape(-1)
 
-    new_adata = np.asarray(((gauss_weight.dot(raw_exp_matrix)).T / temp_nor_para).T)
-    return new_adata
+    n_cells = gauss_weight.shape[0]
+    chunk_size = n_cells if chunk_size is None else max(int(chunk_size), 1)
+    chunks = []
+    for start in range(0, n_cells, chunk_size):
+        end = min(start + chunk_size, n_cells)
+        weight = sp.diags(1 / temp_nor_para[start:end]) @ gauss_weight[start:end]
+        chunks.append(weight @ raw_exp_matrix)
+    if sp.issparse(raw_exp_matrix):
+        return sp.vstack(chunks, format='csr')
+    return np.vstack(chunks)
@@ -282,3 +282,113 @@ def mannwhitneyu(x, y, use_continuity=True, alternative="two-sided",
     p = np.clip(p, 0, 1)
 
     return MannwhitneyuResult(z, p)
+
+
+def _rank_sums_block(data, indices, indptr, codes, group_sizes, n_cells, cell_mask, with_tie_term):
+    '''Rank sums of each group for a block of genes given as the columns of a csc_matrix'''
+    n_genes = indptr.size - 1
+    n_groups = group_sizes.size
+    genes = np.repeat(np.arange(n_genes), np.diff(indptr))
+    values, cells = data, indices
+    # the explicit zeros are ranked along with the implicit ones
+    keep = values != 0
+    if cell_mask is not None:
+        keep &= cell_mask[cells]
+    if not keep.all():
+        values, cells, genes = values[keep], cells[keep], genes[keep]
+    nnz = np.bincount(genes, minlength=n_genes)
+    n_zeros = (n_cells - nnz).astype(np.float64)
+    n_negatives = np.bincount(genes[values < 0], minlength=n_genes)
+
+    # sort the nonzeros by gene then by value, the equal values of a gene make a run sharing the average rank
+    order = np.lexsort((values, genes))
+    values, cells, genes = values[order], cells[order], genes[order]
+    new_run = np.ones(values.size, dtype=bool)
+    new_run[1:] = (values[1:] != values[:-1]) | (genes[1:] != genes[:-1])
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, values.size))
+    run_genes = genes[run_starts]
+    gene_starts = np.concatenate(([0], np.cumsum(nnz)[:-1]))
+    run_ranks = run_starts - gene_starts[run_genes] + (run_lengths + 1) / 2
+    # all the zeros of a gene are one tie group ranked behind the negative values
+    run_ranks += np.where(values[run_starts] > 0, n_zeros[run_genes], 0)
+    zero_ranks = n_negatives + (n_zeros + 1) / 2
+
+    bins = genes * n_groups + codes[cells]
+    ranks = np.repeat(run_ranks, run_lengths)
+    rank_sums = np.bincount(bins, weights=ranks, minlength=n_genes * n_groups).reshape(n_genes, n_groups)
+    nonzero_counts = np.bincount(bins, minlength=n_genes * n_groups).reshape(n_genes, n_groups)
+    rank_sums += (group_sizes - nonzero_counts) * zero_ranks[:, None]
+
+    tie_term = None
+    if with_tie_term:
+        run_lengths = run_lengths.astype(np.float64)
+        tie_term = np.bincount(run_genes, weights=run_lengths ** 3 - run_lengths, minlength=n_genes)
+        tie_term += n_zeros ** 3 - n_zeros
+    return rank_sums, tie_term
+
+
+def rank_sums_by_group(X, codes, n_groups, cell_mask=None, with_tie_term=False, block_size=1000, n_jobs=1):
+    '''Sum of the ranks of each group for each gene, ranking the cells of each gene in one pass.
+
+    Only the nonzero values are sorted, the zeros of a gene are treated as one tie group whose rank is computed
+    analytically, so the expression matrix is never densified.
+
+    Parameters
+    ----------
+    X : csc_matrix
+        The expression matrix, shape (n_cells, n_genes).
+    codes : ndarray
+        The group code of each cell, in ``[0, n_groups)``.
+    n_groups : int
+        The number of groups.
+    cell_mask : ndarray, optional
+        Rank among the cells in the mask only.
+    with_tie_term : bool
+        Whether to compute the tie correction term of each gene.
+    block_size : int
+        The number of genes of each block, the blocks are ranked in parallel by `n_jobs` threads.
+
+    Returns
+    -------
+    rank_sums : ndarray
+        Shape (n_genes, n_groups).
+    tie_term : ndarray or None
+        Shape (n_genes, ).
+    '''
+    from joblib import Parallel, delayed
+
+    codes = np.asarray(codes, dtype=np.int64)
+    if cell_mask is None and (codes < 0).any():
+        # the cells without group
+        cell_mask = codes >= 0
+    if cell_mask is None:
+        group_sizes = np.bincount(codes, minlength=n_groups)
+    else:
+        cell_mask = np.asarray(cell_mask, dtype=bool) & (codes >= 0)
+        group_sizes = np.bincount(codes[cell_mask], minlength=n_groups)
+    n_cells = group_sizes.sum()
+    n_genes = X.shape[1]
+
+    def _run(start, stop):
+        lo, hi = X.indptr[start], X.indptr[stop]
+        return _rank_sums_block(X.data[lo:hi], X.indices[lo:hi], X.indptr[start:stop + 1] - lo, codes,
+                                group_sizes, n_cells, cell_mask, with_tie_term)
+
+    blocks = [(start, min(start + block_size, n_genes)) for start in range(0, n_genes, block_size)]
+    results = Parallel(n_jobs=n_jobs, backend='threading')(delayed(_run)(start, stop) for start, stop in blocks)
+    if len(results) == 0:
+        return np.zeros((0, n_groups)), (np.zeros(0) if with_tie_term else None)
+    rank_sums = np.concatenate([r[0] for r in results])
+    tie_term = np.concatenate([r[1] for r in results]) if with_tie_term else None
+    return rank_sums, tie_term
+
+
+def mannwhitneyu_from_rank_sums(R1, n1, n2, tie_term=None, use_continuity=True):
+    '''Two-sided asymptotic Mann-Whitney U test from the rank sums of sample `x`, see `mannwhitneyu`.'''
+    U1 = R1 - n1*(n1+1)/2
+    U2 = n1 * n2 - U1
+    U = np.maximum(U1, U2)
+    z = _get_mwu_z(U, n1, n2, tie_term, continuity=use_continuity)
+    p = np.clip(2 * stats.norm.sf(z), 0, 1)
+    return MannwhitneyuResult(z, p)
@@ -81,6 +81,62 @@ def compute_neighbors_rapids(
     return knn_indices, knn_dist
 
 
+def compute_neighbors_nndescent(
+        X: np.ndarray,
+        n_neighbors: int,
+        metric: _Metric = 'euclidean',
+        metric_kwds: Mapping[str, Any] = MappingProxyType({}),
+        random_state: AnyRandom = 0,
+        n_jobs: int = 10
+):
+    """Compute approximate nearest neighbors using pynndescent, which is a dependency of umap-learn.
+
+    Parameters
+    ----------
+    X: array of shape (n_samples, n_features)
+        The data to compute nearest neighbors for.
+    n_neighbors
+        The number of neighbors to use.
+    metric
+        The metric to use to compute distances in high dimensional space.
+    metric_kwds
+        Arguments to pass on to the metric.
+    random_state
+        A state capable being used as a numpy random state.
+    n_jobs
+        The number of parallel jobs.
+
+    Returns
+    -------
+    **knn_indices**, **knn_dists** : np.arrays of shape (n_observations, n_neighbors)
+    """
+    import numba
+    from pynndescent import NNDescent
+    n_obs = X.shape[0]
+    # numba refuses more threads than it was launched with
+    if n_jobs is None or n_jobs < 1 or n_jobs > numba.config.NUMBA_NUM_THREADS:
+        n_jobs = numba.config.NUMBA_NUM_THREADS
+    # the same heuristics as `umap.umap_.nearest_neighbors`
+    n_trees = min(64, 5 + int(round((n_obs ** 0.5) / 20.0)))
+    n_iters = max(5, int(round(np.log2(n_obs))))
+    index = NNDescent(
+        X,
+        n_neighbors=n_neighbors,
+        metric=metric,
+        metric_kwds=metric_kwds,
+        random_state=check_random_state(random_state),
+        n_trees=n_trees,
+        n_iters=n_iters,
+        max_candidates=60,
+        low_memory=True,
+        n_jobs=n_jobs,
+        verbose=False,
+    )
+    knn_indices, knn_dists = index.neighbor_graph
+    logger.info('pynndescent NNDescent run end')
+    return knn_indices, knn_dists
+
+
 def find_neighbors(
         x: np.ndarray,
         n_neighbors: Optional[int] = 15,
@@ -90,7 +146,8 @@ def find_neighbors(
         metric_kwds: Mapping[str, Any] = MappingProxyType({}),
         knn: bool = True,
         random_state: AnyRandom = 0,
-        n_jobs: int = 10
+        n_jobs: int = 10,
+        nn_backend: Literal['auto', 'nndescent'] = 'auto'
 ):
     """
 
@@ -134,6 +191,10 @@ def find_neighbors(
         `n_neighbors` nearest neighbor.
     :param random_state:
         A state capable being used as a numpy random state.
+    :param nn_backend:
+        the backend to search the nearest neighbors, `'auto'` computes the exact distances for small data and
+        uses `umap` otherwise, `'nndescent'` always searches the approximate neighbors by `pynndescent`,
+        it only takes effect when `knn` is `True` and `method` is not `'rapids'`.
     :return:
         neighbor: Neighbors object
         dists: sparse
@@ -150,7 +211,8 @@ def find_neighbors(
     )
     neighbor.check_setting()
     neighbor.x = neighbor.choose_x()
-    use_dense_distances = (neighbor.metric == 'euclidean' and neighbor.x.shape[0] < 8192) or not neighbor.knn
+    use_dense_distances = (neighbor.metric == 'euclidean' and neighbor.x.shape[0] < 8192 and nn_backend == 'auto') \
+        or not neighbor.knn
     dists = neighbor.x
 
     connectivities = None
@@ -165,6 +227,11 @@ def find_neighbors(
         knn_indices, knn_distances = compute_neighbors_rapids(
             neighbor.x, n_neighbors, metric=metric
         )
+    elif nn_backend == 'nndescent':
+        knn_indices, knn_distances = compute_neighbors_nndescent(
+            neighbor.x, n_neighbors, metric=metric, metric_kwds=metric_kwds, random_state=neighbor.random_state,
+            n_jobs=n_jobs
+        )
     else:
         if neighbor.x.shape[0] < 4096:
             dists = pairwise_distances(neighbor.x, metric=neighbor.metric, **metric_kwds)
@@ -212,23 +279,19 @@ class Neighbors(object):
     def get_indices_distances_from_sparse_matrix(self, dists):
         indices = np.zeros((dists.shape[0], self.n_neighbors), dtype=int)
         distances = np.zeros((dists.shape[0], self.n_neighbors), dtype=dists.dtype)
-        n_neighbors_m1 = self.n_neighbors - 1
-        for i in range(indices.shape[0]):
-            neighbors = dists[i].nonzero()  # 'true' and 'spurious' zeros
-            indices[i, 0] = i
-            distances[i, 0] = 0
-            # account for the fact that there might be more than n_neighbors
-            # due to an approximate search
-            # [the point itself was not detected as its own neighbor during the search]
-            if len(neighbors[1]) > n_neighbors_m1:
-                sorted_indices = np.argsort(dists[i][neighbors].A1)[:n_neighbors_m1]
-                indices[i, 1:] = neighbors[1][sorted_indices]
-                distances[i, 1:] = dists[i][
-                    neighbors[0][sorted_indices], neighbors[1][sorted_indices]
-                ]
-            else:
-                indices[i, 1:] = neighbors[1]
-                distances[i, 1:] = dists[i][neighbors]
+        # the point itself is the 0th neighbor with distance 0
+        indices[:, 0] = np.arange(dists.shape[0])
+        dists = csr_matrix(dists, copy=True)
+        dists.eliminate_zeros()  # 'true' and 'spurious' zeros
+        rows = np.repeat(np.arange(dists.shape[0]), np.diff(dists.indptr))
+        # there might be more than n_neighbors due to an approximate search,
+        # keep the nearest n_neighbors - 1 of each row
+        order = np.lexsort((dists.data, rows))
+        rank = np.arange(order.size) - dists.indptr[rows[order]]
+        keep = rank < self.n_neighbors - 1
+        order, rank = order[keep], rank[keep]
+        indices[rows[order], rank + 1] = dists.indices[order]
+        distances[rows[order], rank + 1] = dists.data[order]
         return indices, distances
 
     def get_parse_distances_numpy(self, indices, distances, n_obs, ):
@@ -247,24 +310,13 @@ class Neighbors(object):
 
     def get_parse_distances_umap(self, nn_idx, nn_dist):
         n_obs = self.x.shape[0]
-        rows = np.zeros((n_obs * self.n_neighbors), dtype=np.int64)
-        cols = np.zeros((n_obs * self.n_neighbors), dtype=np.int64)
-        vals = np.zeros((n_obs * self.n_neighbors), dtype=np.float64)
-
-        for i in range(nn_idx.shape[0]):
-            for j in range(self.n_neighbors):
-                if nn_idx[i, j] == -1:
-                    continue  # We didn't get the full knn for i
-                if nn_idx[i, j] == i:
-                    val = 0.0
-                else:
-                    val = nn_dist[i, j]
-
-                rows[i * self.n_neighbors + j] = i
-                cols[i * self.n_neighbors + j] = nn_idx[i, j]
-                vals[i * self.n_neighbors + j] = val
-
-        distances = coo_matrix((vals, (rows, cols)), shape=(n_obs, n_obs))
+        rows = np.repeat(np.arange(nn_idx.shape[0], dtype=np.int64), self.n_neighbors)
+        cols = nn_idx[:, :self.n_neighbors].astype(np.int64).ravel()
+        vals = nn_dist[:, :self.n_neighbors].astype(np.float64).ravel()
+        vals[cols == rows] = 0.0
+        # -1 means we didn't get the full knn for the row
+        valid = cols != -1
+        distances = coo_matrix((vals[valid], (rows[valid], cols[valid])), shape=(n_obs, n_obs))
         distances.eliminate_zeros()
         return distances.tocsr()
 
@@ -382,30 +434,36 @@ class Neighbors(object):
                 # restrict number of neighbors to ~k
                 # build a symmetric mask
                 mask = np.zeros(dsq.shape, dtype=bool)
-                for i, row in enumerate(indices):
-                    mask[i, row] = True
-                    for j in row:
-                        if i not in set(indices[j]):
-                            W[j, i] = W[i, j]
-                            mask[j, i] = True
+                mask[np.repeat(np.arange(indices.shape[0]), indices.shape[1]), indices.ravel()] = True
+                # (i, j) is a neighbor pair but (j, i) is not, then W[j, i] = W[i, j]
+                one_way = (mask & ~mask.T).T
+                W[one_way] = W.T[one_way]
+                mask |= one_way
                 # set all entries that are not nearest neighbors to zero
                 W[~mask] = 0
         else:
             W = (
                 dsq.copy()
             )  # need to copy the distance matrix here; what follows is inplace
-            for i in range(len(dsq.indptr[:-1])):
-                row = dsq.indices[dsq.indptr[i]: dsq.indptr[i + 1]]
-                num = 2 * sigmas[i] * sigmas[row]
-                den = sigmas_sq[i] + sigmas_sq[row]
-                W.data[dsq.indptr[i]: dsq.indptr[i + 1]] = np.sqrt(num / den) * np.exp(
-                    -dsq.data[dsq.indptr[i]: dsq.indptr[i + 1]] / den
-                )
-            W = W.tolil()
-            for i, row in enumerate(indices):
-                for j in row:
-                    if i not in set(indices[j]):
-                        W[j, i] = W[i, j]
+            rows = np.repeat(np.arange(dsq.shape[0]), np.diff(dsq.indptr))
+            cols = dsq.indices
+            num = 2 * sigmas[rows] * sigmas[cols]
+            den = sigmas_sq[rows] + sigmas_sq[cols]
+            W.data = np.sqrt(num / den) * np.exp(-dsq.data / den)
             W = W.tocsr()
+            # (i, j) is a neighbor pair but (j, i) is not, then W[j, i] = W[i, j]
+            knn_graph = csr_matrix(
+                (np.ones(indices.size, dtype=np.int8), (np.repeat(np.arange(indices.shape[0]), indices.shape[1]),
+                                                        indices.ravel())),
+                shape=W.shape
+            )
+            knn_graph.data[:] = 1
+            one_way = (knn_graph - knn_graph.multiply(knn_graph.T)).tocoo()
+            one_way.eliminate_zeros()
+            i, j = one_way.row, one_way.col
+            values = np.asarray(W[i, j]).ravel()
+            overwritten = csr_matrix((np.ones(i.size), (j, i)), shape=W.shape)
+            W = W - W.multiply(overwritten) + csr_matrix((values, (j, i)), shape=W.shape)
+            W.eliminate_zeros()
         connectivities = W
         return connectivities
@@ -12,6 +12,8 @@ from functools import singledispatch
 from scipy.sparse import spmatrix
 from sklearn.utils import sparsefuncs
 
+from ..core.lazy_matrix import LazyExpMatrix
+
 
 @singledispatch
 def normalize_total(x, target_sum):
@@ -43,6 +45,17 @@ def _(x, target_sum):
     return x
 
 
+@normalize_total.register(LazyExpMatrix)
+def _(x, target_sum):
+    x = x.astype(np.float32)
+    counts = np.ravel(x.sum(1))
+    counts_greater_than_zero = counts[counts > 0]
+    target_sum = np.median(counts_greater_than_zero, axis=0) if target_sum is None else target_sum
+    counts += counts == 0
+    counts = counts / target_sum
+    return x.scale_rows(1 / counts)
+
+
 def quantile_norm(x):
     """
     Normalize the columns of X to each have the same distribution. Given an expression matrix  of M genes by N samples,
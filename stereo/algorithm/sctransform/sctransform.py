@@ -7,7 +7,7 @@ import numpy as np
 from scipy.sparse import csr_matrix
 
 from .scale_data import ScaleData
-from .vst import vst
+from .vst import vst, get_residuals
 from stereo.log_manager import logger
 
 
@@ -65,9 +65,10 @@ def SCTransform(
     :param clip_range:
         Range to clip the residuals to; default is [-np.sqrt(umi.shape[1] / 30), np.sqrt(umi.shape[1] / 30)], where n
         is the number of cells.
-    :param conserve_memory: TODO not yet finished
+    :param conserve_memory:
         If set to True the residual matrix for all genes is never created in full; useful for large data sets, but will
-        take longer to run; this will also set `return_only_var_genes` to True; default is False
+        take longer to run; this will also set `return_only_var_genes` to True; default is False. Set
+        `corrected_umi_store` in `kwargs` to the path of a HDF5 file to spill the corrected UMI to the file.
     :param return_only_var_genes:
         If set to True the scale.data matrices in output res are subset to contain only the variable genes;
         default is True
@@ -77,7 +78,8 @@ def SCTransform(
         Other arguments, such as `n_genes` defined for `vst`.
     :return:
             {
-                'counts':     csr_matrix,       # describe `umi` corrected by pearson residual
+                'counts':     csr_matrix,       # describe `umi` corrected by pearson residual, a `LazyExpMatrix`
+                                                # if `corrected_umi_store` is set
                 'data':       csr_matrix,       # counts after `log1p`
                 'scale.data': pandas.DataFrame, # pearson residual after `scale`
             },
@@ -110,12 +112,9 @@ def SCTransform(
     vst_args['return_gene_attr'] = True
     vst_args['return_corrected_umi'] = do_correct_umi
     vst_args['n_cells'] = min(n_cells, umi.shape[1])
-    # TODO: ignore `res_clip_range` used in 'conserve.memory' sct-method
-    # res_clip_range = vst_args['res_clip_range'] if 'res_clip_range' in vst_args else [-math.sqrt(umi.shape[1]),
-    #                                                                                  math.sqrt(umi.shape[1])]
 
-    # TODO: ignore `reference_sct_model`、`residual_features` and `conserve.memory`,
-    #     we will finish these features in the future (~_~)
+    # TODO: ignore `reference_sct_model` and `residual_features`, we will finish these features in the future (~_~)
+    # `conserve.memory` streams the residuals gene bin by gene bin in `vst`, clipped by its `res_clip_range`
     if reference_sct_model:
         # sct_method = 'reference.model'
         raise NotImplementedError
@@ -123,12 +122,13 @@ def SCTransform(
         # sct_method = 'residual.features'
         raise NotImplementedError
     elif conserve_memory:
-        # sct_method = 'conserve.memory'
-        raise NotImplementedError
+        sct_method = 'conserve.memory'
+        return_only_var_genes = True
+        vst_args['conserve_memory'] = True
     else:
         sct_method = 'default'
 
-    if sct_method == 'default':
+    if sct_method in ('default', 'conserve.memory'):
         vst_out = vst(**vst_args)
     else:
         raise NotImplementedError
@@ -147,6 +147,14 @@ def SCTransform(
             vst_out['y']['level_0'] = range(0, vst_out['y'].shape[0])
             vst_out['y'] = vst_out['y'].loc[top_features].sort_values('level_0')
             del vst_out['y']['level_0']
+    elif sct_method == 'conserve.memory':
+        # the residuals of the variable genes only, in the order of `umi_genes`
+        vst_out['y'] = get_residuals(
+            vst_out, umi, genes, top_features,
+            residual_type=vst_args.get('residual_type', 'pearson'),
+            min_variance=vst_args.get('min_variance', -np.inf),
+            bin_size=vst_args.get('bin_size', 500)
+        )
     else:
         raise NotImplementedError
 
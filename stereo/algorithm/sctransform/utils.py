@@ -4,8 +4,8 @@ import pandas as pd
 
 from joblib import Parallel, delayed, cpu_count
 from patsy.highlevel import dmatrix
-from scipy.special import polygamma, digamma
 from scipy import interpolate
+from scipy.sparse import csr_matrix
 from KDEpy import FFTKDE
 
 from .bw import bwSJ
@@ -45,7 +45,13 @@ def dds(genes_log10_gmean_step1, grid_points=2 ** 10):
 
 
 def row_gmean_sparse(umi, gmean_eps=1):
-    return np.squeeze(np.asarray(np.array([row_gmean(x.todense(), gmean_eps)[0] for x in umi])))
+    umi = csr_matrix(umi)
+    n_cols = umi.shape[1]
+    rows = np.repeat(np.arange(umi.shape[0]), np.diff(umi.indptr))
+    # the zeros of a row take `log(gmean_eps)` each
+    log_sum = np.bincount(rows, weights=np.log(umi.data + gmean_eps) - np.log(gmean_eps), minlength=umi.shape[0])
+    log_sum += n_cols * np.log(gmean_eps)
+    return np.exp(log_sum / n_cols) - gmean_eps
 
 
 def row_gmean(umi, gmean_eps=1):
@@ -59,121 +65,150 @@ def make_cell_attr(umi, cells, latent_var, batch_var, latent_var_nonreg) -> pd.D
     return pd.DataFrame(tmp_dict_cell_attr, index=cells)
 
 
-def fit_poisson(umi, model_str, data, theta_estimation_fun="theta.ml") -> pd.DataFrame:
+def fit_poisson(umi, model_str, data, theta_estimation_fun="theta.ml", gene_batch_size=500) -> pd.DataFrame:
     # TODO: ignore `theta_estimation_fun`
-    regressor_data = dmatrix("~log_umi", data, return_type='dataframe')
-    results = Parallel(n_jobs=cpu_count(), backend="threading")(
-        delayed(one_row_fit_poission)(regressor_data, y.toarray()[0], theta_estimation_fun)
-        for y in umi
-    )
-    return pd.DataFrame(results, columns=["theta", "Intercept", "log_umi"])
-
-
-@numba.jit(cache=True, forceobj=True, nogil=True)
-def one_row_fit_poission(regressor_data, y, theta_estimation_fun='theta.ml'):
-    fit = qpois_reg(regressor_data.to_numpy(), y, 1e-9, 100, 1.0001, True)
-    if theta_estimation_fun == "theta.ml":
-        theta = theta_ml(y=y, mu=fit['fitted'])
-    elif theta_estimation_fun == "theta.mm":
+    if theta_estimation_fun == "theta.mm":
         # TODO: `theta.mm` not yet finished
         raise NotImplementedError
-    else:
+    elif theta_estimation_fun != "theta.ml":
         raise Exception
-    return theta, fit['coefficients'][0], fit['coefficients'][1]
-
-
-@numba.jit(cache=True, forceobj=True, nogil=True)
-def qpois_reg(X, Y, tol, maxiters, minphi, returnfit):
+    regressor_data = dmatrix("~log_umi", data, return_type='dataframe')
+    x = regressor_data.to_numpy()
+    umi = csr_matrix(umi, dtype=np.double)
+    n_genes = umi.shape[0]
+    # the genes are fitted batch by batch, each batch at once as matrix operations
+    results = Parallel(n_jobs=cpu_count(), backend="threading")(
+        delayed(qpois_reg_batch)(x, umi[start:start + gene_batch_size], 1e-9, 100)
+        for start in range(0, n_genes, gene_batch_size)
+    )
+    coefficients = np.vstack([r[0] for r in results]) if results else np.zeros((0, x.shape[1]))
+    fitted_coefficients = np.vstack([r[1] for r in results]) if results else np.zeros((0, x.shape[1]))
+    theta = theta_ml_batch(umi.data, umi.indices, umi.indptr, x, fitted_coefficients)
+    return pd.DataFrame({"theta": theta, "Intercept": coefficients[:, 0], "log_umi": coefficients[:, 1]},
+                        columns=["theta", "Intercept", "log_umi"])
+
+
+def qpois_reg_batch(X, Y, tol, maxiters):
+    """
+    Poisson regression of each row of `Y` on the shared design `X` by Newton's method (IRLS), all the rows are
+    updated at once and each row stops once its coefficients converge.
+
+    :param X: the design matrix, shape (n_cells, n_cols).
+    :param Y: the counts, a csr_matrix of shape (n_genes, n_cells).
+    :return: the coefficients and the coefficients the fitted values of the last iteration are computed from,
+            both of shape (n_genes, n_cols).
+    """
     n, pcols = X.shape
-    d = pcols
-
-    b_old = np.zeros(shape=(d, 1), dtype=np.double)
-    b_new = np.zeros(shape=(d, 1), dtype=np.double)
-
-    y = Y.reshape((Y.shape[0], 1))
-    m = np.zeros(shape=(n, 1), dtype=np.double)
-    phi = np.zeros(shape=(n, 1), dtype=np.double)
-
-    x = X
+    n_genes = Y.shape[0]
+    b_old = np.zeros(shape=(n_genes, pcols), dtype=np.double)
+    yx = np.asarray(Y @ X)
 
     i = 0
     while i < pcols:
-        unique_vals = np.unique(x[0:, i])
+        unique_vals = np.unique(X[0:, i])
         if unique_vals.shape[0] == 1:
-            b_old[i] = np.log(np.mean(y))
+            with np.errstate(divide='ignore'):
+                b_old[:, i] = np.log(np.asarray(Y.sum(1)).reshape(-1) / n)
             break
         if unique_vals.shape[0] == 2 and (unique_vals[0] == 0 or unique_vals[1] == 0):
-            b_old[i] = np.matmul(y.T, x[0:, i]).item()
-            b_old[i] = b_old[i] / np.sum(x[0:, i])
-            b_old[i] = np.log(max(1e-9, b_old[i]))
+            b_old[:, i] = np.log(np.maximum(1e-9, yx[:, i] / np.sum(X[0:, i])))
         i += 1
 
-    x_tr = x.T
+    # the Hessian of each row is `(m @ xx).reshape(pcols, pcols)` with the fitted values `m`
+    xx = (X[:, :, None] * X[:, None, :]).reshape(n, pcols * pcols)
+    fitted = b_old.copy()
+    active = np.arange(n_genes)
     ij = 2
-    dif = 1.0
-
-    while dif > tol:
-        yhat = np.matmul(x, b_old)
-        m = np.exp(yhat)
-        phi = y - m
-        L1 = np.matmul(x_tr, phi)
-        L2 = []
-        for i in range(x.shape[1]):
-            L2.append(np.multiply(np.asmatrix(x[0:, i]).T, m))
-        L2 = np.array(L2).T
-        L2 = np.matmul(x_tr, L2)
-
-        b_new = b_old + np.matmul(np.linalg.inv(L2), L1)[0]
-        dif = np.sum(np.abs(b_new - b_old))
-        b_old = b_new
+    while active.size > 0:
+        b = b_old[active]
+        m = np.exp(b @ X.T)
+        L1 = yx[active] - m @ X
+        L2 = (m @ xx).reshape(-1, pcols, pcols)
+        b_new = b + np.linalg.solve(L2, L1[:, :, None])[:, :, 0]
+        dif = np.sum(np.abs(b_new - b), axis=1)
+        fitted[active] = b
+        b_old[active] = b_new
         ij += 1
         if ij == maxiters:
             break
-
-    p = np.sum(np.square(phi) / m) / (n - pcols)
-    return {
-        "coefficients": b_new.T[0],
-        "phi": p,
-        "theta.guesstimate": (np.mean(m) / (max(p, minphi) - 1)),
-        "fitted": m.T[0] if returnfit else None
-    }
-
-
-@numba.jit(cache=True, forceobj=True, nogil=True)
-def theta_ml(y, mu, limit=10, eps=0.0001220703):
-    weights = np.ones(len(y))
-    n = np.sum(weights)
-    t0 = n / np.sum(np.power(weights * (y / mu - 1), 2))
-    it = 1
-    _del = 1
-    while it < limit and np.abs(_del) > eps:
-        t0 = np.abs(t0)
-        i = info(n, t0, mu, y, weights)
-        _del = score(n, t0, mu, y, weights) / i
-        t0 = t0 + _del
-        it += 1
-    if t0 < 0:
-        t0 = 0
-    return t0
-
-
-@numba.jit(cache=True, forceobj=True, nogil=True)
-def score(n, th, mu, y, w):
-    a = th + y
-    b = th + mu
-    return np.sum(w * (digamma(a) - digamma(th) + np.log(th) + 1 - np.log(b) - a / b))
-
-
-@numba.jit(cache=True, forceobj=True, nogil=True)
-def trigamma(x):
-    return polygamma(1, x)
-
-
-@numba.jit(cache=True, forceobj=True, nogil=True)
-def info(n, th, mu, y, w):
-    a = th + y
-    b = th + mu
-    return np.sum(w * (-trigamma(a) + trigamma(th) - 1 / th + 2 / b - a / np.power(b, 2)))
+        active = active[dif > tol]
+    return b_old, fitted
+
+
+@numba.njit(cache=True, nogil=True)
+def _digamma(x):
+    result = 0.0
+    while x < 6.0:
+        result -= 1.0 / x
+        x += 1.0
+    f = 1.0 / (x * x)
+    return result + np.log(x) - 0.5 / x - f * (1.0 / 12 - f * (1.0 / 120 - f * (1.0 / 252 - f * (
+            1.0 / 240 - f * (1.0 / 132)))))
+
+
+@numba.njit(cache=True, nogil=True)
+def _trigamma(x):
+    result = 0.0
+    while x < 6.0:
+        result += 1.0 / (x * x)
+        x += 1.0
+    f = 1.0 / (x * x)
+    return result + 1.0 / x + f / 2 + f / x * (1.0 / 6 - f * (1.0 / 30 - f * (1.0 / 42 - f * (
+            1.0 / 30 - f * (5.0 / 66)))))
+
+
+@numba.njit(cache=True, nogil=True, parallel=True)
+def theta_ml_batch(data, indices, indptr, X, coefficients, limit=10, eps=0.0001220703):
+    """
+    Maximum likelihood estimate of the negative binomial theta of each row of a csr_matrix of counts,
+    the mean of row `g` at column `c` is `exp(X[c] @ coefficients[g])`.
+
+    The terms of the score and the information at the zeros of a row only depend on the mean, so the counts are
+    only visited at the nonzeros.
+    """
+    n_genes = indptr.shape[0] - 1
+    n, pcols = X.shape
+    thetas = np.empty(n_genes, dtype=np.double)
+    for g in numba.prange(n_genes):
+        mu = np.empty(n, dtype=np.double)
+        for c in range(n):
+            eta = 0.0
+            for k in range(pcols):
+                eta += X[c, k] * coefficients[g, k]
+            mu[c] = np.exp(eta)
+        start, end = indptr[g], indptr[g + 1]
+
+        # the zeros take (0 / mu - 1) ** 2 = 1 each
+        sum_sq = n - (end - start)
+        for j in range(start, end):
+            sum_sq += (data[j] / mu[indices[j]] - 1) ** 2
+        t0 = n / sum_sq
+        it = 1
+        _del = 1.0
+        while it < limit and np.abs(_del) > eps:
+            t0 = np.abs(t0)
+            score = 0.0
+            info = 0.0
+            log_t0 = np.log(t0)
+            for c in range(n):
+                b = t0 + mu[c]
+                score += log_t0 + 1 - np.log(b) - t0 / b
+                info += -1 / t0 + 2 / b - t0 / (b * b)
+            if end > start:
+                digamma_t0 = _digamma(t0)
+                trigamma_t0 = _trigamma(t0)
+                for j in range(start, end):
+                    y = data[j]
+                    b = t0 + mu[indices[j]]
+                    score += _digamma(t0 + y) - digamma_t0 - y / b
+                    info += trigamma_t0 - _trigamma(t0 + y) - y / (b * b)
+            _del = score / info
+            t0 = t0 + _del
+            it += 1
+        if t0 < 0:
+            t0 = 0
+        thetas[g] = t0
+    return thetas
 
 
 def is_outlier(y, x, th=10, eps=2.220446e-16 * 10):
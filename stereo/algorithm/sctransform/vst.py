@@ -2,17 +2,19 @@ import time
 from typing import Optional
 from random import sample
 
+import h5py
 import numba
 import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
 from patsy.highlevel import dmatrix
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, vstack
 
 from .bw import bwSJ
 from .ksmooth import ksmooth
 from .utils import make_cell_attr, cpu_count, dds, multi_pearson_residual, is_outlier, fit_poisson, \
     row_gmean_sparse
+from stereo.core.lazy_matrix import H5MatrixSource, LazyExpMatrix
 from stereo.log_manager import logger
 
 
@@ -47,7 +49,18 @@ def vst(
         fix_slope=False,
         scale_factor=None,
         vst_flavor=None,
+        conserve_memory=False,
+        corrected_umi_store=None,
 ):
+    """
+    Variance stabilizing transformation of UMI count data by regularized negative binomial regression.
+
+    When `conserve_memory` is `True`, the residuals are computed block by block over the gene bins and the
+    residual matrix of all genes is never created, only the residual mean and variance of each gene and the corrected
+    UMI are kept, `rv['y']` is `None` and the residuals of the chosen genes can be computed by `get_residuals`.
+    `corrected_umi_store` is the path of a HDF5 file to spill the blocks of corrected UMI to, then `rv['umi_corrected']`
+    is a `LazyExpMatrix` backed by the file.
+    """
     # TODO: `vst.flavor` not completed
     if vst_flavor is not None:
         logger.warn("`vst.flavor` not completed")
@@ -101,9 +114,8 @@ def vst(
 
     if n_genes and n_genes < len(genes_step1):
         sampling_prob = dds(genes_log_gmean_step1)
-        genes_step1 = np.array(
-            pd.DataFrame(genes_step1).sample(n_genes, weights=sampling_prob.T, random_state=np.random.RandomState())).T[
-            0]
+        # sampled by the global random state, which is seeded by `seed_use` of `SCTransform`
+        genes_step1 = np.array(pd.DataFrame(genes_step1).sample(n_genes, weights=sampling_prob.T)).T[0]
         genes_step1_bool_list = np.isin(genes, genes_step1)
         if use_geometric_mean:
             genes_log_gmean_step1 = \
@@ -155,7 +167,14 @@ def vst(
         regressor_data_final = regressor_data
 
     start_time = time.time()
-    if residual_type:
+    residual_stats, corrected_umi = None, None
+    if residual_type and conserve_memory:
+        residual_stats, corrected_umi = stream_residuals(
+            umi, genes, model_pars_final, regressor_data_final, cell_attr, residual_type, min_variance, bin_size,
+            res_clip_range, return_corrected_umi and residual_type == 'pearson', scale_factor, corrected_umi_store
+        )
+        res = None
+    elif residual_type:
         # TODO `min_variance` not completed related to `vst_flavor`
         bin_ind = np.ceil(np.array(range(1, len(genes) + 1)) / bin_size)
         max_bin = int(np.max(bin_ind))
@@ -182,10 +201,13 @@ def vst(
         "cell_attr": cell_attr,
         "umi_genes": genes,
         "umi_cells": regressor_data_final.index.values,
+        "res_clip_range": res_clip_range,
     }
 
     if return_corrected_umi:
-        if residual_type == "pearson":
+        if residual_type == "pearson" and conserve_memory:
+            rv["umi_corrected"] = corrected_umi
+        elif residual_type == "pearson":
             start_time = time.time()
             rv["umi_corrected"] = correct(rv, genes, do_round=True, do_pos=True, scale_factor=scale_factor,
                                           bin_size=bin_size)
@@ -193,8 +215,9 @@ def vst(
         else:
             logger.info("will not return corrected UMI because residual type is not set to `pearson`")
 
-    rv["y"][rv["y"] < res_clip_range[0]] = res_clip_range[0]
-    rv["y"][rv["y"] > res_clip_range[1]] = res_clip_range[1]
+    if rv["y"] is not None:
+        rv["y"][rv["y"] < res_clip_range[0]] = res_clip_range[0]
+        rv["y"][rv["y"] > res_clip_range[1]] = res_clip_range[1]
     if not return_cell_attr:
         rv["cell_attr"] = None
 
@@ -206,7 +229,10 @@ def vst(
         gene_attr["amean"] = pd.DataFrame(umi_genes_mean, index=genes)
         gene_attr["variance"] = \
             pd.DataFrame(np.power((umi - umi_genes_mean), 2).sum(1) / (umi.shape[1] - 1), index=genes)[0]
-        if rv['y'].shape[1] > 0:
+        if residual_stats is not None:
+            gene_attr["residual_mean"] = residual_stats["residual_mean"]
+            gene_attr["residual_variance"] = residual_stats["residual_variance"]
+        elif rv['y'] is not None and rv['y'].shape[1] > 0:
             gene_attr["residual_mean"] = rv['y'].mean(1)
             gene_attr["residual_variance"] = rv['y'].var(1)
         rv["gene_attr"] = gene_attr
@@ -315,12 +341,7 @@ def reg_model_pars(
 
 
 def correct(x, genes, as_is=False, do_round=True, do_pos=True, scale_factor=None, bin_size=500):
-    if not as_is:
-        cell_attr = x['cell_attr'].copy()
-        cell_attr['log_umi'] = [np.median(cell_attr['log_umi'])] * len(cell_attr['log_umi'])
-    else:
-        cell_attr = x['cell_attr']
-    regressor_data = dmatrix("~log_umi", cell_attr, return_type='dataframe')
+    regressor_data = _correct_regressor_data(x['cell_attr'], as_is)
     bin_ind = np.ceil(np.array(range(1, len(genes) + 1)) / bin_size)
     max_bin = int(np.max(bin_ind))
     corrected_data = pd.concat(Parallel(n_jobs=cpu_count(), backend='threading')(
@@ -334,6 +355,155 @@ def correct(x, genes, as_is=False, do_round=True, do_pos=True, scale_factor=None
     return csr_matrix(corrected_data)
 
 
+def _correct_regressor_data(cell_attr, as_is=False):
+    if not as_is:
+        cell_attr = cell_attr.copy()
+        cell_attr['log_umi'] = [np.median(cell_attr['log_umi'])] * len(cell_attr['log_umi'])
+    return dmatrix("~log_umi", cell_attr, return_type='dataframe')
+
+
+def _iter_residual_blocks(umi, genes, model_pars_final, regressor_data_final, residual_type, min_variance, bin_size,
+                          gene_index=None):
+    """
+    Compute the residuals of the gene bins of `bin_ind` in windows of `cpu_count()` bins by threads.
+
+    :param gene_index: the indices of the genes to compute, default all genes.
+    :return: an iterator of `(index of the genes of the block, dense residuals of the block)`.
+    """
+    if gene_index is None:
+        gene_index, sub_genes, sub_umi = np.arange(len(genes)), genes, umi
+    else:
+        gene_index = np.asarray(gene_index)
+        sub_genes, sub_umi = genes[gene_index], umi[gene_index]
+    bin_ind = np.ceil(np.array(range(1, gene_index.size + 1)) / bin_size)
+    max_bin = int(np.max(bin_ind)) if bin_ind.size else 0
+    window = max(cpu_count(), 1)
+    for first in range(1, max_bin + 1, window):
+        bins = range(first, min(first + window, max_bin + 1))
+        blocks = Parallel(n_jobs=cpu_count(), backend='threading')(
+            delayed(multi_pearson_residual)(i, model_pars_final, regressor_data_final, sub_umi, residual_type,
+                                            min_variance, sub_genes, bin_ind)
+            for i in bins
+        )
+        for i, block in zip(bins, blocks):
+            yield gene_index[bin_ind == i], np.asarray(block)
+
+
+def stream_residuals(umi, genes, model_pars_final, regressor_data_final, cell_attr, residual_type, min_variance,
+                     bin_size, res_clip_range, return_corrected_umi=False, scale_factor=None, corrected_umi_store=None):
+    """
+    Compute the residuals block by block, keeping the residual mean and variance of each gene and the corrected UMI.
+
+    :return: a DataFrame of `residual_mean` and `residual_variance` of the genes, and the corrected UMI which is
+            a csr_matrix, a `LazyExpMatrix` backed by `corrected_umi_store` or `None` if not `return_corrected_umi`.
+    """
+    n_genes = len(genes)
+    residual_mean = np.zeros(n_genes, dtype=np.double)
+    residual_variance = np.zeros(n_genes, dtype=np.double)
+    correct_regressor_data = _correct_regressor_data(cell_attr) if return_corrected_umi else None
+    writer = _CsrBlockWriter(corrected_umi_store, umi.shape[1]) if return_corrected_umi else None
+    try:
+        for gene_index, block in _iter_residual_blocks(umi, genes, model_pars_final, regressor_data_final,
+                                                       residual_type, min_variance, bin_size):
+            if writer is not None:
+                genes_bin = genes[gene_index]
+                corrected = get_correct_data(
+                    model_pars_final.loc[genes_bin, ["Intercept", "log_umi"]], correct_regressor_data,
+                    model_pars_final.loc[genes_bin, 'theta'], pd.DataFrame(block)
+                )
+                corrected = np.round(np.asarray(corrected), 0)
+                corrected[corrected < 0] = 0
+                writer.append(csr_matrix(corrected))
+            np.clip(block, res_clip_range[0], res_clip_range[1], out=block)
+            residual_mean[gene_index] = block.mean(1)
+            residual_variance[gene_index] = block.var(1, ddof=1)
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        raise
+    corrected_umi = writer.close() if writer is not None else None
+    residual_stats = pd.DataFrame(
+        {"residual_mean": residual_mean, "residual_variance": residual_variance}, index=genes
+    )
+    return residual_stats, corrected_umi
+
+
+def get_residuals(vst_out, umi, genes, features, residual_type='pearson', min_variance=-np.inf, bin_size=500):
+    """
+    Compute the clipped residuals of the features by the models of `vst`, used when `vst` runs with
+    `conserve_memory`.
+
+    :param umi: the UMI counts with genes as rows and cells as columns.
+    :param genes: the genes of the rows of `umi`.
+    :param features: the genes to compute, in the order of `genes` in the result.
+    :return: a DataFrame of the residuals with the features as rows and the cells as columns.
+    """
+    regressor_data_final = dmatrix("~log_umi", vst_out['cell_attr'], return_type='dataframe')
+    gene_index = np.flatnonzero(np.isin(genes, features))
+    res_clip_range = vst_out['res_clip_range']
+    blocks = []
+    for _, block in _iter_residual_blocks(umi, genes, vst_out['model_pars_fit'], regressor_data_final, residual_type,
+                                          min_variance, bin_size, gene_index):
+        np.clip(block, res_clip_range[0], res_clip_range[1], out=block)
+        blocks.append(block)
+    res = np.vstack(blocks) if blocks else np.zeros((0, umi.shape[1]))
+    return pd.DataFrame(res, index=genes[gene_index], columns=regressor_data_final.index.values)
+
+
+class _CsrBlockWriter(object):
+    """
+    Stack the row blocks of a csr_matrix in memory, or append them to a HDF5 group laid out as
+    `h5ad.write_spmatrix` when `file_path` is set.
+    """
+
+    def __init__(self, file_path, n_cols, key='umi_corrected'):
+        self.file_path = file_path
+        self.n_cols = n_cols
+        self.key = key
+        self.blocks = []
+        self.indptr = [np.zeros(1, dtype=np.int64)]
+        self.n_rows = 0
+        self.nnz = 0
+        self.f = None
+        if file_path is not None:
+            self.f = h5py.File(file_path, 'a')
+            if key in self.f:
+                del self.f[key]
+            group = self.f.create_group(key)
+            group.attrs.setdefault('encoding-type', 'csr_matrix')
+            group.attrs.setdefault('encoding-version', '0.1.0')
+            self.data = group.create_dataset('data', shape=(0,), maxshape=(None,), dtype=np.double, chunks=True)
+            self.indices = group.create_dataset('indices', shape=(0,), maxshape=(None,), dtype=np.int32, chunks=True)
+            self.group = group
+
+    def append(self, block: csr_matrix):
+        if self.f is None:
+            self.blocks.append(block)
+        else:
+            block.sort_indices()
+            self.data.resize((self.nnz + block.nnz,))
+            self.indices.resize((self.nnz + block.nnz,))
+            self.data[self.nnz:] = block.data
+            self.indices[self.nnz:] = block.indices
+            self.indptr.append(block.indptr[1:].astype(np.int64) + self.nnz)
+        self.n_rows += block.shape[0]
+        self.nnz += block.nnz
+
+    def close(self):
+        if self.f is None:
+            if not self.blocks:
+                return csr_matrix((0, self.n_cols), dtype=np.double)
+            return vstack(self.blocks, format='csr')
+        self.group.create_dataset('indptr', data=np.concatenate(self.indptr))
+        self.group.attrs['shape'] = (self.n_rows, self.n_cols)
+        self.f.close()
+        return LazyExpMatrix(H5MatrixSource(self.file_path, self.key))
+
+    def abort(self):
+        if self.f is not None:
+            self.f.close()
+
+
 @numba.jit(cache=True, forceobj=True, nogil=True)
 def multi_correct_data(x, genes, bin_ind, data, i, regressor_data):
     genes_bin = genes[bin_ind == i]
@@ -2,7 +2,6 @@ import time
 from collections import defaultdict
 
 import scipy
-import numba
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
@@ -10,8 +9,9 @@ from joblib import Parallel, delayed, cpu_count
 
 from ...log_manager import logger
 from ..algorithm_base import AlgorithmBase
-from .utils import corr_spearman, apply_along_axis
+from .utils import apply_along_axis, normalized_ranks, corr_spearman_sparse
 from ...core.stereo_exp_data import StereoExpData
+from ...utils.group_stats import GroupStats
 
 
 class _TestData(object):
@@ -25,12 +25,6 @@ class _TestData(object):
         return pd.DataFrame(self.exp_matrix.toarray(), index=self.cell_names, columns=self.gene_names)
 
 
-def _spearman_parallel(label, ranked_mat_ref, y, quantile):
-    ranked_mat_qry = apply_along_axis(y)
-    sim = corr_spearman(ranked_mat_ref, ranked_mat_qry)
-    return label, np.percentile(sim, quantile, axis=1)
-
-
 def _get_label_genes_set(top_labels, trained_data, de_n_len=0):
     de_n = np.round(500 * (2 / 3) ** np.log2(de_n_len if de_n_len else len(top_labels)))
     res_set = set()
@@ -51,6 +45,7 @@ class SingleR(AlgorithmBase):
         self.fine_tune_times = None
         self.group_data_frame = None
         self.fine_tune_threshold = None
+        self.batch_size = None
 
     def main(
             self,
@@ -62,6 +57,7 @@ class SingleR(AlgorithmBase):
             fine_tune_times=0,
             n_jobs=int(cpu_count() / 2),
             res_key='annotation',
+            batch_size=1000,
     ):
         """
         Single-cell recognition is a tool to automatically annotate a test sample by a reference sample.
@@ -76,6 +72,8 @@ class SingleR(AlgorithmBase):
                                 If it is set to num(eg: 5), it will only loop only 5 times, and choose the first one.
         :param n_jobs: `joblib` parameter, will create `n_jobs` num of threads to work.
         :param res_key: default to `annotation`, means the result will be stored as key `annotation` in the `tl.result`.
+        :param batch_size: the number of test cells scored against the reference at once, the test expression matrix
+                            is ranked batch by batch as a sparse matrix and never densified.
         :return: `pandas.DataFrame`
         """
         assert ref_use_col in ref_exp_data.tl.result
@@ -84,7 +82,7 @@ class SingleR(AlgorithmBase):
         assert interact_genes, "no gene of `test_exp_data.gene_names` in `ref_exp_data.gene_names`"
 
         test_exp_data = self.stereo_exp_data.sub_by_name(gene_name=interact_genes)
-        ref_exp_data.sub_by_name(gene_name=interact_genes)
+        ref_exp_data = ref_exp_data.sub_by_name(gene_name=interact_genes)
 
         self.group_data_frame = ref_exp_data.tl.result[ref_use_col]
         self.group_data_frame = self.group_data_frame.reset_index()
@@ -102,6 +100,7 @@ class SingleR(AlgorithmBase):
         self.quantile = quantile
         self.fine_tune_times = fine_tune_times
         self.fine_tune_threshold = fine_tune_threshold
+        self.batch_size = max(int(batch_size), 1)
 
         logger.info(f'start single-r with n_jobs={n_jobs} fine_tune_times={fine_tune_times}')
         the_very_start_time = time.time()
@@ -113,20 +112,11 @@ class SingleR(AlgorithmBase):
 
         test_cluster_result = None
         if cluster_res_key:
-            tmp_exp_matrix = pd.DataFrame(
-                test_exp_data.exp_matrix.todense() if scipy.sparse.issparse(
-                    test_exp_data.exp_matrix) else test_exp_data.exp_matrix,
-                index=test_exp_data.cell_names,
-                columns=test_exp_data.gene_names
-            )
             test_cluster_result = test_exp_data.tl.result[cluster_res_key]
-            test_group_data_frame = test_cluster_result['group']
-            if 'bins' in test_cluster_result:
-                test_group_data_frame.index = test_cluster_result['bins'].values
-            tmp_exp_matrix = tmp_exp_matrix.groupby(test_group_data_frame).sum()
+            group_stats = GroupStats(test_exp_data.exp_matrix, test_cluster_result['group'].values)
             test_data = _TestData(
-                scipy.sparse.csr_matrix(tmp_exp_matrix.values),
-                tmp_exp_matrix.index,
+                scipy.sparse.csr_matrix(group_stats.sum()),
+                group_stats.group_index,
                 np.array(range(len(test_exp_data.gene_names)))
             )
         else:
@@ -199,22 +189,37 @@ class SingleR(AlgorithmBase):
 
         return ret_all, list(common_gene)
 
+    def _label_ranks(self, labels, genes):
+        """
+        the normalized ranks of the reference cells of each label over the genes, shape (n_genes, n_cells_of_label).
+        """
+        ref_groups = self.group_data_frame['group'].values
+        ranks = {}
+        for label in labels:
+            cells = np.isin(self.ref_exp_data.cell_names, self.group_data_frame['bins'].values[ref_groups == label])
+            ranks[label] = normalized_ranks(self.ref_exp_data.exp_matrix[cells][:, genes])
+        return ranks
+
+    def _score_batch(self, test_mat, label_ranks):
+        return np.stack([
+            np.percentile(corr_spearman_sparse(test_mat, ranks), self.quantile, axis=1)
+            for ranks in label_ranks.values()
+        ], axis=1)
+
     def _score_test_data(self, test_data, common_gene):
-        original_exp = {}
         ref_common_gene_bool_list = np.isin(self.ref_exp_data.gene_names, common_gene)
-        for x, y in self.group_data_frame.groupby('group'):
-            y_cell_bool_list = np.isin(self.ref_exp_data.cell_names, y['bins'].values)
-            original_exp[x] = self.ref_exp_data.exp_matrix[y_cell_bool_list][:, ref_common_gene_bool_list].toarray()
-
-        test_mat = test_data.exp_matrix[:, np.isin(test_data.gene_names, common_gene)].toarray()
-        ranked_mat_ref = apply_along_axis(test_mat.T)
-
-        res_dict = dict(Parallel(n_jobs=self.n_jobs, backend="threading")(
-            delayed(_spearman_parallel)(label, ranked_mat_ref, y.T, self.quantile)
-            for label, y in tqdm(original_exp.items())
-        ))
-
-        ret = pd.DataFrame(res_dict, index=test_data.cell_names)
+        labels = self.group_data_frame['group'].astype('category').cat.categories
+        labels = [label for label in labels if (self.group_data_frame['group'] == label).any()]
+        label_ranks = self._label_ranks(labels, ref_common_gene_bool_list)
+
+        test_mat = scipy.sparse.csr_matrix(test_data.exp_matrix)[:, np.isin(test_data.gene_names, common_gene)]
+        n_cells = test_mat.shape[0]
+        scores = Parallel(n_jobs=self.n_jobs, backend="threading")(
+            delayed(self._score_batch)(test_mat[start:start + self.batch_size], label_ranks)
+            for start in tqdm(range(0, n_cells, self.batch_size))
+        )
+        scores = np.concatenate(scores) if scores else np.zeros((0, len(labels)))
+        ret = pd.DataFrame(scores, index=test_data.cell_names, columns=labels)
         return ret, ret.columns[np.argmax(ret.values, axis=1)]
 
     def _fine_tune(self, test_data, output, trained_data):
@@ -222,77 +227,85 @@ class SingleR(AlgorithmBase):
         tmp[tmp < np.array(np.max(output.values, axis=1) - self.fine_tune_threshold).reshape([-1, 1])] = 0
         tmp[tmp > 0] = 1
 
-        ref = pd.DataFrame(
-            self.ref_exp_data.exp_matrix.toarray(),
-            index=self.ref_exp_data.cell_names,
-            columns=self.ref_exp_data.gene_names
-        )
-
         logger.info(f'fine-tuning with test_data(shape={test_data.exp_matrix.shape})')
 
-        ret_labels = Parallel(n_jobs=self.n_jobs, backend="threading")(
-            delayed(self._fine_tune_parallel)(
-                ref,
-                output.columns[tmp[x].astype(bool)].values,
-                y[1].to_frame().T,
-                trained_data
+        test_mat = scipy.sparse.csr_matrix(test_data.exp_matrix)
+        ret_labels = np.empty(test_mat.shape[0], dtype=object)
+        # the cells sharing the same candidate labels are fine-tuned together
+        pending = self._group_by_labels(output.columns.values, tmp.astype(bool), np.arange(test_mat.shape[0]))
+        try_num = 0
+        while pending:
+            if self.fine_tune_times and try_num >= self.fine_tune_times:
+                for labels, cells in pending:
+                    ret_labels[cells] = labels[0]
+                break
+            tasks = []
+            for labels, cells in pending:
+                if len(labels) <= 1:
+                    ret_labels[cells] = labels[0]
+                    continue
+                for start in range(0, cells.size, self.batch_size):
+                    tasks.append((labels, cells[start:start + self.batch_size]))
+            results = Parallel(n_jobs=self.n_jobs, backend="threading")(
+                delayed(self._fine_tune_one_time)(labels, test_mat[cells], trained_data) for labels, cells in tasks
             )
-            for x, y in tqdm(enumerate(test_data.to_df().iterrows()))
-        )
-        return ret_labels
-
-    def _fine_tune_parallel(self, ref, labels, y, trained_data):
-        label_genes = _get_label_genes_set(labels, trained_data, 2)
-        ref = ref.loc[:, list(label_genes)]
-        if self.fine_tune_times:
-            try_num = 0
-            while try_num < self.fine_tune_threshold and len(labels) > 1:
-                labels = self._fine_tune_one_time(labels, ref, y, trained_data)
-                try_num += 1
-        else:
-            while len(labels) > 1:
-                labels = self._fine_tune_one_time(labels, ref, y, trained_data)
-        return labels[0]
+            pending = []
+            for (labels, cells), selected in zip(tasks, results):
+                pending.extend(self._group_by_labels(labels, selected, cells))
+            try_num += 1
+        return list(ret_labels)
+
+    @staticmethod
+    def _group_by_labels(labels, selected, cells):
+        """
+        group the cells by their selected labels, the cells selecting no label keep the first one.
 
-    @numba.jit(forceobj=True, nogil=True, parallel=True)
-    def _fine_tune_one_time(self, top_labels, ref, test, trained_data):
+        :return: a list of `(labels, cells)`.
+        """
+        selected = np.asarray(selected, dtype=bool)
+        selected[~selected.any(axis=1), 0] = True
+        unique_selected, inverse = np.unique(selected, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        return [(labels[row], cells[inverse == i]) for i, row in enumerate(unique_selected)]
+
+    def _fine_tune_one_time(self, top_labels, test_mat, trained_data):
+        """
+        score the cells against the reference cells of the top labels over the genes distinguishing them.
+
+        :return: a boolean array of shape (n_cells, n_top_labels), the labels kept for each cell.
+        """
+        n_cells = test_mat.shape[0]
+        keep_first = np.zeros((n_cells, len(top_labels)), dtype=bool)
+        keep_first[:, 0] = True
         label_genes = _get_label_genes_set(top_labels, trained_data)
         if len(label_genes) < 20:
-            return [top_labels[0]]
-
-        genes_filtered = list(label_genes)
-        test_filtered = test.loc[:, genes_filtered].values
-        if np.std(test_filtered) <= 0:
-            return [top_labels[0]]
-
-        bool_list = np.isin(self.group_data_frame['group'].values, top_labels)
-        ref_filtered = ref.loc[bool_list, genes_filtered]
-        group_data_frame_filtered = self.group_data_frame.loc[bool_list].reset_index()
-
-        ranked_mat_ref = apply_along_axis(test_filtered.T)
-        res_labels = {}
-        for p, q in group_data_frame_filtered.groupby('group'):
-            ref_filtered_by_group = ref_filtered.iloc[q.index].values.T
-            ranked_mat_qry = apply_along_axis(ref_filtered_by_group)
-            sim = corr_spearman(ranked_mat_ref, ranked_mat_qry)
-            if not (sim.shape and sim.shape[0] and sim.shape[1]):
-                continue
-            res_labels[p] = np.percentile(sim, self.quantile, axis=1)[0]
-        if not res_labels:
-            return [top_labels[0]]
+            return keep_first
+
+        genes_filtered = np.sort(np.array(list(label_genes)))
+        test_filtered = test_mat[:, genes_filtered]
+        # the cells whose expression of the genes are all the same
+        constant = np.asarray(test_filtered.max(axis=1).todense()).reshape(-1) == \
+            np.asarray(test_filtered.min(axis=1).todense()).reshape(-1)
+
+        label_ranks = self._label_ranks(top_labels, genes_filtered)
+        scored = np.array([label_ranks[label].shape[1] > 0 for label in top_labels])
+        if not scored.any():
+            return keep_first
+        scores = np.full((n_cells, len(top_labels)), np.nan)
+        for i, label in enumerate(top_labels):
+            if scored[i]:
+                sim = corr_spearman_sparse(test_filtered, label_ranks[label])
+                scores[:, i] = np.percentile(sim, self.quantile, axis=1)
 
         # remove the labels lower than median
-        mid_value = np.median(list(res_labels.values()))
-        res_labels = {p: value for p, value in res_labels.items() if value > mid_value}
-        if not res_labels:
-            return [top_labels[0]]
-
-        # remove the label lower than fine_tune_threshold
-        max_value = max(res_labels.values())
-        res_labels = {p: value for p, value in res_labels.items() if value >= max_value - self.fine_tune_threshold}
-        if not res_labels:
-            return [top_labels[0]]
-        return list(res_labels.keys())
+        with np.errstate(invalid='ignore'):
+            mid_value = np.median(scores[:, scored], axis=1)
+            selected = scored & (scores > mid_value[:, None])
+            # remove the label lower than fine_tune_threshold
+            max_value = np.where(selected, scores, -np.inf).max(axis=1)
+            selected &= scores >= (max_value - self.fine_tune_threshold)[:, None]
+        selected[constant] = keep_first[constant]
+        return selected
 
     @staticmethod
     def test_rank():
@@ -1,5 +1,6 @@
 import numba
 import numpy as np
+from scipy.sparse import csr_matrix
 
 
 @numba.njit(cache=True, fastmath=True, nogil=True, parallel=True)
@@ -59,3 +60,84 @@ def apply_along_axis(arr: np.ndarray):
     for i in numba.prange(res.shape[1]):
         res[:, i] = rankdata1d(arr[:, i])
     return res
+
+
+def rank_sparse_rows(mat: csr_matrix):
+    """
+    Rank the values of each row of a sparse matrix by the average method without densifying it,
+    all the zeros of a row are one tie group.
+
+    :return: the csr_matrix of the ranks of the nonzeros and the rank of the zeros of each row.
+    """
+    mat = csr_matrix(mat, copy=True)
+    mat.eliminate_zeros()
+    mat.sum_duplicates()
+    n_rows, n_cols = mat.shape
+    counts = np.diff(mat.indptr)
+    rows = np.repeat(np.arange(n_rows), counts)
+    values = mat.data
+    n_zeros = n_cols - counts
+    n_negatives = np.bincount(rows[values < 0], minlength=n_rows)
+
+    # sort the nonzeros by row then by value, the equal values of a row make a run sharing the average rank
+    order = np.lexsort((values, rows))
+    sorted_values, sorted_rows = values[order], rows[order]
+    new_run = np.ones(values.size, dtype=bool)
+    new_run[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_rows[1:] != sorted_rows[:-1])
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, values.size))
+    run_rows = sorted_rows[run_starts]
+    run_ranks = run_starts - mat.indptr[run_rows] + (run_lengths + 1) / 2
+    run_ranks += np.where(sorted_values[run_starts] > 0, n_zeros[run_rows], 0)
+
+    ranks = np.empty(values.size, dtype=np.float64)
+    ranks[order] = np.repeat(run_ranks, run_lengths)
+    zero_ranks = n_negatives + (n_zeros + 1) / 2
+    return csr_matrix((ranks, mat.indices, mat.indptr), shape=mat.shape), zero_ranks
+
+
+def centered_sparse_ranks(mat: csr_matrix):
+    """
+    Center the ranks of each row by the mean rank `(n_cols + 1) / 2`.
+
+    The centered ranks of a row are `zero_centered` at the zeros, the dot product of them with any vector of zero mean
+    only takes the nonzeros, so they are returned as the sparse deviations from `zero_centered` at the nonzeros.
+
+    :return: the csr_matrix of the deviations, `zero_centered` and the L2 norm of the centered ranks of each row.
+    """
+    ranks, zero_ranks = rank_sparse_rows(mat)
+    n_cols = mat.shape[1]
+    mean = (n_cols + 1) / 2
+    zero_centered = zero_ranks - mean
+    counts = np.diff(ranks.indptr)
+    rows = np.repeat(np.arange(mat.shape[0]), counts)
+    sum_sq = np.bincount(rows, weights=(ranks.data - mean) ** 2, minlength=mat.shape[0])
+    norms = np.sqrt((n_cols - counts) * zero_centered ** 2 + sum_sq)
+    ranks.data -= zero_ranks[rows]
+    return ranks, zero_centered, norms
+
+
+def normalized_ranks(mat: csr_matrix) -> np.ndarray:
+    """
+    The centered ranks of each row scaled to unit norm, the rows whose values are all the same are NaN.
+
+    :return: a dense array of shape (n_cols, n_rows).
+    """
+    deviations, zero_centered, norms = centered_sparse_ranks(mat)
+    dense = deviations.toarray()
+    dense += zero_centered[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dense /= norms[:, None]
+    return dense.T
+
+
+def corr_spearman_sparse(mat: csr_matrix, ref_normalized_ranks: np.ndarray) -> np.ndarray:
+    """
+    Spearman correlation between each row of a sparse matrix and each column of the reference ranks
+    returned by `normalized_ranks`.
+
+    :return: shape (n_rows, n_ref).
+    """
+    deviations, _, norms = centered_sparse_ranks(mat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.asarray(deviations @ ref_normalized_ranks) / norms[:, None]
@@ -15,19 +15,25 @@ import pandas as pd
 import numpy as np
 import statistics
 import scipy.stats as stats
-from tqdm import tqdm
+from scipy.sparse import csc_matrix, issparse
+from typing import Optional, Union
 
 
-def spatial_pattern_score(exp_df: pd.DataFrame):
+def spatial_pattern_score(exp_df: Union[pd.DataFrame, np.ndarray, csc_matrix], gene_names: Optional[np.ndarray] = None):
     """
     calculate the spatial pattern score.
-    :param exp_df: dataframe of spatial express matrix which columns is genes, and rows is cells.
+    :param exp_df: dataframe of spatial express matrix which columns is genes, and rows is cells,
+                   or an express matrix (sparse or dense) with the gene names set by `gene_names`.
+    :param gene_names: the gene names of columns of the express matrix, ignored if `exp_df` is a dataframe.
     :return:
     """
-    tqdm.pandas(desc="calculating enrichment score")
-    report = exp_df.progress_apply(get_enrichment_score, axis=0)
-    report = report.T.reset_index()
-    report.columns = ['gene', 'E10', 'C50', 'total_count']
+    if isinstance(exp_df, pd.DataFrame):
+        gene_names = exp_df.columns.values
+        exp_matrix = exp_df.values
+    else:
+        exp_matrix = exp_df
+    e10, c50, total_count = get_enrichment_scores(exp_matrix)
+    report = pd.DataFrame({'gene': gene_names, 'E10': e10, 'C50': c50, 'total_count': total_count})
     tmp = report[report['total_count'] > 300]
     e10_cutoff = find_cutoff(list(tmp['E10']), 0.9)
     c50_cutoff = find_cutoff(list(tmp['C50']), 0.1)
@@ -43,6 +49,44 @@ def spatial_pattern_score(exp_df: pd.DataFrame):
     return report_out
 
 
+def get_enrichment_scores(exp_matrix: Union[np.ndarray, csc_matrix]):
+    """
+    calculate enrichment score E10 and C50 of all genes at once, only the positive values of each column are visited,
+    the same as `get_enrichment_score` on each column.
+    :param exp_matrix: express matrix which columns is genes, and rows is cells.
+    :return: arrays of E10 score, C50 score and total MID counts of genes, the scores of a gene without any positive
+             count are nan.
+    """
+    exp_matrix = exp_matrix.tocsc() if issparse(exp_matrix) else csc_matrix(exp_matrix)
+    n_genes = exp_matrix.shape[1]
+    values = exp_matrix.data
+    genes = np.repeat(np.arange(n_genes), np.diff(exp_matrix.indptr))
+    positive = values > 0
+    values, genes = values[positive], genes[positive]
+
+    # sort the counts of each gene descending, the genes stay in ascending order
+    order = np.lexsort((-values, genes))
+    values, genes = values[order], genes[order]
+    n_counts = np.bincount(genes, minlength=n_genes)
+    starts = np.concatenate([[0], np.cumsum(n_counts)[:-1]])
+    rank = np.arange(values.size) - starts[genes]
+    total_count = np.bincount(genes, weights=values, minlength=n_genes)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        top10 = rank < (n_counts * 0.1).astype(np.int64)[genes]
+        e10 = np.around(100 * (np.bincount(genes, weights=values * top10, minlength=n_genes) / total_count), 2)
+        # the cumulative counts within each gene
+        cdf = np.cumsum(values)
+        cdf -= np.concatenate([[0], cdf])[starts][genes]
+        # the index of the first count whose fraction is over 0.5 equals the number of counts before it
+        c50_index = np.bincount(genes, weights=(cdf / total_count[genes]) <= 0.5, minlength=n_genes)
+        c50 = np.around((c50_index / n_counts) * 100, 2)
+    c50[n_counts == 0] = np.nan
+    if np.issubdtype(exp_matrix.dtype, np.integer):
+        total_count = total_count.astype(exp_matrix.dtype)
+    return e10, c50, total_count
+
+
 def get_enrichment_score(gene_expression):
     """
     calculate enrichment score E10 and C50.
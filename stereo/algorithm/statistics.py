@@ -9,8 +9,7 @@ import pandas as pd
 import numpy as np
 from scipy import stats
 from statsmodels.stats.multitest import multipletests
-from .mannwhitneyu import mannwhitneyu
-from ..utils.hvg_utils import get_mean_var
+from .mannwhitneyu import mannwhitneyu_from_rank_sums
 
 
 def corr_pvalues(pvals, method, n_genes):
@@ -31,12 +30,8 @@ def corr_pvalues(pvals, method, n_genes):
     return pvals_adj
 
 
-def cal_log2fc(group, other_group):
-    g_mean = np.expm1(np.mean(group, axis=0)) + 1e-9
-    other_mean = np.expm1(np.mean(other_group, axis=0) )+ 1e-9
-    # log2fc = np.log2(g_mean/other_mean + 10e-5)
-    log2fc = np.log2(g_mean/other_mean)
-    return log2fc.A[0] if isinstance(log2fc, np.matrix) else log2fc
+def cal_log2fc_from_means(g_mean, other_mean):
+    return np.log2((np.expm1(g_mean) + 1e-9) / (np.expm1(other_mean) + 1e-9))
 
 
 def logreg(x, y, **kwds):
@@ -49,48 +44,47 @@ def logreg(x, y, **kwds):
     return res
 
 
-def wilcoxon(group, other_group, corr_method=None, ranks=None, tie_term=None, x_mask=None):
+def wilcoxon_from_rank_sums(rank_sums, n1, n2, log2fc, corr_method=None, tie_term=None):
     """
-    wilcoxon_test
+    wilcoxon_test from the rank sums of the group, see `mannwhitneyu.rank_sums_by_group`.
 
-    :param group:
-    :param other_group:
+    :param rank_sums: the rank sums of the group for each gene.
+    :param n1: the number of cells of the group.
+    :param n2: the number of cells of the other group.
+    :param log2fc: the log2 fold change of each gene.
     :param corr_method:
-    :param ranks:
     :param tie_term:
-    :param x_mask:
     :return:
     """
-    s, p = mannwhitneyu(group, other_group, ranks=ranks, tie_term=tie_term, x_mask=x_mask)
+    s, p = mannwhitneyu_from_rank_sums(rank_sums, n1, n2, tie_term=tie_term)
     result = pd.DataFrame({'scores': s, 'pvalues': p})
-    # result['genes'] = list(group.columns)
     n_genes = result.shape[0]
     pvals_adj = corr_pvalues(result['pvalues'], corr_method, n_genes)
     if pvals_adj is not None:
         result['pvalues_adj'] = pvals_adj
-    result['log2fc'] = cal_log2fc(group, other_group)
-    return pd.DataFrame(result)
+    result['log2fc'] = log2fc
+    return result
 
 
-def ttest(group, other_group, corr_method=None):
-    mean_group, var_group = get_mean_var(group)
-    mean_rest, var_rest = get_mean_var(other_group)
+def ttest_from_stats(mean_group, var_group, n_group, mean_rest, var_rest, n_rest, corr_method=None):
+    """
+    Welch's t-test from the means and the variances of the group and the rest, see `GroupStats`.
+    """
     with np.errstate(invalid="ignore"):
         scores, pvals = stats.ttest_ind_from_stats(
             mean1=mean_group,
             std1=np.sqrt(var_group),
-            nobs1=group.shape[0],
+            nobs1=n_group,
             mean2=mean_rest,
             std2=np.sqrt(var_rest),
-            nobs2=other_group.shape[0],
+            nobs2=n_rest,
             equal_var=False,  # Welch's
         )
     scores[np.isnan(scores)] = 0
     pvals[np.isnan(pvals)] = 1
-    n_genes = group.shape[1]
+    n_genes = scores.size
     pvals_adj = corr_pvalues(pvals, corr_method, n_genes)
     result = {'scores': scores, 'pvalues': pvals}
     if pvals_adj is not None:
         result['pvalues_adj'] = pvals_adj
-    result['log2fc'] = cal_log2fc(group, other_group)
     return pd.DataFrame(result)
@@ -0,0 +1,293 @@
+from typing import Optional
+
+import h5py
+import numpy as np
+from scipy.sparse import csr_matrix, csc_matrix, vstack, hstack
+
+
+class H5MatrixSource(object):
+    """
+    Read blocks of a matrix stored in a HDF5 file, including the sparse groups written by `h5ad.write_spmatrix`
+    and the dense datasets, a `'csc_matrix'` group is read along columns, the others are read along rows.
+    """
+
+    def __init__(self, file_path: str, key: str):
+        self.file_path = file_path
+        self.key = key
+        with h5py.File(file_path, mode='r') as f:
+            node = f[key]
+            if isinstance(node, h5py.Group):
+                self.format = 'csr' if node.attrs['encoding-type'] == 'csr_matrix' else 'csc'
+                self.shape = tuple(int(i) for i in node.attrs['shape'])
+                self.dtype = node['data'].dtype
+                self.indptr = node['indptr'][...]
+            else:
+                self.format = 'dense'
+                self.shape = tuple(node.shape)
+                self.dtype = node.dtype
+                self.indptr = None
+        self.axis = 1 if self.format == 'csc' else 0
+
+    def read(self, start: int, stop: int):
+        """
+        read the rows (or the columns if `self.axis` is 1) in `[start, stop)`.
+
+        :return: a csr_matrix or csc_matrix.
+        """
+        with h5py.File(self.file_path, mode='r') as f:
+            node = f[self.key]
+            if self.format == 'dense':
+                return csr_matrix(node[start:stop])
+            lo, hi = self.indptr[start], self.indptr[stop]
+            data = node['data'][lo:hi]
+            indices = node['indices'][lo:hi]
+        indptr = self.indptr[start:stop + 1] - lo
+        if self.format == 'csr':
+            return csr_matrix((data, indices, indptr), shape=(stop - start, self.shape[1]))
+        return csc_matrix((data, indices, indptr), shape=(self.shape[0], stop - start))
+
+
+class RowBlocksSource(object):
+    """
+    Stack the row blocks of several in-memory sparse matrices without copying them,
+    the columns of each block are mapped into the columns of the stacked matrix by `col_maps`,
+    the columns mapped to -1 are dropped.
+
+    :param matrices: the row blocks.
+    :param col_maps: for each block, the column in the stacked matrix of each of its columns.
+    :param n_cols: the number of columns of the stacked matrix.
+    """
+
+    def __init__(self, matrices: list, col_maps: list, n_cols: int):
+        self.matrices = [csr_matrix(m) for m in matrices]
+        self.col_maps = [np.asarray(col_map, dtype=np.int64) for col_map in col_maps]
+        self.row_offsets = np.concatenate([[0], np.cumsum([m.shape[0] for m in self.matrices])]).astype(np.int64)
+        self.shape = (int(self.row_offsets[-1]), int(n_cols))
+        self.dtype = np.result_type(*[m.dtype for m in self.matrices])
+        self.axis = 0
+        self.file_path = None
+
+    def read(self, start: int, stop: int):
+        blocks = []
+        first = max(np.searchsorted(self.row_offsets, start, side='right') - 1, 0)
+        for i in range(first, len(self.matrices)):
+            offset = self.row_offsets[i]
+            if offset >= stop:
+                break
+            block = self.matrices[i][max(start - offset, 0):stop - offset]
+            col_map = self.col_maps[i][block.indices]
+            keep = col_map >= 0
+            indptr = np.concatenate([[0], np.cumsum(keep)])[block.indptr]
+            blocks.append(csr_matrix((block.data[keep], col_map[keep], indptr), shape=(block.shape[0], self.shape[1])))
+        if len(blocks) == 0:
+            return csr_matrix((0, self.shape[1]), dtype=self.dtype)
+        return vstack(blocks, format='csr').astype(self.dtype, copy=False)
+
+
+class LazyExpMatrix(object):
+    """
+    An expression matrix which is never fully loaded, the data is read block by block from its source on demand.
+
+    Subsetting, `astype`, `np.log1p`, the other elementwise ufuncs mapping 0 to 0 (such as `np.expm1` and
+    `np.square`) and the row scaling of `normalize_total` are recorded and applied to each block when it is read,
+    the ufuncs not mapping 0 to 0 return a dense ndarray computed on the whole matrix, the reductions like `sum`, `getnnz`, `min` and `max` run block-wise,
+    call `tocsr` or `toarray` to pull the (subset of) matrix into memory.
+
+    :param source: an object supplying `shape`, `dtype`, `axis` and `read(start, stop)`, such as `H5MatrixSource`.
+    :param block_size: the number of rows (or columns if the source is read along columns) of each block.
+    """
+
+    def __init__(
+            self,
+            source,
+            block_size: int = 10000,
+            rows: Optional[np.ndarray] = None,
+            cols: Optional[np.ndarray] = None,
+            ops: tuple = (),
+            dtype: Optional[np.dtype] = None
+    ):
+        self.source = source
+        self.block_size = block_size
+        self._rows = rows
+        self._cols = cols
+        self._ops = ops
+        self._dtype = np.dtype(source.dtype if dtype is None else dtype)
+
+    def _new(self, rows=None, cols=None, ops=None, dtype=None):
+        return LazyExpMatrix(
+            self.source,
+            block_size=self.block_size,
+            rows=self._rows if rows is None else rows,
+            cols=self._cols if cols is None else cols,
+            ops=self._ops if ops is None else ops,
+            dtype=self._dtype if dtype is None else dtype
+        )
+
+    @property
+    def shape(self):
+        n_rows = self.source.shape[0] if self._rows is None else self._rows.size
+        n_cols = self.source.shape[1] if self._cols is None else self._cols.size
+        return n_rows, n_cols
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def nnz(self):
+        return self.getnnz()
+
+    def _read_selected(self, positions, selected):
+        """
+        read the blocks of source which cover the selected positions along the read axis, the selected positions
+        are read in runs, the gap inside a run is not larger than `block_size`.
+        """
+        if selected is None:
+            return self.source.read(positions.start, positions.stop)
+        index = selected[positions]
+        if index.size == 0:
+            return self.source.read(0, 0)
+        uniques = np.unique(index)
+        runs = np.split(uniques, np.flatnonzero(np.diff(uniques) > self.block_size) + 1)
+        pieces, offsets, read_rows = [], [], 0
+        for run in runs:
+            pieces.append(self.source.read(run[0], run[-1] + 1))
+            offsets.append(run - run[0] + read_rows)
+            read_rows += run[-1] + 1 - run[0]
+        # the position in the pieces of each selected index
+        local = np.concatenate(offsets)[np.searchsorted(uniques, index)]
+        if self.source.axis == 0:
+            block = pieces[0] if len(pieces) == 1 else vstack(pieces, format='csr')
+            return block[local]
+        block = pieces[0] if len(pieces) == 1 else hstack(pieces, format='csc')
+        return block[:, local]
+
+    def _apply_ops(self, block, row_positions):
+        for op in self._ops:
+            if op[0] == 'astype':
+                block = block.astype(op[1])
+            elif op[0] == 'log1p':
+                block = block.log1p()
+            elif op[0] == 'ufunc':
+                block = block.__class__((op[1](block.data), block.indices, block.indptr), shape=block.shape)
+            elif op[0] == 'scale_rows':
+                factors = op[1][row_positions]
+                block = block.multiply(factors.reshape(-1, 1)).tocsr() if self.source.axis == 0 \
+                    else block.multiply(factors.reshape(-1, 1)).tocsc()
+        return block.astype(self._dtype, copy=False)
+
+    def iter_blocks(self):
+        """
+        Iterate over the blocks along the axis the source is read along.
+
+        :return: an iterator of `(positions, block)`, `positions` is a slice of the rows (or the columns) of this
+                matrix covered by the block.
+        """
+        axis = self.source.axis
+        total = self.shape[axis]
+        for start in range(0, max(total, 1), self.block_size):
+            positions = slice(start, min(start + self.block_size, total))
+            if axis == 0:
+                block = self._read_selected(positions, self._rows)
+                if self._cols is not None:
+                    block = block[:, self._cols]
+                block = self._apply_ops(block.tocsr(), positions)
+            else:
+                block = self._read_selected(positions, self._cols)
+                if self._rows is not None:
+                    block = block[self._rows]
+                block = self._apply_ops(block.tocsc(), slice(None))
+            yield positions, block
+
+    def sum(self, axis=None):
+        if axis is None:
+            return sum(block.sum() for _, block in self.iter_blocks())
+        return self._reduce(lambda block: np.asarray(block.sum(axis=axis)).reshape(-1), axis).reshape(
+            (-1, 1) if axis == 1 else (1, -1))
+
+    def getnnz(self, axis=None):
+        if axis is None:
+            return sum(block.nnz for _, block in self.iter_blocks())
+        return self._reduce(lambda block: block.getnnz(axis=axis), axis)
+
+    def min(self):
+        return min(block.min() for _, block in self.iter_blocks())
+
+    def max(self):
+        return max(block.max() for _, block in self.iter_blocks())
+
+    def _reduce(self, func, axis):
+        """
+        reduce each block along `axis`, concatenating the pieces or adding them up depending on the read axis.
+        """
+        if axis == self.source.axis:
+            # each block covers all the positions of the other axis
+            result = None
+            for _, block in self.iter_blocks():
+                value = func(block)
+                result = value if result is None else result + value
+            return result
+        return np.concatenate([func(block) for _, block in self.iter_blocks()])
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        row_key, col_key = key
+        rows, cols = self._rows, self._cols
+        ops = self._ops
+        if not (isinstance(row_key, slice) and row_key == slice(None)):
+            index = np.arange(self.shape[0])[row_key]
+            rows = index if self._rows is None else self._rows[index]
+            ops = tuple((op[0], op[1][index]) if op[0] == 'scale_rows' else op for op in ops)
+        if not (isinstance(col_key, slice) and col_key == slice(None)):
+            index = np.arange(self.shape[1])[col_key]
+            cols = index if self._cols is None else self._cols[index]
+        return self._new(rows=rows, cols=cols, ops=ops)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != '__call__' or ufunc.nin != 1 or len(inputs) != 1 or kwargs:
+            return NotImplemented
+        if ufunc is np.log1p:
+            return self.log1p()
+        with np.errstate(all='ignore'):
+            zero = ufunc(np.zeros(1, dtype=self._dtype))
+        if zero[0] != 0:
+            return ufunc(self.toarray())
+        return self._new(ops=self._ops + (('ufunc', ufunc),), dtype=zero.dtype)
+
+    def __array__(self, dtype=None):
+        array = self.toarray()
+        return array if dtype is None else array.astype(dtype)
+
+    def log1p(self):
+        dtype = self._dtype if self._dtype.kind == 'f' else np.dtype(np.float32)
+        return self._new(ops=self._ops + (('log1p',),), dtype=dtype)
+
+    def astype(self, dtype, copy=True):
+        return self._new(ops=self._ops + (('astype', np.dtype(dtype)),), dtype=dtype)
+
+    def scale_rows(self, factors: np.ndarray):
+        """
+        Multiply each row by the corresponding factor.
+        """
+        factors = np.asarray(factors).reshape(-1)
+        return self._new(ops=self._ops + (('scale_rows', factors),))
+
+    def copy(self):
+        return self._new()
+
+    def tocsr(self):
+        blocks = [block for _, block in self.iter_blocks()]
+        matrix = vstack(blocks) if self.source.axis == 0 else hstack(blocks)
+        return matrix.tocsr()
+
+    def toarray(self):
+        return self.tocsr().toarray()
+
+    def __repr__(self):
+        backed = self.source.file_path if self.source.file_path is not None else type(self.source).__name__
+        return f'<{self.shape[0]}x{self.shape[1]} LazyExpMatrix of type {self.dtype} backed by {backed}>'
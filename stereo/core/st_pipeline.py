@@ -25,6 +25,7 @@ from scipy.sparse import issparse
 
 from ..log_manager import logger
 from ..utils.time_consume import TimeConsume
+from ..utils.result_cache import cache_result
 from ..algorithm.algorithm_base import AlgorithmBase
 
 tc = TimeConsume()
@@ -413,6 +414,11 @@ class StPipeline(object):
             clips residuals to -sqrt(ncells), sqrt(ncells), only used when `filter_hvgs` is `True`.
         method 
             offset, theta_ml, theta_lbfgs, alpha_lbfgs.
+        conserve_memory[bool]
+            whether to compute the pearson residuals block by block over the genes without creating the residual
+            matrix of all genes, only the residuals of the variable genes are kept, `filter_hvgs` is set to `True`.
+        corrected_umi_store[str]
+            the path of a HDF5 file to spill the corrected UMI to, only used when `conserve_memory` is `True`.
 
         Returns
         -----------
@@ -519,6 +525,7 @@ class StPipeline(object):
         return data
 
     @logit
+    @cache_result()
     def pca(self, 
             use_highly_genes: bool=False, 
             n_pcs: int=None, 
@@ -558,7 +565,9 @@ class StPipeline(object):
             raise Exception(f'{hvg_res_key} is not in the result, please check and run the highly_var_genes func.')
         data = self.subset_by_hvg(hvg_res_key, inplace=False) if use_highly_genes else self.data
         from ..algorithm.dim_reduce import pca
-        res = pca(data.exp_matrix, n_pcs, svd_solver=svd_solver)
+        from .lazy_matrix import LazyExpMatrix
+        exp_matrix = data.exp_matrix.tocsr() if isinstance(data.exp_matrix, LazyExpMatrix) else data.exp_matrix
+        res = pca(exp_matrix, n_pcs, svd_solver=svd_solver)
         self.result[res_key] = pd.DataFrame(res['x_pca'])
         key = 'pca'
         self.reset_key_record(key, res_key)
@@ -571,6 +580,7 @@ class StPipeline(object):
     #     self.result[res_key] = pd.DataFrame(res)
 
     @logit
+    @cache_result()
     def umap(
             self,
             pca_res_key: str='pca',
@@ -630,6 +640,7 @@ class StPipeline(object):
         self.reset_key_record(key, res_key)
 
     @logit
+    @cache_result()
     def neighbors(self, 
                   pca_res_key: str='pca', 
                   method: Literal['umap', 'gauss']='umap', 
@@ -638,7 +649,8 @@ class StPipeline(object):
                   n_neighbors: int=10, 
                   knn: bool=True, 
                   n_jobs: int=10,
-                  res_key: str='neighbors'):
+                  res_key: str='neighbors',
+                  nn_backend: Literal['auto', 'nndescent']='auto'):
         """
         Compute a spatial neighborhood graph over all cells.
 
@@ -675,6 +687,9 @@ class StPipeline(object):
         :param n_jobs: the number of parallel running jobs for neighbors, if set to `-1`, all CPUs will 
                     be used. Notice that extremely high value of `n_jobs` may cause segment fault.
         :param res_key: the key for storing result of neighbors, default is `neighbors`.
+        :param nn_backend: the backend to search the nearest neighbors, `auto` computes the exact distances for
+                    small data and uses `umap` otherwise, `nndescent` always searches the approximate neighbors
+                    by `pynndescent`, which is much faster on large data, only take effect when `knn` is `True`.
 
         :return: Neighbors result is stored in `self.result` where the result key is `'neighbors'`.
         """
@@ -686,7 +701,8 @@ class StPipeline(object):
             n_pcs = self.result[pca_res_key].shape[1]
         from ..algorithm.neighbors import find_neighbors
         neighbor, dists, connectivities = find_neighbors(x=self.result[pca_res_key].values, method=method, n_pcs=n_pcs,
-                                                         n_neighbors=n_neighbors, metric=metric, knn=knn, n_jobs=n_jobs)
+                                                         n_neighbors=n_neighbors, metric=metric, knn=knn, n_jobs=n_jobs,
+                                                         nn_backend=nn_backend)
         res = {'neighbor': neighbor, 'connectivities': connectivities, 'nn_dist': dists}
         self.result[res_key] = res
         key = 'neighbors'
@@ -734,6 +750,7 @@ class StPipeline(object):
         self.reset_key_record(key, res_key)
 
     @logit
+    @cache_result()
     def leiden(self,
                neighbors_res_key: str='neighbors',
                res_key: str='leiden',
@@ -782,6 +799,7 @@ class StPipeline(object):
             self.reset_key_record('gene_exp_cluster', gene_cluster_res_key)
 
     @logit
+    @cache_result()
     def louvain(self,
                 neighbors_res_key: str='neighbors',
                 res_key: str='louvain',
@@ -825,6 +843,7 @@ class StPipeline(object):
 
 
     @logit
+    @cache_result()
     def phenograph(self, 
                    phenograph_k: int=30, 
                    pca_res_key: str='pca', 
@@ -865,6 +884,7 @@ class StPipeline(object):
             self.reset_key_record('gene_exp_cluster', gene_cluster_res_key)
 
     @logit
+    @cache_result(bypass_args=('output',))
     def find_marker_genes(self,
                           cluster_res_key,
                           method: Literal['t_test', 'wilcoxon_test'] = 't_test',
@@ -878,7 +898,8 @@ class StPipeline(object):
                           output: Optional[str] = None,
                           sort_by='scores',
                           n_genes: Union[str, int] = 'all',
-                          ascending: bool = False
+                          ascending: bool = False,
+                          n_jobs: int = -1
                           ):
         """
         A tool to find maker genes. For each group, find statistical test different genes 
@@ -898,6 +919,7 @@ class StPipeline(object):
         :param n_genes: default to 0, means will auto calculate n_genes by N = 10000/K². K is cluster number, and N is
                 larger or equal to 1, less or equal to 50.
         :param ascending: default to False.
+        :param n_jobs: the number of threads to rank the genes for `wilcoxon_test`, if `-1`, all CPUs will be used.
         :return: The result of marker genes is stored in `self.result` where the key is `'marker_genes'`.
         """
         from ..tools.find_markers import FindMarker
@@ -914,7 +936,7 @@ class StPipeline(object):
         data = self.subset_by_hvg(hvg_res_key, use_raw=use_raw, inplace=False) if use_highly_genes else data
         tool = FindMarker(data=data, groups=self.result[cluster_res_key], method=method, case_groups=case_groups,
                           control_groups=control_groups, corr_method=corr_method, raw_data=self.raw, sort_by=sort_by,
-                          n_genes=n_genes, ascending=ascending)
+                          n_genes=n_genes, ascending=ascending, n_jobs=n_jobs)
         self.result[res_key] = tool.result
         self.result[res_key]['parameters'] = {}
         self.result[res_key]['parameters']['cluster_res_key'] = cluster_res_key
@@ -943,6 +965,8 @@ class StPipeline(object):
                     random_drop=True,
                     drop_dummy=None,
                     n_neighbors=8,
+                    n_jobs=1,
+                    chunk_size=1000,
                     res_key='spatial_lag'):
         """
         spatial lag model, calculate cell-bin's lag coefficient, lag z-stat and p-value.
@@ -952,6 +976,8 @@ class StPipeline(object):
         :param random_drop: randomly drop bin-cells if True.
         :param drop_dummy: drop specify clusters.
         :param n_neighbors: number of neighbors.
+        :param n_jobs: number of threads to fit the chunks of genes.
+        :param chunk_size: number of genes fitted together in one batch.
         :param res_key: the key for getting the result from the self.result.
         :return:
         """
@@ -959,7 +985,7 @@ class StPipeline(object):
         if cluster_res_key not in self.result:
             raise Exception(f'{cluster_res_key} is not in the result, please check and run the func of cluster.')
         tool = SpatialLag(data=self.data, groups=self.result[cluster_res_key], genes=genes, random_drop=random_drop,
-                          drop_dummy=drop_dummy, n_neighbors=n_neighbors)
+                          drop_dummy=drop_dummy, n_neighbors=n_neighbors, n_jobs=n_jobs, chunk_size=chunk_size)
         tool.fit()
         self.result[res_key] = tool.result
 
@@ -977,9 +1003,7 @@ class StPipeline(object):
         if use_raw and not self.raw:
             raise Exception(f'self.raw must be set if use_raw is True.')
         data = self.raw if use_raw else self.data
-        x = data.exp_matrix.toarray() if issparse(data.exp_matrix) else data.exp_matrix
-        df = pd.DataFrame(x, columns=data.gene_names, index=data.cell_names)
-        res = spatial_pattern_score(df)
+        res = spatial_pattern_score(data.exp_matrix, gene_names=data.gene_names)
         self.result[res_key] = res
 
     @logit
@@ -1041,7 +1065,8 @@ class StPipeline(object):
                         pca_res_key: str='pca', 
                         res_key: str='gaussian_smooth',
                         n_jobs: int=-1, 
-                        inplace: bool=True):
+                        inplace: bool=True,
+                        chunk_size: Optional[int]=None):
         """
         Smooth the express matrix by the algorithm of Gaussian smoothing [Shen22]_.
 
@@ -1053,8 +1078,11 @@ class StPipeline(object):
         :param res_key: the key for storing result of Gaussian smoothing, defaults to 'gaussian_smooth'.
         :param n_jobs: the number of parallel jobs to run for searching neighbors, if `-1`, all CPUs will be used.
         :param inplace: whether to inplace the previous express matrix or get a new one.
+        :param chunk_size: the number of cells to smooth at a time, set it to bound the memory on large data,
+            defaults to `None` which smooths all cells at once.
 
-        :return: An object of StereoExpData with the express matrix processed by Gaussian smooting.
+        :return: An object of StereoExpData with the express matrix processed by Gaussian smooting,
+            the express matrix is sparse if the raw express matrix is sparse.
         """
         assert pca_res_key in self.result, f'{pca_res_key} is not in the result, please check and run the pca func.'
         assert self.raw is not None, 'no raw exp_matrix to be saved, please check and run the raw_checkpoint.'
@@ -1062,7 +1090,7 @@ class StPipeline(object):
         assert smooth_threshold >= 20 and smooth_threshold <= 100, 'smooth_threshold must be between 20 and 100'
 
         pca_exp_matrix = self.result[pca_res_key].values
-        raw_exp_matrix = self.raw.exp_matrix.toarray() if issparse(self.raw.exp_matrix) else self.raw.exp_matrix
+        raw_exp_matrix = self.raw.exp_matrix
 
         if pca_exp_matrix.shape[0] != raw_exp_matrix.shape[0]:
             raise Exception(
@@ -1071,7 +1099,7 @@ class StPipeline(object):
         # logger.info(f"raw exp matrix size: {raw_exp_matrix.shape}")
         from ..algorithm.gaussian_smooth import gaussian_smooth
         result = gaussian_smooth(pca_exp_matrix, raw_exp_matrix, self.data.position, n_neighbors=n_neighbors,
-                                 smooth_threshold=smooth_threshold, n_jobs=n_jobs)
+                                 smooth_threshold=smooth_threshold, n_jobs=n_jobs, chunk_size=chunk_size)
         # logger.info(f"smoothed exp matrix size: {result.shape}")
         if inplace:
             self.data.exp_matrix = result
@@ -1127,7 +1155,7 @@ class StPipeline(object):
             _description_
         """
         from ..tools.LR_interaction import LrInteraction
-        interaction = LrInteraction(self,
+        interaction = LrInteraction(self.data,
                                     verbose=verbose,
                                     bin_scale=bin_scale,
                                     distance=distance,
@@ -1296,6 +1324,63 @@ class StPipeline(object):
     #     self.result[res_key] = res
 
 
+class _ResultLoader(object):
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __repr__(self):
+        return '<not loaded>'
+
+
+class LazyResult(dict):
+    """
+    A result dict whose items can be set as loaders, the loader of an item is called on the first access of the item
+    and the item is replaced by what the loader returns, such as the results which are read from file when used.
+    """
+
+    def set_loader(self, key, loader):
+        """
+        set the item of the key as a loader.
+
+        :param key: the key of the item.
+        :param loader: a callable without parameters which returns the item.
+        """
+        super().__setitem__(key, _ResultLoader(loader))
+
+    def is_loaded(self, key):
+        return not isinstance(super().__getitem__(key), _ResultLoader)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if isinstance(value, _ResultLoader):
+            value = value.func()
+            super().__setitem__(key, value)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            super().pop(key)
+            return value
+        return super().pop(key, *args)
+
+    def copy(self):
+        result = LazyResult()
+        dict.update(result, self)
+        return result
+
+
 class AnnBasedResult(dict):
     CLUSTER_NAMES = {'leiden', 'louvain', 'phenograph', 'annotation'}
     CONNECTIVITY_NAMES = {'neighbors'}
@@ -2,7 +2,7 @@
 # coding: utf-8
 
 try:
-    from .pyramid import merge_pyramid, create_pyramid
+    from .pyramid import merge_pyramid, create_pyramid, PyramidReader
     from .segmentation.segment import cell_seg
 
     from . import tissue_cut
@@ -11,10 +11,15 @@ change log:
     2021/06/11  create file.
 """
 import time
+import zlib
+from functools import lru_cache
+from typing import Optional
+
 import h5py
 import numpy as np
 import tifffile as tifi
 from PIL import Image
+from joblib import Parallel, delayed
 
 
 def _write_attrs(gp, d):
@@ -23,13 +28,47 @@ def _write_attrs(gp, d):
         gp.attrs[k] = v
 
 
-def split_image(im, img_size, h5_path, bin_size):
-    """ Split image into patches with img_size and save to h5 file. """
+def _tile_bounds(x, y, img_size, width, height):
+    """ The row and column slices of the patch `x/y`. """
+    x_end = min(((x + 1) * img_size), width)
+    y_end = min(((y + 1) * img_size), height)
+    return slice(y * img_size, y_end), slice(x * img_size, x_end)
+
+
+def _encode_tile(im, rows, cols, compression):
+    """ Copy a patch out of the image and deflate it, zlib releases the GIL so that patches are encoded in parallel. """
+    small_im = np.ascontiguousarray(im[rows, cols])
+    if small_im.size == 0 or compression is None:
+        return small_im.shape, small_im
+    return small_im.shape, zlib.compress(small_im.tobytes(), compression)
+
+
+def _read_tile(dataset):
+    """ Read a patch, inflate the single gzip chunk of the patch without holding the GIL if it is possible. """
+    if dataset.size > 0 and dataset.chunks == dataset.shape and dataset.compression == 'gzip' \
+            and not dataset.shuffle and not dataset.fletcher32 and dataset.scaleoffset is None:
+        filter_mask, chunk = dataset.id.read_direct_chunk((0,) * dataset.ndim)
+        if filter_mask == 0:
+            return np.frombuffer(zlib.decompress(chunk), dtype=dataset.dtype).reshape(dataset.shape)
+    return dataset[()]
+
+
+def split_image(im, img_size, h5_path, bin_size, n_jobs=-1, compression: Optional[int] = 1):
+    """
+    Split image into patches with img_size and save to h5 file.
+
+    The patches are encoded in a thread pool of `n_jobs` threads and each patch is stored as a single gzip chunk
+    of level `compression`, set `compression` to None to store the patches uncompressed.
+    """
     t0 = time.time()
     # get number of patches
     height, width = im.shape
     num_x = int(width / img_size) + 1
     num_y = int(height / img_size) + 1
+    tiles = [(x, y) for x in range(0, num_x) for y in range(0, num_y)]
+    encoded = Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(_encode_tile)(im, *_tile_bounds(x, y, img_size, width, height), compression) for x, y in tiles
+    )
 
     with h5py.File(h5_path, 'a') as out:
         group = out.require_group(f'bin_{bin_size}')
@@ -42,22 +81,17 @@ def split_image(im, img_size, h5_path, bin_size):
         _write_attrs(group, attrs)
 
         # write dataset
-        for x in range(0, num_x):
-            for y in range(0, num_y):
-                # deal with last row/column images
-                x_end = min(((x + 1) * img_size), width)
-                y_end = min(((y + 1) * img_size), height)
-                small_im = im[y * img_size:y_end, x * img_size:x_end]
-
-                data_name = f'{x}/{y}'
-                try:
-                    # normal dataset creation
-                    group.create_dataset(data_name, data=small_im)
-                except Exception as e:
-                    # if dataset already exists, replace it with new data
-                    print(e)
-                    del group[data_name]
-                    group.create_dataset(data_name, data=small_im)
+        for (x, y), (shape, data) in zip(tiles, encoded):
+            data_name = f'{x}/{y}'
+            # if dataset already exists, replace it with new data
+            if data_name in group:
+                del group[data_name]
+            if isinstance(data, np.ndarray):
+                group.create_dataset(data_name, data=data)
+            else:
+                dataset = group.create_dataset(data_name, shape=shape, dtype=im.dtype, chunks=shape,
+                                               compression='gzip', compression_opts=compression)
+                dataset.id.write_direct_chunk((0,) * len(shape), data)
     t1 = time.time()
     print(f"bin_{bin_size} split: {t1 - t0:.2f} seconds")
 
@@ -65,7 +99,8 @@ def split_image(im, img_size, h5_path, bin_size):
 def merge_pyramid(
         h5_path: str, 
         bin_size: int, 
-        out_path: str):
+        out_path: str,
+        n_jobs: int = -1):
     """
     Merge image patches back to large image.
 
@@ -77,34 +112,36 @@ def merge_pyramid(
         bin size.
     out_path
         the path to output file.
+    n_jobs
+        the number of threads to decode the patches.
 
     Returns
     -----------------
     Large image.
     """
     t0 = time.time()
-    h5 = h5py.File(h5_path, 'r')
-    # get attributes
-    img_size = h5['metaInfo'].attrs['imgSize']
-    group = h5[f'bin_{bin_size}']
-    width = group.attrs['sizex']
-    height = group.attrs['sizey']
-    # initialize image
-    im = np.zeros((height, width), dtype=group['0/0'][()].dtype)
-
-    # recontruct image
-    for i in range(group.attrs['XimageNumber']):
-        for j in range(group.attrs['YimageNumber']):
-            small_im = group[f'{i}/{j}'][()]
-            x_end = min(((i + 1) * img_size), width)
-            y_end = min(((j + 1) * img_size), height)
-            im[j * img_size:y_end, i * img_size:x_end] = small_im
-    h5.close()
+    with h5py.File(h5_path, 'r') as h5:
+        # get attributes
+        img_size = h5['metaInfo'].attrs['imgSize']
+        group = h5[f'bin_{bin_size}']
+        width = group.attrs['sizex']
+        height = group.attrs['sizey']
+        # initialize image
+        im = np.zeros((height, width), dtype=group['0/0'].dtype)
+
+        # recontruct image
+        def fill(i, j):
+            rows, cols = _tile_bounds(i, j, img_size, width, height)
+            im[rows, cols] = _read_tile(group[f'{i}/{j}'])
+
+        Parallel(n_jobs=n_jobs, backend='threading')(
+            delayed(fill)(i, j)
+            for i in range(group.attrs['XimageNumber']) for j in range(group.attrs['YimageNumber'])
+        )
     t1 = time.time()
     print(f"Merge image: {t1 - t0:.2f} seconds.")
     tifi.imsave(out_path + '.tiff', im)
-    image = Image.open(out_path + '.tiff')
-    image.mode = 'I'
+    image = Image.fromarray(im.astype(np.int32), mode='I')
     image.point(lambda i: i * (1. / 256)).convert('L').save(out_path + '.jpeg')
     return im
 
@@ -115,7 +152,9 @@ def create_pyramid(
         img_size: int, 
         x_start: int, 
         y_start: int, 
-        mag):
+        mag,
+        n_jobs: int = -1,
+        compression: Optional[int] = 1):
     """
     Create image pyramid and save to `.h5`.
 
@@ -134,6 +173,10 @@ def create_pyramid(
         start value of y.
     mag
         mag
+    n_jobs
+        the number of threads to encode the patches.
+    compression
+        the gzip level of patches, None means no compression.
     
     Returns
     -----------
@@ -158,10 +201,61 @@ def create_pyramid(
                 'sizey': height}
         _write_attrs(meta_group, info)
 
-    # write image pyramid of bin size
-    for bin_size in mag:
-        im_downsample = img[::bin_size, ::bin_size]
-        split_image(im_downsample, img_size, h5_path, bin_size)
+    # write image pyramid of bin size, each level is downsampled from the largest finer level it is a multiple of,
+    # the same as `img[::bin_size, ::bin_size]`
+    levels = {1: img}
+    for bin_size in sorted(set(mag)):
+        base = max(b for b in levels if bin_size % b == 0)
+        step = bin_size // base
+        im_downsample = levels[base] if step == 1 else np.ascontiguousarray(levels[base][::step, ::step])
+        levels[bin_size] = im_downsample
+        split_image(im_downsample, img_size, h5_path, bin_size, n_jobs=n_jobs, compression=compression)
 
     t2 = time.time()
     print(f"Save h5: {t2 - t1:.2f} seconds.")
+
+
+class PyramidReader(object):
+    """
+    Read patches and regions of the image pyramid created by `create_pyramid`, for viewers.
+
+    The decoded patches are kept in a LRU cache of `cache_size` patches.
+    """
+
+    def __init__(self, h5_path: str, cache_size: int = 256):
+        self.h5_path = h5_path
+        self.levels = dict()
+        with h5py.File(h5_path, 'r') as h5:
+            self.img_size = int(h5['metaInfo'].attrs['imgSize'])
+            for name in h5:
+                if name.startswith('bin_'):
+                    attrs = h5[name].attrs
+                    self.levels[int(name[4:])] = {k: int(attrs[k]) for k in
+                                                  ('sizex', 'sizey', 'XimageNumber', 'YimageNumber')}
+        self.read_tile = lru_cache(maxsize=cache_size)(self._read_tile)
+
+    def _read_tile(self, bin_size: int, x: int, y: int):
+        with h5py.File(self.h5_path, 'r') as h5:
+            tile = _read_tile(h5[f'bin_{bin_size}'][f'{x}/{y}'])
+        tile.flags.writeable = False
+        return tile
+
+    def read_region(self, bin_size: int, x0: int, y0: int, x1: int, y1: int):
+        """
+        Read the region `[y0, y1) x [x0, x1)` of the level `bin_size` in the coordinates of that level.
+        """
+        level = self.levels[bin_size]
+        x0, y0 = max(int(x0), 0), max(int(y0), 0)
+        x1, y1 = min(int(x1), level['sizex']), min(int(y1), level['sizey'])
+        region = None
+        for x in range(x0 // self.img_size, max(x1 - 1, x0) // self.img_size + 1):
+            for y in range(y0 // self.img_size, max(y1 - 1, y0) // self.img_size + 1):
+                tile = self.read_tile(bin_size, x, y)
+                if region is None:
+                    region = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=tile.dtype)
+                tx0, ty0 = x * self.img_size, y * self.img_size
+                sx0, sx1 = max(x0, tx0), min(x1, tx0 + tile.shape[1])
+                sy0, sy1 = max(y0, ty0), min(y1, ty0 + tile.shape[0])
+                if sx1 > sx0 and sy1 > sy0:
+                    region[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = tile[sy0 - ty0:sy1 - ty0, sx0 - tx0:sx1 - tx0]
+        return region
@@ -8,3 +8,4 @@
 """
 from .reader import read_gef, read_gem, read_ann_h5ad, read_stereo_h5ad, anndata_to_stereo, stereo_to_anndata, read_gef_info, read_seurat_h5ad
 from .writer import write, write_h5ad, write_mid_gef, update_gef
+from .gef import build_gef_tile_index
@@ -1,9 +1,13 @@
 # coding: utf-8
 import gc
+import os
+import tempfile
+from contextlib import nullcontext
+from functools import lru_cache
 
 import h5py
 import pandas as pd
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, csc_matrix
 
 import numpy as np
 from ..core.cell import Cell
@@ -124,3 +128,244 @@ class GEF(object):
         data.offset_x = self.offset_x
         data.offset_y = self.offset_y
         return data
+
+
+class GefExpSource(object):
+    """
+    Read the expression of a bin GEF file gene by gene, as the source of `stereo.core.lazy_matrix.LazyExpMatrix`.
+
+    The expression dataset is stored gene-major, so the blocks are read along columns,
+    the cells are the unique bins sorted by their ids which are packed by `x << 32 | y`.
+    """
+
+    def __init__(self, file_path: str, bin_size: int = 100, chunk_size: int = 10000000):
+        self.file_path = file_path
+        self.bin_tag = 'bin{}'.format(bin_size)
+        self.axis = 1
+        with h5py.File(file_path, mode='r') as h5f:
+            if self.bin_tag not in h5f['geneExp'].keys():
+                raise Exception('The bin size {} info is not in the GEF file'.format(bin_size))
+            h5exp = h5f['geneExp'][self.bin_tag]['expression']
+            h5gene = h5f['geneExp'][self.bin_tag]['gene']
+            gene_field = [name for name in ('gene', 'geneName', 'geneID') if name in h5gene.dtype.names][0]
+            self.genes = np.char.decode(h5gene[gene_field][...].astype(bytes), 'utf-8')
+            self.indptr = np.concatenate([[0], np.cumsum(h5gene['count'][...].astype(np.int64))])
+            self.dtype = h5exp.dtype['count']
+            cells = np.array([], dtype=np.uint64)
+            for start in range(0, h5exp.shape[0], chunk_size):
+                exp = h5exp[start:start + chunk_size]
+                cells = np.union1d(cells, np.unique(self._cell_id(exp)))
+        self.cells = cells
+        self.shape = (self.cells.size, self.genes.size)
+
+    @staticmethod
+    def _cell_id(exp):
+        return np.bitwise_or(np.left_shift(exp['x'].astype('uint64'), 32), exp['y'].astype('uint64'))
+
+    def read(self, start: int, stop: int):
+        """
+        read the genes in `[start, stop)`.
+
+        :return: a csc_matrix.
+        """
+        lo, hi = self.indptr[start], self.indptr[stop]
+        with h5py.File(self.file_path, mode='r') as h5f:
+            exp = h5f['geneExp'][self.bin_tag]['expression'][lo:hi]
+        rows = np.searchsorted(self.cells, self._cell_id(exp))
+        return csc_matrix((exp['count'], rows, self.indptr[start:stop + 1] - lo), shape=(self.shape[0], stop - start))
+
+
+TILE_INDEX_GROUP = 'tileIndex'
+
+
+def _tile_index_path(file_path: str):
+    return '{}.tile_index.h5'.format(file_path)
+
+
+def _find_tile_index(file_path: str):
+    index_path = _tile_index_path(file_path)
+    return index_path if os.path.exists(index_path) else file_path
+
+
+def build_gef_tile_index(file_path: str, bin_size: int = 1, tile_size: int = 500, chunk_size: int = 10000000,
+                         index_path: str = None):
+    """
+    Build a spatial tile index of a bin GEF file and store it into the group `tileIndex/bin{bin_size}` of `index_path`.
+
+    The expression of the bin size is copied in the order of tiles along with the gene index of each record,
+    the table `tile` maps `(tile_x, tile_y)` to the offset and count of the records of the tile,
+    so that a region is read tile by tile instead of scanning the whole file.
+
+    :param file_path: the path of the GEF file, which is opened read-only unless `index_path` is itself.
+    :param bin_size: the bin size of the expression to be indexed.
+    :param tile_size: the width and height of a tile, in the coordinates of the expression of the bin size.
+    :param chunk_size: the number of records to process at a time.
+    :param index_path: the path of the file to store the index, default to the sidecar file
+                       `{file_path}.tile_index.h5`, set it to `file_path` to store the index into the GEF file.
+    """
+    bin_tag = 'bin{}'.format(bin_size)
+    index_path = _tile_index_path(file_path) if index_path is None else index_path
+    in_place = os.path.abspath(index_path) == os.path.abspath(file_path)
+    with h5py.File(file_path, mode='r+' if in_place else 'r') as h5f, \
+            (nullcontext(h5f) if in_place else h5py.File(index_path, mode='a')) as index_f:
+        if bin_tag not in h5f['geneExp'].keys():
+            raise Exception('The bin size {} info is not in the GEF file'.format(bin_size))
+        h5exp = h5f['geneExp'][bin_tag]['expression']
+        indptr = np.concatenate([[0], np.cumsum(h5f['geneExp'][bin_tag]['gene']['count'].astype(np.int64))])
+        total = h5exp.shape[0]
+        min_x, min_y, max_x, max_y = [
+            int(np.ravel(h5exp.attrs[key])[0]) for key in ('minX', 'minY', 'maxX', 'maxY')
+        ]
+        n_tile_y = (max_y - min_y) // tile_size + 1
+        n_tiles = ((max_x - min_x) // tile_size + 1) * n_tile_y
+        exp_type = np.dtype([('x', h5exp.dtype['x']), ('y', h5exp.dtype['y']), ('count', h5exp.dtype['count']),
+                             ('geneIndex', np.uint32)])
+
+        def _tile_keys(exp):
+            tile_x = (exp['x'].astype(np.int64) - min_x) // tile_size
+            tile_y = (exp['y'].astype(np.int64) - min_y) // tile_size
+            return tile_x * n_tile_y + tile_y
+
+        def _sorted_records(start):
+            exp = h5exp[start:start + chunk_size]
+            tile_pos = np.searchsorted(tile_keys, _tile_keys(exp))
+            order = np.argsort(tile_pos, kind='stable')
+            records = np.empty(exp.shape[0], dtype=exp_type)
+            records['x'], records['y'], records['count'] = exp['x'], exp['y'], exp['count']
+            records['geneIndex'] = np.searchsorted(indptr, np.arange(start, start + exp.shape[0]), side='right') - 1
+            return records[order], tile_pos[order]
+
+        # the first pass counts the records of each tile
+        tile_counts = np.zeros(n_tiles, dtype=np.int64)
+        for start in range(0, total, chunk_size):
+            tile_counts += np.bincount(_tile_keys(h5exp.fields(['x', 'y'])[start:start + chunk_size]),
+                                       minlength=n_tiles)
+        tile_keys = np.flatnonzero(tile_counts)
+        tile_counts = tile_counts[tile_keys]
+        tile_offsets = np.concatenate([[0], np.cumsum(tile_counts)[:-1]]).astype(np.int64)
+
+        if TILE_INDEX_GROUP in index_f and bin_tag in index_f[TILE_INDEX_GROUP]:
+            del index_f[TILE_INDEX_GROUP][bin_tag]
+        group = index_f.require_group(TILE_INDEX_GROUP).create_group(bin_tag)
+        exp_chunk = min(max(total, 1), 65536)
+        tile_exp = group.create_dataset('expression', shape=(total,), dtype=exp_type, chunks=(exp_chunk,),
+                                        compression='gzip')
+        if total <= chunk_size:
+            if total > 0:
+                tile_exp[:] = _sorted_records(0)[0]
+        else:
+            # the second pass scatters the records of each chunk to the ranges of their tiles in an uncompressed
+            # temporary file, where a write is a plain seek instead of recompressing the chunks it touches,
+            # then the records are compressed range by range in the order of tiles
+            fd, spill_path = tempfile.mkstemp(suffix='.h5', dir=os.path.dirname(os.path.abspath(index_path)))
+            os.close(fd)
+            try:
+                with h5py.File(spill_path, mode='w') as spill_f:
+                    spill = spill_f.create_dataset('expression', shape=(total,), dtype=exp_type)
+                    cursor = tile_offsets.copy()
+                    for start in range(0, total, chunk_size):
+                        records, tile_pos = _sorted_records(start)
+                        bounds = np.flatnonzero(np.diff(tile_pos)) + 1
+                        for piece_start, piece_end in zip(np.r_[0, bounds], np.r_[bounds, tile_pos.size]):
+                            pos = tile_pos[piece_start]
+                            spill[cursor[pos]:cursor[pos] + piece_end - piece_start] = records[piece_start:piece_end]
+                            cursor[pos] += piece_end - piece_start
+                    copy_size = max(chunk_size // exp_chunk, 1) * exp_chunk
+                    for start in range(0, total, copy_size):
+                        tile_exp[start:start + copy_size] = spill[start:start + copy_size]
+            finally:
+                os.remove(spill_path)
+
+        tile_type = np.dtype([('tile_x', np.uint32), ('tile_y', np.uint32), ('offset', np.uint64),
+                              ('count', np.uint64)])
+        tiles = np.empty(tile_keys.size, dtype=tile_type)
+        tiles['tile_x'], tiles['tile_y'] = tile_keys // n_tile_y, tile_keys % n_tile_y
+        tiles['offset'], tiles['count'] = tile_offsets, tile_counts
+        group.create_dataset('tile', data=tiles)
+        group.attrs['tileSize'] = tile_size
+        group.attrs['minX'] = min_x
+        group.attrs['minY'] = min_y
+    _load_gef_tile_reader.cache_clear()
+
+
+class GefTileReader(object):
+    """
+    Random access into a bin GEF file by region through the tile index built by `build_gef_tile_index`,
+    the decoded tiles are kept in a LRU cache, so that the time of a query is proportional to the size of the region.
+
+    The index is read from `index_path`, default to the sidecar file of the GEF file if it exists,
+    otherwise the GEF file itself.
+    """
+
+    def __init__(self, file_path: str, bin_size: int = 1, cache_size: int = 256, index_path: str = None):
+        if index_path is None:
+            index_path = _find_tile_index(file_path)
+        self.file_path = file_path
+        self.index_path = index_path
+        self.bin_tag = 'bin{}'.format(bin_size)
+        with h5py.File(index_path, mode='r') as index_f:
+            if TILE_INDEX_GROUP not in index_f or self.bin_tag not in index_f[TILE_INDEX_GROUP]:
+                raise Exception('The tile index of bin size {} is not in {}, '
+                                'please run build_gef_tile_index first'.format(bin_size, index_path))
+            group = index_f[TILE_INDEX_GROUP][self.bin_tag]
+            tiles = group['tile'][...]
+            self.tile_size = int(group.attrs['tileSize'])
+            self.min_x = int(group.attrs['minX'])
+            self.min_y = int(group.attrs['minY'])
+        with h5py.File(file_path, mode='r') as h5f:
+            h5gene = h5f['geneExp'][self.bin_tag]['gene']
+            gene_field = [name for name in ('gene', 'geneName', 'geneID') if name in h5gene.dtype.names][0]
+            self.genes = np.char.decode(h5gene[gene_field][...].astype(bytes), 'utf-8')
+        self.tile_x = tiles['tile_x'].astype(np.int64)
+        self.tile_y = tiles['tile_y'].astype(np.int64)
+        self.tile_offset = tiles['offset'].astype(np.int64)
+        self.tile_count = tiles['count'].astype(np.int64)
+        self._load_tile = lru_cache(maxsize=cache_size)(self._read_tile)
+
+    def _read_tile(self, tile_pos: int):
+        offset, count = self.tile_offset[tile_pos], self.tile_count[tile_pos]
+        with h5py.File(self.index_path, mode='r') as index_f:
+            return index_f[TILE_INDEX_GROUP][self.bin_tag]['expression'][offset:offset + count]
+
+    def query(self, region: list, gene_list: list = None):
+        """
+        Get the expression in the region, like [minX, maxX, minY, maxY].
+
+        :return: the packed ids of the cells, the gene names and the expression matrix of cells by genes.
+        """
+        tile_min_x, tile_max_x = [(v - self.min_x) // self.tile_size for v in region[:2]]
+        tile_min_y, tile_max_y = [(v - self.min_y) // self.tile_size for v in region[2:]]
+        tile_pos = np.flatnonzero(
+            (self.tile_x >= tile_min_x) & (self.tile_x <= tile_max_x) &
+            (self.tile_y >= tile_min_y) & (self.tile_y <= tile_max_y)
+        )
+        if tile_pos.size > 0:
+            exp = np.concatenate([self._load_tile(pos) for pos in tile_pos])
+        else:
+            with h5py.File(self.index_path, mode='r') as index_f:
+                exp = index_f[TILE_INDEX_GROUP][self.bin_tag]['expression'][0:0]
+        flag = (exp['x'] >= region[0]) & (exp['x'] <= region[1]) & (exp['y'] >= region[2]) & (exp['y'] <= region[3])
+        if gene_list:
+            flag &= np.isin(exp['geneIndex'], np.flatnonzero(np.isin(self.genes, gene_list)))
+        exp = exp[flag]
+        cell_ids = np.bitwise_or(np.left_shift(exp['x'].astype('uint64'), 32), exp['y'].astype('uint64'))
+        cells, cell_ind = np.unique(cell_ids, return_inverse=True)
+        gene_index, gene_ind = np.unique(exp['geneIndex'], return_inverse=True)
+        exp_matrix = csr_matrix((exp['count'], (cell_ind, gene_ind)), shape=(cells.size, gene_index.size),
+                                dtype=np.uint32)
+        return cells, self.genes[gene_index], exp_matrix
+
+
+@lru_cache(maxsize=8)
+def _load_gef_tile_reader(file_path: str, bin_size: int, index_path: str, mtime: tuple):
+    return GefTileReader(file_path, bin_size, index_path=index_path)
+
+
+def _gef_tile_reader(file_path: str, bin_size: int):
+    """
+    Get the tile reader of the GEF file, which is cached until the GEF file or its tile index is modified.
+    """
+    file_path = os.path.abspath(file_path)
+    index_path = _find_tile_index(file_path)
+    mtime = tuple((os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in {file_path, index_path})
+    return _load_gef_tile_reader(file_path, bin_size, index_path, mtime)
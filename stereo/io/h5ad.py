@@ -11,10 +11,16 @@ change log:
     2021/06/18  create file.
     2022/02/09  write and read neighbors
 """
+import os
+import zlib
+from itertools import product
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import h5py
 import numpy as np
 import pandas as pd
-from typing import Union
+from typing import Optional, Union
 from types import MappingProxyType
 from pandas.api.types import is_categorical_dtype
 from scipy import sparse
@@ -35,8 +41,8 @@ def write(v, f, k, *args, **kwargs):
 
 
 @write.register(np.ndarray)
-def _(v, f, k):
-    write_array(f, k, v)
+def _(v, f, k, dataset_kwargs=MappingProxyType({})):
+    write_array(f, k, v, dataset_kwargs=dataset_kwargs)
 
 
 @write.register(list)
@@ -50,8 +56,8 @@ def _(v, f, k, save_as_matrix=False):
 
 
 @write.register(sparse.spmatrix)
-def _(v, f, k, sp_format):
-    write_spmatrix(f, k, v, sp_format)
+def _(v, f, k, sp_format, dataset_kwargs=MappingProxyType({})):
+    write_spmatrix(f, k, v, sp_format, dataset_kwargs=dataset_kwargs)
 
 
 @write.register(Gene)
@@ -65,8 +71,121 @@ def _(v, f, k):
 
 
 @write.register(Neighbors)
-def _(v, f, k):
-    write_neighbors(f, k, v)
+def _(v, f, k, dataset_kwargs=MappingProxyType({})):
+    write_neighbors(f, k, v, dataset_kwargs=dataset_kwargs)
+
+
+FILTER_KWARGS = ('chunks', 'compression', 'compression_opts', 'shuffle')
+
+
+def get_dataset_kwargs(
+        chunks: Optional[Union[int, tuple]] = None,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
+        shuffle: bool = False,
+        encoder: Optional['ChunkEncoder'] = None
+):
+    """
+    Get the `dataset_kwargs` of the writing functions.
+
+    :param chunks: the chunk shape of the datasets, an int is the length of chunks along the first axis,
+                the chunks span the other axes entirely, a tuple of different rank from a dataset is taken as
+                its first element for the dataset.
+    :param compression: the compression filter, `'gzip'` or `'lzf'`, `None` means no compression.
+    :param compression_level: the level of `'gzip'`, from 0 to 9.
+    :param shuffle: whether to apply the shuffle filter before compression, it helps compressing integers and floats.
+    :param encoder: a `ChunkEncoder` to compress the chunks of `'gzip'` datasets in threads.
+    """
+    dataset_kwargs = {}
+    if chunks is not None:
+        dataset_kwargs['chunks'] = chunks
+    if compression is not None:
+        dataset_kwargs['compression'] = compression
+        if compression_level is not None:
+            dataset_kwargs['compression_opts'] = compression_level
+    if shuffle:
+        dataset_kwargs['shuffle'] = True
+    if encoder is not None:
+        dataset_kwargs['encoder'] = encoder
+    return dataset_kwargs
+
+
+def _encode_chunk(value, offset, chunks, level, shuffle):
+    """ Deflate a chunk the same way as the shuffle and deflate filters of HDF5, zlib releases the GIL. """
+    block = value[tuple(slice(o, o + c) for o, c in zip(offset, chunks))]
+    if block.shape != chunks:
+        # the edge chunks are stored in full size
+        full_block = np.zeros(chunks, dtype=value.dtype)
+        full_block[tuple(slice(0, n) for n in block.shape)] = block
+        block = full_block
+    block = np.ascontiguousarray(block)
+    if shuffle and block.dtype.itemsize > 1:
+        block = np.ascontiguousarray(block.reshape(-1).view(np.uint8).reshape(-1, block.dtype.itemsize).T)
+    return zlib.compress(block, level)
+
+
+class ChunkEncoder(object):
+    """
+    Compress the chunks of datasets in a thread pool, while the calling thread writes the compressed chunks
+    into the file as soon as they are ready, only the `'gzip'` datasets are encoded by it.
+
+    :param n_jobs: the number of threads, `-1` means using all CPUs.
+    """
+
+    def __init__(self, n_jobs: int = -1):
+        self.n_jobs = os.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+        self._executor = ThreadPoolExecutor(max_workers=self.n_jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def write(self, f, key, value, chunks, level, shuffle, dataset_kwargs):
+        level = 4 if level is None else level
+        dataset = f.create_dataset(key, shape=value.shape, dtype=value.dtype, chunks=chunks, compression='gzip',
+                                   compression_opts=level, shuffle=shuffle, **dataset_kwargs)
+        offsets = product(*[range(0, n, c) for n, c in zip(value.shape, chunks)])
+        # a bounded window of chunks in flight keeps the memory of compressed chunks small
+        pending = deque()
+        for offset in offsets:
+            pending.append((offset, self._executor.submit(_encode_chunk, value, offset, chunks, level, shuffle)))
+            if len(pending) >= self.n_jobs * 4:
+                offset, future = pending.popleft()
+                dataset.id.write_direct_chunk(offset, future.result())
+        while pending:
+            offset, future = pending.popleft()
+            dataset.id.write_direct_chunk(offset, future.result())
+        return dataset
+
+
+def _create_dataset(f, key, value, dataset_kwargs=MappingProxyType({})):
+    """
+    Create a dataset of the array, the chunk and filter options of `dataset_kwargs` only apply to
+    the non-empty numeric arrays.
+    """
+    dataset_kwargs = dict(dataset_kwargs)
+    encoder = dataset_kwargs.pop('encoder', None)
+    filter_kwargs = {k: dataset_kwargs.pop(k) for k in FILTER_KWARGS if k in dataset_kwargs}
+    if value.ndim == 0 or value.size == 0 or value.dtype.kind not in {'i', 'u', 'f'}:
+        return f.create_dataset(key, data=value, **dataset_kwargs)
+    chunks = filter_kwargs.get('chunks', None)
+    if isinstance(chunks, tuple) and len(chunks) != value.ndim:
+        # the chunk shape for the datasets of other ranks is taken as the length along the first axis
+        chunks = chunks[0]
+    if isinstance(chunks, (int, np.integer)) and not isinstance(chunks, bool):
+        chunks = (int(chunks),) + tuple(value.shape[1:])
+    if isinstance(chunks, tuple):
+        chunks = tuple(max(min(int(c), n), 1) for c, n in zip(chunks, value.shape))
+        filter_kwargs['chunks'] = chunks
+    if encoder is not None and filter_kwargs.get('compression', None) == 'gzip' and isinstance(chunks, tuple):
+        return encoder.write(f, key, value, chunks, filter_kwargs.get('compression_opts', None),
+                             filter_kwargs.get('shuffle', False), dataset_kwargs)
+    return f.create_dataset(key, data=value, **filter_kwargs, **dataset_kwargs)
 
 
 def write_array(f, key, value, dataset_kwargs=MappingProxyType({})):
@@ -75,7 +194,7 @@ def write_array(f, key, value, dataset_kwargs=MappingProxyType({})):
         value = value.astype(h5py.special_dtype(vlen=str))
     elif value.dtype.names is not None:
         value = _to_hdf5_vlen_strings(value)
-    f.create_dataset(key, data=value, **dataset_kwargs)
+    _create_dataset(f, key, value, dataset_kwargs)
 
 
 def write_list(f, key, value, dataset_kwargs=MappingProxyType({})):
@@ -93,9 +212,9 @@ def write_spmatrix(f, k, v, fmt: str, dataset_kwargs=MappingProxyType({})):
     # Allow resizing
     if 'maxshape' not in dataset_kwargs:
         dataset_kwargs = dict(maxshape=(None,), **dataset_kwargs)
-    g.create_dataset('data', data=v.data, **dataset_kwargs)
-    g.create_dataset('indices', data=v.indices, **dataset_kwargs)
-    g.create_dataset('indptr', data=v.indptr, **dataset_kwargs)
+    _create_dataset(g, 'data', v.data, dataset_kwargs)
+    _create_dataset(g, 'indices', v.indices, dataset_kwargs)
+    _create_dataset(g, 'indptr', v.indptr, dataset_kwargs)
 
 
 def write_genes(f, k, v, dataset_kwargs=MappingProxyType({})):
@@ -121,6 +240,7 @@ def write_cells(f, k, v, dataset_kwargs=MappingProxyType({})):
 
 
 def write_spmatrix_as_dense(f, key, value, dataset_kwargs=MappingProxyType({})):
+    dataset_kwargs = {k: v for k, v in dataset_kwargs.items() if k != 'encoder'}
     dset = f.create_dataset(key, shape=value.shape, dtype=value.dtype, **dataset_kwargs)
     compressed_axis = int(isinstance(value, sparse.csc_matrix))
     for idx in idx_chunks_along_axis(value.shape, compressed_axis, 1000):
@@ -162,7 +282,7 @@ def write_series(group, key, series, dataset_kwargs=MappingProxyType({})):
             key,
             data=series.values,
             dtype=h5py.special_dtype(vlen=str),
-            **dataset_kwargs,
+            **{k: v for k, v in dataset_kwargs.items() if k != 'encoder' and k not in FILTER_KWARGS},
         )
     elif is_categorical_dtype(series):
         # This should work for categorical Index and Series
@@ -16,7 +16,7 @@ change log:
     2022/02/09  read raw data and result
 """
 from copy import deepcopy
-from typing import Optional
+from typing import Optional, Union, List
 
 import h5py
 import numpy as np
@@ -24,7 +24,6 @@ import pandas as pd
 from anndata import AnnData
 from typing_extensions import Literal
 from scipy.sparse import csr_matrix
-from shapely.geometry import Point, MultiPoint
 
 from stereo.io import h5ad
 from stereo.core.cell import Cell
@@ -40,7 +39,9 @@ def read_gem(
     sep: str='\t', 
     bin_type: str="bins", 
     bin_size: int=100, 
-    is_sparse: bool=True):
+    is_sparse: bool=True,
+    chunk_size: Optional[int]=None,
+    n_jobs: int=-1):
     """
     Read the Stereo-seq GEM file, and generate the StereoExpData object.
 
@@ -56,12 +57,23 @@ def read_gem(
         the size of bin to merge, when `bin_type` is set to `'bins'`.
     is_sparse
         the expression matrix is sparse matrix, if `True`, otherwise `np.ndarray`.
+    chunk_size
+        the number of lines to read at a time, if set, the file (gzip included) is read in streaming mode
+        and the peak memory is bounded by the chunk size plus the output matrix, only available
+        when `bin_type` is set to `'bins'`, default to `None` which reads the whole file at once.
+    n_jobs
+        the number of threads to parse the cell borders when `bin_type` is set to `'cell_bins'`,
+        `-1` means using all cores.
 
     Returns
     -------------
     An object of StereoExpData.
     """
     data = StereoExpData(file_path=file_path, bin_type=bin_type, bin_size=bin_size)
+    if chunk_size is not None:
+        if data.bin_type == 'bins':
+            return _read_gem_bins_by_chunks(data, sep, bin_size, is_sparse, chunk_size)
+        logger.warning('chunk_size only takes effect when bin_type is bins, reading the whole file at once.')
     df = pd.read_csv(str(data.file), sep=sep, comment='#', header=0)
     if 'MIDCounts' in df.columns:
         df.rename(columns={'MIDCounts': 'UMICount'}, inplace=True)
@@ -73,7 +85,7 @@ def read_gem(
     gdf = None
     if data.bin_type == 'cell_bins':
         df.rename(columns={'label': 'cell_id'}, inplace=True)
-        gdf = parse_cell_bin_coor(df)
+        gdf = parse_cell_bin_coor(df, n_jobs=n_jobs)
     else:
         df = parse_bin_coor(df, bin_size)
     cells = df['cell_id'].unique()
@@ -106,6 +118,101 @@ def read_gem(
     return data
 
 
+_GEM_COUNT_COLUMNS = ('UMICount', 'MIDCounts', 'MIDCount')
+
+
+def _encode_by_appearance(values, index: pd.Index):
+    """
+    Map `values` to integer codes in order of first appearance, growing `index` with the unseen values.
+
+    :param values: values of the current chunk.
+    :param index: the values seen in the previous chunks.
+    :return: the codes of `values` and the updated index.
+    """
+    codes = index.get_indexer(values)
+    missing = codes == -1
+    if missing.any():
+        index = index.append(pd.Index(pd.unique(values[missing])))
+        codes[missing] = index.get_indexer(values[missing])
+    return codes, index
+
+
+def _read_gem_bins_by_chunks(data, sep, bin_size, is_sparse, chunk_size):
+    """
+    Read a GEM file chunk by chunk, the bins are keyed by packing `bin_x` and `bin_y` into one uint64,
+    and the counts of each chunk are accumulated into a COO matrix which is compressed periodically.
+    """
+    file_path = str(data.file)
+    columns = pd.read_csv(file_path, sep=sep, comment='#', header=0, nrows=0).columns
+    count_col = [c for c in _GEM_COUNT_COLUMNS if c in columns][0]
+
+    # the first pass only reads the coordinates to get the origin of the bins
+    x_min = y_min = np.iinfo(np.int64).max
+    x_max = y_max = np.iinfo(np.int64).min
+    for chunk in pd.read_csv(file_path, sep=sep, comment='#', header=0, usecols=['x', 'y'],
+                             chunksize=chunk_size):
+        chunk.dropna(inplace=True)
+        x, y = chunk['x'].values, chunk['y'].values
+        if x.size == 0:
+            continue
+        x_min, x_max = min(x_min, x.min()), max(x_max, x.max())
+        y_min, y_max = min(y_min, y.min()), max(y_max, y.max())
+
+    cell_index = pd.Index([], dtype=np.uint64)
+    gene_index = pd.Index([], dtype=object)
+    rows, cols, counts = [], [], []
+    buffered = compacted = 0
+    for chunk in pd.read_csv(file_path, sep=sep, comment='#', header=0, usecols=['geneID', 'x', 'y', count_col],
+                             chunksize=chunk_size):
+        chunk.dropna(inplace=True)
+        bin_x = merge_bin_coor(chunk['x'].values, x_min, bin_size).astype(np.uint64)
+        bin_y = merge_bin_coor(chunk['y'].values, y_min, bin_size).astype(np.uint64)
+        cell_codes, cell_index = _encode_by_appearance(np.bitwise_or(np.left_shift(bin_x, np.uint64(32)), bin_y),
+                                                       cell_index)
+        gene_codes, gene_index = _encode_by_appearance(chunk['geneID'].values, gene_index)
+        rows.append(cell_codes.astype(np.int64))
+        cols.append(gene_codes.astype(np.int64))
+        counts.append(chunk[count_col].values.astype(np.int32))
+        buffered += chunk.shape[0]
+        if buffered >= max(4 * chunk_size, compacted):
+            # sum up the duplicated (bin, gene) pairs so that the buffer never outgrows the output matrix
+            coo = csr_matrix(
+                (np.concatenate(counts), (np.concatenate(rows), np.concatenate(cols))),
+                shape=(cell_index.size, gene_index.size), dtype=np.int32
+            ).tocoo()
+            rows, cols, counts = [coo.row.astype(np.int64)], [coo.col.astype(np.int64)], [coo.data]
+            buffered, compacted = 0, coo.nnz
+
+    exp_matrix = csr_matrix(
+        (np.concatenate(counts), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(cell_index.size, gene_index.size), dtype=np.int32
+    )
+    del rows, cols, counts
+    logger.info(f'the martrix has {cell_index.size} cells, and {gene_index.size} genes.')
+
+    cell_keys = cell_index.values.astype(np.uint64)
+    bin_x = np.right_shift(cell_keys, np.uint64(32)).astype(np.int64)
+    bin_y = np.bitwise_and(cell_keys, np.uint64(0xffffffff)).astype(np.int64)
+    data.cells = Cell(cell_name=(pd.Series(bin_x).astype(str) + '_' + pd.Series(bin_y).astype(str)).values)
+    data.genes = Gene(gene_name=gene_index.values)
+    data.exp_matrix = exp_matrix if is_sparse else exp_matrix.toarray()
+    data.position = np.stack(
+        [get_bin_center(bin_x, x_min, bin_size), get_bin_center(bin_y, y_min, bin_size)], axis=1
+    )
+    data.offset_x = x_min
+    data.offset_y = y_min
+    data.attr = {
+        'minX': x_min,
+        'minY': y_min,
+        'maxX': x_max,
+        'maxY': y_max,
+        'minExp': exp_matrix.min(),
+        'maxExp': exp_matrix.max(),
+        'resolution': 0,
+    }
+    return data
+
+
 def parse_bin_coor(df, bin_size):
     """
     merge bins to a bin unit according to the bin size, also calculate the center coordinate of bin unit,
@@ -125,17 +232,46 @@ def parse_bin_coor(df, bin_size):
     return df
 
 
-def parse_cell_bin_coor(df):
-    gdf = df.groupby('cell_id').apply(lambda x: make_multipoint(x))
-    return gdf
-
+def parse_cell_bin_coor(df, n_jobs=-1, block_size=100000):
+    """
+    calculate the convex hull and its centroid of each cell, the DNBs are sorted by cell once and the hulls
+    are built in bulk by the vectorized geometry functions of shapely, block by block of cells in parallel.
 
-def make_multipoint(x):
-    p = [Point(i) for i in zip(x['x'], x['y'])]
-    mlp = MultiPoint(p).convex_hull
-    x_center = mlp.centroid.x
-    y_center = mlp.centroid.y
-    return pd.Series({'cell_point': mlp, 'x_center': x_center, 'y_center': y_center})
+    :param df: a dataframe of the cell bin file.
+    :param n_jobs: the number of threads, `-1` means using all cores.
+    :param block_size: the number of cells in each block.
+    :return: a dataframe indexed by cell id, including the columns `cell_point`, `x_center` and `y_center`.
+    """
+    import shapely
+    from joblib import Parallel, delayed
+    from multiprocessing import cpu_count
+
+    cell_codes, cells = pd.factorize(df['cell_id'], sort=True)
+    order = np.argsort(cell_codes, kind='stable')
+    cell_codes = cell_codes[order]
+    coords = df[['x', 'y']].to_numpy(dtype=np.float64)[order]
+    # the dnb offset of each cell block in the sorted coords
+    block_starts = np.arange(0, cells.size, block_size)
+    bounds = np.append(np.searchsorted(cell_codes, block_starts), cell_codes.size)
+
+    def _convex_hull(start, end, first_cell):
+        hulls = shapely.convex_hull(shapely.multipoints(coords[start:end], indices=cell_codes[start:end] - first_cell))
+        centroids = shapely.centroid(hulls)
+        return hulls, shapely.get_x(centroids), shapely.get_y(centroids)
+
+    if n_jobs < 0 or n_jobs > cpu_count():
+        n_jobs = cpu_count()
+    n_jobs = max(min(n_jobs, block_starts.size), 1)
+    # shapely releases the GIL in its vectorized functions, so threads are enough
+    result = Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(_convex_hull)(bounds[i], bounds[i + 1], block_starts[i]) for i in range(block_starts.size)
+    )
+    gdf = pd.DataFrame({
+        'cell_point': np.concatenate([r[0] for r in result]) if result else np.array([], dtype=object),
+        'x_center': np.concatenate([r[1] for r in result]) if result else np.array([]),
+        'y_center': np.concatenate([r[2] for r in result]) if result else np.array([]),
+    }, index=pd.Index(cells, name='cell_id'))
+    return gdf
 
 
 def merge_bin_coor(coor: np.ndarray, coor_min: int, bin_size: int):
@@ -155,7 +291,9 @@ def to_interval(interval_string):
 def read_stereo_h5ad(
     file_path: str, 
     use_raw: bool=True, 
-    use_result: bool=True, ):
+    use_result: bool=True,
+    lazy: Union[bool, List[Literal['exp_matrix', 'raw']]]=False,
+    result_keys: Optional[List[str]]=None):
     """
     Read the H5ad file, and generate the StereoExpData object.
 
@@ -167,6 +305,13 @@ def read_stereo_h5ad(
         whether to read data of `self.raw`.
     use_result
         whether to read `result` and `res_key`.
+    lazy
+        if `True`, the expression matrices are not loaded but backed by the datasets of the file,
+        see `stereo.core.lazy_matrix.LazyExpMatrix`, a list of `'exp_matrix'` and `'raw'` makes only the
+        listed matrices lazy.
+    result_keys
+        the `res_key` of results to load, the other results are read from the file on their first access,
+        by default all the results are loaded.
 
     Returns
     --------------------
@@ -178,12 +323,87 @@ def read_stereo_h5ad(
         logger.error('the input file is not exists, please check!')
         raise FileExistsError('the input file is not exists, please check!')
     with h5py.File(data.file, mode='r') as f:
-        data = _read_stereo_h5ad_from_group(f, data, use_raw, use_result)
+        data = _read_stereo_h5ad_from_group(f, data, use_raw, use_result, lazy, result_keys)
     return data
 
-def _read_stereo_h5ad_from_group(f, data, use_raw, use_result):
+def _read_exp_matrix(node, lazy):
+    if lazy:
+        from stereo.core.lazy_matrix import H5MatrixSource, LazyExpMatrix
+        return LazyExpMatrix(H5MatrixSource(node.file.filename, node.name))
+    if isinstance(node, h5py.Group):
+        return h5ad.read_group(node)
+    return h5ad.read_dataset(node)
+
+def _read_parameters(node):
+    parameters_df: pd.DataFrame = h5ad.read_group(node)
+    parameters = {}
+    for i, row in parameters_df.iterrows():
+        parameters[row['name']] = row['value']
+    return parameters
+
+def _read_result(f, analysis_key, res_key):
     import ast
+    if analysis_key == 'hvg':
+        hvg_df = h5ad.read_group(f[f'{res_key}@hvg'])
+        # str to interval
+        hvg_df['mean_bin'] = [to_interval(interval_string) for interval_string in hvg_df['mean_bin']]
+        return hvg_df
+    if analysis_key in ['pca', 'umap']:
+        return pd.DataFrame(h5ad.read_dataset(f[f'{res_key}@{analysis_key}']))
+    if analysis_key == 'neighbors':
+        return {
+            'neighbor': h5ad.read_group(f[f'neighbor@{res_key}@neighbors']),
+            'connectivities': h5ad.read_group(f[f'connectivities@{res_key}@neighbors']),
+            'nn_dist': h5ad.read_group(f[f'nn_dist@{res_key}@neighbors'])
+        }
+    if analysis_key == 'cluster':
+        return h5ad.read_group(f[f'{res_key}@cluster'])
+    if analysis_key == 'gene_exp_cluster':
+        return h5ad.read_group(f[f'{res_key}@gene_exp_cluster'])
+    if analysis_key == 'marker_genes':
+        clusters = h5ad.read_dataset(f[f'clusters_record@{res_key}@marker_genes'])
+        result = {}
+        for cluster in clusters:
+            cluster_key = f'{cluster}@{res_key}@marker_genes'
+            if cluster !=  'parameters':
+                result[cluster] = h5ad.read_group(f[cluster_key])
+            else:
+                result['parameters'] = _read_parameters(f[cluster_key])
+        return result
+    if analysis_key == 'cell_cell_communication':
+        result = {}
+        for key in ['means', 'significant_means', 'deconvoluted', 'pvalues']:
+            full_key = f'{res_key}@{key}@cell_cell_communication'
+            if full_key in f.keys():
+                result[key] = h5ad.read_group(f[full_key])
+        result['parameters'] = _read_parameters(f[f'{res_key}@parameters@cell_cell_communication'])
+        return result
+    if analysis_key == 'regulatory_network_inference':
+        result = {}
+        for key in ['regulons', 'auc_matrix', 'adjacencies']:
+            full_key = f'{res_key}@{key}@regulatory_network_inference'
+            if full_key in f.keys():
+                if key == 'regulons':
+                    result[key] = ast.literal_eval(h5ad.read_dataset(f[full_key]))
+                else:
+                    result[key] = h5ad.read_group(f[full_key])
+        return result
+
+RESULT_ANALYSIS_KEYS = (
+    'hvg', 'pca', 'umap', 'neighbors', 'cluster', 'gene_exp_cluster', 'marker_genes', 'cell_cell_communication',
+    'regulatory_network_inference'
+)
+
+def _load_result(file_path, group_name, analysis_key, res_key):
+    with h5py.File(file_path, mode='r') as f:
+        return _read_result(f[group_name], analysis_key, res_key)
+
+def _read_stereo_h5ad_from_group(f, data, use_raw, use_result, lazy=False, result_keys=None):
+    from functools import partial
+    from ..core.st_pipeline import LazyResult
     from ..utils.pipeline_utils import cell_cluster_to_gene_exp_cluster
+    lazy_exp_matrix = lazy is True or (isinstance(lazy, (list, tuple)) and 'exp_matrix' in lazy)
+    lazy_raw = lazy is True or (isinstance(lazy, (list, tuple)) and 'raw' in lazy)
     # read data
     for k in f.keys():
         if k == 'cells':
@@ -197,10 +417,7 @@ def _read_stereo_h5ad_from_group(f, data, use_raw, use_result):
         elif k == 'merged':
             data.merged = h5ad.read_dataset(f[k])
         elif k == 'exp_matrix':
-            if isinstance(f[k], h5py.Group):
-                data.exp_matrix = h5ad.read_group(f[k])
-            else:
-                data.exp_matrix = h5ad.read_dataset(f[k])
+            data.exp_matrix = _read_exp_matrix(f[k], lazy_exp_matrix)
         elif k == 'sn':
             sn_data = h5ad.read_group(f[k])
             if sn_data.shape[0] == 1:
@@ -214,10 +431,7 @@ def _read_stereo_h5ad_from_group(f, data, use_raw, use_result):
     # read raw
     if use_raw is True and 'exp_matrix@raw' in f.keys():
         data.tl.raw = StereoExpData()
-        if isinstance(f['exp_matrix@raw'], h5py.Group):
-            data.tl.raw.exp_matrix = h5ad.read_group(f['exp_matrix@raw'])
-        else:
-            data.tl.raw.exp_matrix = h5ad.read_dataset(f['exp_matrix@raw'])
+        data.tl.raw.exp_matrix = _read_exp_matrix(f['exp_matrix@raw'], lazy_raw)
         if 'cells@raw' in f.keys():
             data.tl.raw.cells = h5ad.read_group(f['cells@raw'])
         else:
@@ -234,89 +448,88 @@ def _read_stereo_h5ad_from_group(f, data, use_raw, use_result):
     # read key_record and result
     if use_result is True and 'key_record' in f.keys():
         h5ad.read_key_record(f['key_record'], data.tl.key_record)
-        for analysis_key in list(data.tl.key_record.keys()):
-            res_keys = data.tl.key_record[analysis_key]
-            for res_key in res_keys:
-                if analysis_key == 'hvg':
-                    hvg_df = h5ad.read_group(f[f'{res_key}@hvg'])
-                    # str to interval
-                    hvg_df['mean_bin'] = [to_interval(interval_string) for interval_string in hvg_df['mean_bin']]
-                    data.tl.result[res_key] = hvg_df
-                if analysis_key in ['pca', 'umap']:
-                    data.tl.result[res_key] = pd.DataFrame(h5ad.read_dataset(f[f'{res_key}@{analysis_key}']))
-                if analysis_key == 'neighbors':
-                    data.tl.result[res_key] = {
-                        'neighbor': h5ad.read_group(f[f'neighbor@{res_key}@neighbors']),
-                        'connectivities': h5ad.read_group(f[f'connectivities@{res_key}@neighbors']),
-                        'nn_dist': h5ad.read_group(f[f'nn_dist@{res_key}@neighbors'])
-                    }
-                if analysis_key == 'cluster':
-                    data.tl.result[res_key] = h5ad.read_group(f[f'{res_key}@cluster'])
-                    gene_cluster_res_key = f'gene_exp_{res_key}'
-                    if ('gene_exp_cluster' not in data.tl.key_record) or (
-                            gene_cluster_res_key not in data.tl.key_record['gene_exp_cluster']):
+        if result_keys is not None:
+            data.tl.result = LazyResult(data.tl.result)
+        # the `gene_exp_cluster` records added while reading the clusters are not read from the file
+        records = [(analysis_key, res_key) for analysis_key, res_keys in data.tl.key_record.items()
+                   for res_key in res_keys if analysis_key in RESULT_ANALYSIS_KEYS]
+        for analysis_key, res_key in records:
+            if result_keys is None or res_key in result_keys:
+                data.tl.result[res_key] = _read_result(f, analysis_key, res_key)
+            else:
+                data.tl.result.set_loader(res_key, partial(_load_result, f.file.filename, f.name, analysis_key, res_key))
+            if analysis_key == 'cluster':
+                gene_cluster_res_key = f'gene_exp_{res_key}'
+                if ('gene_exp_cluster' not in data.tl.key_record) or (
+                        gene_cluster_res_key not in data.tl.key_record['gene_exp_cluster']):
+                    if result_keys is None or gene_cluster_res_key in result_keys:
                         data.tl.result[gene_cluster_res_key] = cell_cluster_to_gene_exp_cluster(data.tl, res_key)
-                        data.tl.reset_key_record('gene_exp_cluster', gene_cluster_res_key)
-                if analysis_key == 'gene_exp_cluster':
-                    data.tl.result[res_key] = h5ad.read_group(f[f'{res_key}@gene_exp_cluster'])
-                if analysis_key == 'marker_genes':
-                    clusters = h5ad.read_dataset(f[f'clusters_record@{res_key}@marker_genes'])
-                    data.tl.result[res_key] = {}
-                    for cluster in clusters:
-                        cluster_key = f'{cluster}@{res_key}@marker_genes'
-                        if cluster !=  'parameters':
-                            data.tl.result[res_key][cluster] = h5ad.read_group(f[cluster_key])
-                        else:
-                            parameters_df: pd.DataFrame = h5ad.read_group(f[cluster_key])
-                            data.tl.result[res_key]['parameters'] = {}
-                            for i, row in parameters_df.iterrows():
-                                name = row['name']
-                                value = row['value']
-                                data.tl.result[res_key]['parameters'][name] = value
-                if analysis_key == 'cell_cell_communication':
-                    data.tl.result[res_key] = {}
-                    for key in ['means', 'significant_means', 'deconvoluted', 'pvalues']:
-                        full_key = f'{res_key}@{key}@cell_cell_communication'
-                        if full_key in f.keys():
-                            data.tl.result[res_key][key] = h5ad.read_group(f[full_key])
-                    parameters_df: pd.DataFrame = h5ad.read_group(f[f'{res_key}@parameters@cell_cell_communication'])
-                    data.tl.result[res_key]['parameters'] = {}
-                    for i, row in parameters_df.iterrows():
-                        name = row['name']
-                        value = row['value']
-                        data.tl.result[res_key]['parameters'][name] = value
-                if analysis_key == 'regulatory_network_inference':
-                    data.tl.result[res_key] = {}
-                    for key in ['regulons', 'auc_matrix', 'adjacencies']:
-                        full_key = f'{res_key}@{key}@regulatory_network_inference'
-                        if full_key in f.keys():
-                            if key == 'regulons':
-                                data.tl.result[res_key][key] = ast.literal_eval(h5ad.read_dataset(f[full_key]))
-                            else:
-                                data.tl.result[res_key][key] = h5ad.read_group(f[full_key])
+                    else:
+                        data.tl.result.set_loader(
+                            gene_cluster_res_key, partial(cell_cluster_to_gene_exp_cluster, data.tl, res_key)
+                        )
+                    data.tl.reset_key_record('gene_exp_cluster', gene_cluster_res_key)
     return data
 
 
 @ReadWriteUtils.check_file_exists
-def read_h5ms(file_path, use_raw=True, use_result=True):
+def read_h5ms(
+        file_path,
+        use_raw=True,
+        use_result=True,
+        lazy: Union[bool, List[Literal['exp_matrix', 'raw']]]=False,
+        result_keys: Optional[List[str]]=None,
+        slices: Optional[List[Union[int, str]]]=None):
+    """
+    Read the h5ms file, and generate the MSData object.
+
+    :param file_path: the path to input h5ms file.
+    :param use_raw: whether to read data of `self.raw` of each slice.
+    :param use_result: whether to read `result` and `res_key` of each slice.
+    :param lazy: if `True`, the expression matrices are not loaded but backed by the datasets of the file,
+                a list of `'exp_matrix'` and `'raw'` makes only the listed matrices lazy.
+    :param result_keys: the `res_key` of results to load, the other results are read from the file on their
+                first access, by default all the results are loaded.
+    :param slices: the indices or names of slices to load, `'merged'` for the merged data, the matrices and results
+                of the other slices are read from the file on their first access, by default all the slices are loaded.
+    :return: An object of MSData.
+    """
     with h5py.File(file_path, mode='r') as f:
         data_list = []
         merged_data = None
-        names = []
+        names = h5ad.read_dataset(f['names']) if 'names' in f.keys() else []
         obs = None
         var = None
         var_type = None
         relationship = None
+
+        def is_requested(idx, one_slice_key):
+            if slices is None:
+                return True
+            name = names[idx] if idx is not None and idx < len(names) else None
+            return idx in slices or one_slice_key in slices or (name is not None and name in slices)
+
         for k in f.keys():
             if k == 'slice':
-                for one_slice_key in f[k].keys():
+                # h5py iterates the keys alphabetically, such as slice_0, slice_1, slice_10, slice_2,
+                # so the slices are ordered by the index in their keys `slice_{idx}`
+                slice_keys = sorted(f[k].keys(), key=lambda key: int(key[len('slice_'):]))
+                for one_slice_key in slice_keys:
+                    idx = int(one_slice_key[len('slice_'):])
                     data = StereoExpData()
-                    data_list.append(_read_stereo_h5ad_from_group(f[k][one_slice_key], data, use_raw, use_result))
+                    if is_requested(idx, one_slice_key):
+                        data = _read_stereo_h5ad_from_group(f[k][one_slice_key], data, use_raw, use_result, lazy,
+                                                            result_keys)
+                    else:
+                        data = _read_stereo_h5ad_from_group(f[k][one_slice_key], data, use_raw, use_result, True, [])
+                    data_list.append(data)
             elif k == 'slice_merged':
                 merged_data = StereoExpData()
-                merged_data = _read_stereo_h5ad_from_group(f[k], merged_data, use_raw, use_result)
-            elif k == 'names':
-                names = h5ad.read_dataset(f[k])
+                if is_requested(None, 'merged'):
+                    merged_data = _read_stereo_h5ad_from_group(f[k], merged_data, use_raw, use_result, lazy,
+                                                               result_keys)
+                else:
+                    merged_data = _read_stereo_h5ad_from_group(f[k], merged_data, use_raw, use_result, True, [])
             elif k == 'obs':
                 obs = h5ad.read_dataframe(f[k])
             elif k == 'var':
@@ -558,7 +771,7 @@ def stereo_to_anndata(
     if data.merged and split_batches:
         from os import path
         from ..utils.data_helper import split
-        data_list = split(data)
+        data_list = split(data, view=True)
         batch = np.unique(data.cells.batch)
         adata_list = []
         if output is not None:
@@ -803,7 +1016,9 @@ def read_gef(
     bin_size: int=100, 
     is_sparse: bool=True, 
     gene_list: Optional[list] = None,
-    region: Optional[list] = None):
+    region: Optional[list] = None,
+    lazy: bool=False,
+    use_tile_index: bool=False):
     """
     Read the GEF (.h5) file, and generate the StereoExpData object.
 
@@ -821,6 +1036,14 @@ def read_gef(
         select targeted data based on the gene list.
     region
         restrict data to the region condition, like [minX, maxX, minY, maxY].
+    lazy
+        if `True`, the expression matrix is not loaded but backed by the expression dataset of the GEF file,
+        which only takes effect when `bin_type` is `'bins'` and neither `gene_list` nor `region` is set,
+        the cells are sorted by their coordinates in this mode.
+    use_tile_index
+        whether to read the `region` through the spatial tile index built by `stereo.io.build_gef_tile_index`,
+        which is found in the sidecar file `{file_path}.tile_index.h5` or else the GEF file itself,
+        the decoded tiles are cached among calls, which only takes effect when `bin_type` is `'bins'`.
 
     Returns
     ------------------------
@@ -878,7 +1101,17 @@ def read_gef(
             'resolution': gef_attr[5],
         }
 
-        if gene_list is not None or region is not None:
+        if region is not None and use_tile_index:
+            from stereo.io.gef import _gef_tile_reader
+            uniq_cell, gene_names, exp_matrix = _gef_tile_reader(file_path, bin_size).query(region, gene_list)
+            cell_num, gene_num = exp_matrix.shape
+            logger.info(f'the matrix has {cell_num} cells, and {gene_num} genes.')
+            data.position = np.stack(
+                [np.right_shift(uniq_cell, 32), np.bitwise_and(uniq_cell, 0xffffffff)], axis=1).astype('uint32')
+            data.cells = Cell(cell_name=uniq_cell)
+            data.genes = Gene(gene_name=gene_names)
+            data.exp_matrix = exp_matrix if is_sparse else exp_matrix.toarray()
+        elif gene_list is not None or region is not None:
             if gene_list is None:
                 gene_list = []
             if region is None:
@@ -895,6 +1128,16 @@ def read_gef(
             data.genes = Gene(gene_name=gene_names)
 
             data.exp_matrix = exp_matrix if is_sparse else exp_matrix.toarray()
+        elif lazy:
+            from stereo.core.lazy_matrix import LazyExpMatrix
+            from stereo.io.gef import GefExpSource
+            source = GefExpSource(file_path, bin_size)
+            logger.info(f'the matrix has {source.shape[0]} cells, and {source.shape[1]} genes.')
+            data.position = np.stack(
+                [np.right_shift(source.cells, 32), np.bitwise_and(source.cells, 0xffffffff)], axis=1).astype('uint32')
+            data.cells = Cell(cell_name=source.cells)
+            data.genes = Gene(gene_name=source.genes)
+            data.exp_matrix = LazyExpMatrix(source)
         else:
             gene_num = gef.get_gene_num()
             uniq_cells, rows, count = gef.get_exp_data()
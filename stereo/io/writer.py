@@ -13,13 +13,16 @@ change log:
 """
 from stereo.core.stereo_exp_data import StereoExpData
 from stereo.log_manager import logger
-from scipy.sparse import csr_matrix, issparse
+from scipy.sparse import csr_matrix, csc_matrix, issparse
 import h5py
 from stereo.io import h5ad
 import pickle
 import numpy as np
 import pandas as pd
 from copy import deepcopy
+from types import MappingProxyType
+from typing import Optional, Union, Dict
+from typing_extensions import Literal
 
 
 def write_h5ad(
@@ -28,7 +31,12 @@ def write_h5ad(
         use_result: bool=True, 
         key_record: dict=None, 
         output: str=None, 
-        split_batches: bool=True):
+        split_batches: bool=True,
+        chunks: Optional[Union[int, tuple]]=None,
+        compression: Optional[Literal['gzip', 'lzf']]=None,
+        compression_level: Optional[int]=None,
+        shuffle: bool=False,
+        n_jobs: int=1):
     """
     Write the StereoExpData into a H5ad file.
 
@@ -48,6 +56,19 @@ def write_h5ad(
         the path to output file.
 	split_batches
 		Whether to save each batch to a single file if it is a merged data, default to True.
+    chunks
+        the chunk shape of the expression matrices, the positions and the array results, an int is the
+        number of elements (rows for 2-D arrays) of each chunk, by default the datasets are not chunked.
+    compression
+        the compression filter, `'gzip'` or `'lzf'`, the datasets are chunked automatically if `chunks` is not set,
+        by default no compression.
+    compression_level
+        the level of `'gzip'` compression, from 0 to 9, default to 4.
+    shuffle
+        whether to apply the shuffle filter before compression.
+    n_jobs
+        the number of threads to compress the chunks of `'gzip'` datasets while writing them to the file,
+        `-1` means using all CPUs, only take effect when `chunks` is set.
     Returns
     -------------------
     None
@@ -55,7 +76,7 @@ def write_h5ad(
     if data.merged and split_batches:
         from os import path
         from ..utils.data_helper import split
-        data_list = split(data)
+        data_list = split(data, view=True)
         batch = np.unique(data.cells.batch)
         if output is not None:
             name, ext = path.splitext(output)
@@ -64,7 +85,9 @@ def write_h5ad(
                 boutput = f"{name}-{d.sn}{ext}"
             else:
                 boutput = None
-            write_h5ad(d, use_raw=use_raw, use_result=use_result, key_record=key_record, output=boutput, split_batches=False)
+            write_h5ad(d, use_raw=use_raw, use_result=use_result, key_record=key_record, output=boutput,
+                       split_batches=False, chunks=chunks, compression=compression,
+                       compression_level=compression_level, shuffle=shuffle, n_jobs=n_jobs)
         return
 
     if output is not None:
@@ -72,10 +95,17 @@ def write_h5ad(
     else:
         if data.output is None:
             logger.error("The output path must be set before writing.")
-    with h5py.File(data.output, mode='w') as f:
-        _write_one_h5ad(f, data, use_raw=use_raw, use_result=use_result, key_record=key_record)
+    encoder = h5ad.ChunkEncoder(n_jobs) if n_jobs != 1 and compression == 'gzip' else None
+    dataset_kwargs = h5ad.get_dataset_kwargs(chunks, compression, compression_level, shuffle, encoder)
+    try:
+        with h5py.File(data.output, mode='w') as f:
+            _write_one_h5ad(f, data, use_raw=use_raw, use_result=use_result, key_record=key_record,
+                            dataset_kwargs=dataset_kwargs)
+    finally:
+        if encoder is not None:
+            encoder.close()
 
-def _write_one_h5ad(f, data, use_raw=False, use_result=True, key_record=None):
+def _write_one_h5ad(f, data, use_raw=False, use_result=True, key_record=None, dataset_kwargs=MappingProxyType({})):
     if data.sn is not None:
         if isinstance(data.sn, str):
             sn_list = [['-1', data.sn]]
@@ -87,12 +117,12 @@ def _write_one_h5ad(f, data, use_raw=False, use_result=True, key_record=None):
         h5ad.write(sn_data, f, 'sn', save_as_matrix=True)
     h5ad.write(data.genes, f, 'genes')
     h5ad.write(data.cells, f, 'cells')
-    h5ad.write(data.position, f, 'position')
+    h5ad.write(data.position, f, 'position', dataset_kwargs=dataset_kwargs)
     if issparse(data.exp_matrix):
         sp_format = 'csr' if isinstance(data.exp_matrix, csr_matrix) else 'csc'
-        h5ad.write(data.exp_matrix, f, 'exp_matrix', sp_format)
+        h5ad.write(data.exp_matrix, f, 'exp_matrix', sp_format, dataset_kwargs=dataset_kwargs)
     else:
-        h5ad.write(data.exp_matrix, f, 'exp_matrix')
+        h5ad.write(data.exp_matrix, f, 'exp_matrix', dataset_kwargs=dataset_kwargs)
     h5ad.write(data.bin_type, f, 'bin_type')
     h5ad.write(data.merged, f, 'merged')
 
@@ -107,13 +137,13 @@ def _write_one_h5ad(f, data, use_raw=False, use_result=True, key_record=None):
             h5ad.write(data.tl.raw.cells, f, 'cells@raw')
         if not (same_genes | same_cells):
             # if either raw genes or raw cells are different
-            h5ad.write(data.tl.raw.position, f, 'position@raw')
+            h5ad.write(data.tl.raw.position, f, 'position@raw', dataset_kwargs=dataset_kwargs)
         # save raw exp_matrix
         if issparse(data.tl.raw.exp_matrix):
             sp_format = 'csr' if isinstance(data.tl.raw.exp_matrix, csr_matrix) else 'csc'
-            h5ad.write(data.tl.raw.exp_matrix, f, 'exp_matrix@raw', sp_format)
+            h5ad.write(data.tl.raw.exp_matrix, f, 'exp_matrix@raw', sp_format, dataset_kwargs=dataset_kwargs)
         else:
-            h5ad.write(data.tl.raw.exp_matrix, f, 'exp_matrix@raw')
+            h5ad.write(data.tl.raw.exp_matrix, f, 'exp_matrix@raw', dataset_kwargs=dataset_kwargs)
 
     if use_result is True:
         # write key_record
@@ -140,12 +170,14 @@ def _write_one_h5ad(f, data, use_raw=False, use_result=True, key_record=None):
                     hvg_df.mean_bin = [str(interval) for interval in data.tl.result[res_key].mean_bin]
                     h5ad.write(hvg_df, f, f'{res_key}@hvg')  # -> dataframe
                 if analysis_key in ['pca', 'umap']:
-                    h5ad.write(data.tl.result[res_key].values, f, f'{res_key}@{analysis_key}')  # -> array
+                    h5ad.write(data.tl.result[res_key].values, f, f'{res_key}@{analysis_key}',
+                               dataset_kwargs=dataset_kwargs)  # -> array
                 if analysis_key == 'neighbors':
                     for neighbor_key, value in data.tl.result[res_key].items():
                         if issparse(value):
                             sp_format = 'csr' if isinstance(value, csr_matrix) else 'csc'
-                            h5ad.write(value, f, f'{neighbor_key}@{res_key}@neighbors', sp_format)  # -> csr_matrix
+                            h5ad.write(value, f, f'{neighbor_key}@{res_key}@neighbors', sp_format,
+                                       dataset_kwargs=dataset_kwargs)  # -> csr_matrix
                         else:
                             h5ad.write(value, f, f'{neighbor_key}@{res_key}@neighbors')  # -> Neighbors
                 if analysis_key == 'cluster':
@@ -209,27 +241,59 @@ def _write_one_h5ad(f, data, use_raw=False, use_result=True, key_record=None):
                             h5ad.write(item, f, f'{res_key}@{key}@regulatory_network_inference', save_as_matrix=False)  # -> dataframe
 
 
-def write_h5ms(ms_data, output : str):
-    with h5py.File(output, mode='w') as f:
-        f.create_group(f'slice')
-        for idx, data in enumerate(ms_data._data_list):
-            f['slice'].create_group(f'slice_{idx}')
-            _write_one_h5ad(f['slice'][f'slice_{idx}'], data)
-        if ms_data._merged_data:
-            f.create_group(f'slice_merged')
-            _write_one_h5ad(f['slice_merged'], ms_data._merged_data)
-        h5ad.write_list(f, 'names', ms_data.names)
-        h5ad.write_dataframe(f, 'obs', ms_data.obs)
-        h5ad.write_dataframe(f, 'var', ms_data.var)
-        h5ad.write(ms_data._var_type, f, 'var_type')
-        h5ad.write(ms_data.relationship, f, 'relationship')
-        # TODO
-        # h5ad.write(ms_data.relationship_info, f, 'relationship_info')
+def write_h5ms(
+        ms_data,
+        output: str,
+        chunks: Optional[Union[int, tuple]]=None,
+        compression: Optional[Literal['gzip', 'lzf']]=None,
+        compression_level: Optional[int]=None,
+        shuffle: bool=False,
+        n_jobs: int=1):
+    """
+    Write the MSData into a h5ms file.
+
+    :param ms_data: the MSData object.
+    :param output: the path to output file.
+    :param chunks: the chunk shape of the expression matrices, the positions and the array results of each slice,
+                an int is the number of elements (rows for 2-D arrays) of each chunk.
+    :param compression: the compression filter, `'gzip'` or `'lzf'`, the datasets are chunked automatically if
+                `chunks` is not set.
+    :param compression_level: the level of `'gzip'` compression, from 0 to 9, default to 4.
+    :param shuffle: whether to apply the shuffle filter before compression.
+    :param n_jobs: the number of threads to compress the chunks of `'gzip'` datasets while writing them to the file,
+                `-1` means using all CPUs, only take effect when `chunks` is set.
+    """
+    encoder = h5ad.ChunkEncoder(n_jobs) if n_jobs != 1 and compression == 'gzip' else None
+    dataset_kwargs = h5ad.get_dataset_kwargs(chunks, compression, compression_level, shuffle, encoder)
+    try:
+        with h5py.File(output, mode='w') as f:
+            _write_h5ms(f, ms_data, dataset_kwargs)
+    finally:
+        if encoder is not None:
+            encoder.close()
+
+
+def _write_h5ms(f, ms_data, dataset_kwargs):
+    f.create_group(f'slice')
+    for idx, data in enumerate(ms_data._data_list):
+        f['slice'].create_group(f'slice_{idx}')
+        _write_one_h5ad(f['slice'][f'slice_{idx}'], data, dataset_kwargs=dataset_kwargs)
+    if ms_data._merged_data:
+        f.create_group(f'slice_merged')
+        _write_one_h5ad(f['slice_merged'], ms_data._merged_data, dataset_kwargs=dataset_kwargs)
+    h5ad.write_list(f, 'names', ms_data.names)
+    h5ad.write_dataframe(f, 'obs', ms_data.obs)
+    h5ad.write_dataframe(f, 'var', ms_data.var)
+    h5ad.write(ms_data._var_type, f, 'var_type')
+    h5ad.write(ms_data.relationship, f, 'relationship')
+    # TODO
+    # h5ad.write(ms_data.relationship_info, f, 'relationship_info')
 
 
 def write_mid_gef(
         data: StereoExpData, 
-        output: str):
+        output: str,
+        chunk_size: int = 1000000):
     """
     Write the StereoExpData object into a GEF (.h5) file. 
 
@@ -239,6 +303,8 @@ def write_mid_gef(
         the input StereoExpData object.
     output
         the path to output file.
+    chunk_size
+        the number of expressions written to the file at a time.
 
     Returns
     ---------------------
@@ -246,42 +312,52 @@ def write_mid_gef(
     """
     logger.info("The output standard gef file only contains one expression matrix with mid count."
                 "Please make sure the expression matrix of StereoExpData object is mid count without normaliztion.")
-    import numpy.lib.recfunctions as rfn
-    final_exp = []  # [(x_1,y_1,umi_1),(x_2,y_2,umi_2)]
-    final_gene = []  # [(A,offset,count)]
-    exp_np = data.exp_matrix.toarray()
-
-    for i in range(exp_np.shape[1]):
-        gene_exp = exp_np[:, i]
-        c_idx = np.nonzero(gene_exp)[0]  # idx for all cells
-        zipped = np.concatenate((data.position[c_idx], gene_exp[c_idx].reshape(c_idx.shape[0], 1)), axis=1)
-        for k in zipped:
-            final_exp.append(k)
-
-        ## count
-        g_len = len(final_gene)
-        last_offset = 0 if g_len == 0 else final_gene[g_len - 1][1]
-        last_count = 0 if g_len == 0 else final_gene[g_len - 1][2]
-        g_name = data.gene_names[i]
-        offset = last_offset + last_count
-        count = c_idx.shape[0]
-        final_gene.append((g_name, offset, count))
-    final_exp_np = rfn.unstructured_to_structured(np.array(final_exp, dtype=int),
-                                                  np.dtype([('x', np.uint32), ('y', np.uint32), ('count', np.uint16)]))
+    exptype = np.dtype([('x', np.uint32), ('y', np.uint32), ('count', np.uint16)])
     genetyp = np.dtype({'names': ['gene', 'offset', 'count'], 'formats': ['S32', np.uint32, np.uint32]})
-    final_gene_np = np.array(final_gene, dtype=genetyp)
-    h5f = h5py.File(output, "w")
-    geneExp = h5f.create_group("geneExp")
-    binsz = "bin" + str(data.bin_size)
-    bing = geneExp.create_group(binsz)
-    geneExp[binsz]["expression"] = final_exp_np  # np.arry([(10,20,2), (20,40,3)], dtype=exptype)
-    geneExp[binsz]["gene"] = final_gene_np  # np.arry([("gene1",0,21), ("gene2",21,3)], dtype=genetype)
-    if data.attr is not None:
-        for key, value in data.attr.items():
-            bing["expression"].attrs.create(key, value)
-    h5f.attrs.create("version", 2)
-    h5f.attrs.create("omics", 'Transcriptomics')
-    h5f.close()
+
+    from stereo.core.lazy_matrix import LazyExpMatrix
+    exp_matrix = data.exp_matrix
+    if isinstance(exp_matrix, LazyExpMatrix):
+        exp_matrix = exp_matrix.tocsr()
+    exp_matrix = exp_matrix.tocsc() if issparse(exp_matrix) else csc_matrix(exp_matrix)
+    if exp_matrix.nnz > 0 and np.any(exp_matrix.data == 0):
+        exp_matrix = exp_matrix.copy()
+        exp_matrix.eliminate_zeros()
+    # the cells of each gene are in the order of rows
+    exp_matrix.sort_indices()
+
+    # the expressions of each gene are contiguous in the order of genes
+    gene_count = np.diff(exp_matrix.indptr)
+    final_gene_np = np.empty(exp_matrix.shape[1], dtype=genetyp)
+    final_gene_np['gene'] = data.gene_names
+    final_gene_np['offset'] = exp_matrix.indptr[:-1]
+    final_gene_np['count'] = gene_count
+
+    position = np.asarray(data.position).astype(int)
+    nnz = exp_matrix.nnz
+    with h5py.File(output, "w") as h5f:
+        geneExp = h5f.create_group("geneExp")
+        binsz = "bin" + str(data.bin_size)
+        bing = geneExp.create_group(binsz)
+        if nnz > 0:
+            expression = bing.create_dataset("expression", shape=(nnz,), dtype=exptype,
+                                             chunks=(min(chunk_size, nnz),))
+        else:
+            expression = bing.create_dataset("expression", data=np.empty(0, dtype=exptype))
+        for start in range(0, nnz, chunk_size):
+            end = min(start + chunk_size, nnz)
+            cell_idx = exp_matrix.indices[start:end]
+            final_exp_np = np.empty(end - start, dtype=exptype)
+            final_exp_np['x'] = position[cell_idx, 0]
+            final_exp_np['y'] = position[cell_idx, 1]
+            final_exp_np['count'] = exp_matrix.data[start:end].astype(int)
+            expression[start:end] = final_exp_np
+        bing["gene"] = final_gene_np  # np.arry([("gene1",0,21), ("gene2",21,3)], dtype=genetype)
+        if data.attr is not None:
+            for key, value in data.attr.items():
+                bing["expression"].attrs.create(key, value)
+        h5f.attrs.create("version", 2)
+        h5f.attrs.create("omics", 'Transcriptomics')
 
 
 def write(data, output=None, output_type='h5ad', *args, **kwargs):
@@ -308,10 +384,36 @@ def save_pkl(obj, output):
     f.close()
 
 
+def _align_to_gef_cells(gef_cell_ids: np.ndarray, result: pd.DataFrame):
+    """
+    Find the row of each cell of the GEF in the result by the packed cell IDs, -1 for the cells not in the result.
+    """
+    bins = np.asarray(result['bins']).astype(np.uint64)
+    order = np.argsort(bins, kind='stable')
+    sorted_bins = bins[order]
+    # the last row is taken if a cell appears several times in the result
+    pos = np.searchsorted(sorted_bins, gef_cell_ids, side='right') - 1
+    found = pos >= 0
+    found[found] = sorted_bins[pos[found]] == gef_cell_ids[found]
+    return np.where(found, order[pos], -1)
+
+
+def _group_to_ids(group: pd.Series):
+    """
+    The integer groups of clusters are written as `group + 1`, the others, such as annotations, as the rank of
+    the group among the sorted groups plus 1, 0 is left for the cells without group.
+    """
+    try:
+        return group.astype(int).to_numpy() + 1
+    except (ValueError, TypeError):
+        categories = np.unique(group.astype(str))
+        return np.searchsorted(categories, group.astype(str).to_numpy()) + 1
+
+
 def update_gef(
         data: StereoExpData, 
         gef_file: str, 
-        cluster_res_key: str):
+        cluster_res_key: Union[str, Dict[str, str]]):
     """
     Add cluster result into GEF (.h5) file and update the GEF file directly.
 
@@ -322,27 +424,34 @@ def update_gef(
     gef_file
         the path of the GEF file to add cluster result to.
     cluster_res_key
-        the key to get cluster result from `data.tl.result`.
+        the key to get cluster result from `data.tl.result`, which is written to the `clusterID` of cells,
+        a dict maps several keys of results (clusters, annotations or scores) to the fields of `cellBin/cell`
+        to write them in one open of the file, such as `{'leiden': 'clusterID', 'anno': 'cellTypeID'}`.
     
     Returns
     --------------
     None
     """
-    cluster = {}
-    if cluster_res_key not in data.tl.result:
-        raise Exception(f'{cluster_res_key} is not in the result, please check and run the func of cluster.')
-    clu_result = data.tl.result[cluster_res_key]
-    for i,v in clu_result.iterrows():
-        cluster[v['bins']] = int(v['group'])+1
-
-    h5f = h5py.File(gef_file, 'r+')
-    cell_names = np.bitwise_or(np.left_shift(h5f['cellBin']['cell']['x'].astype('uint64'), 32), h5f['cellBin']['cell']['y'])
-    celltid = np.zeros(h5f['cellBin']['cell'].shape, dtype='uint16')
-    n = 0
-    for cell_name in cell_names:
-        if cell_name in cluster:
-            celltid[n] = cluster[cell_name]
-        n += 1
-
-    # h5f['cellBin']['cell']['cellTypeID'] = celltid
-    h5f['cellBin']['cell']['clusterID'] = celltid
\ No newline at end of file
+    res_fields = {cluster_res_key: 'clusterID'} if isinstance(cluster_res_key, str) else dict(cluster_res_key)
+    for res_key in res_fields:
+        if res_key not in data.tl.result:
+            raise Exception(f'{res_key} is not in the result, please check and run the func of cluster.')
+
+    with h5py.File(gef_file, 'r+') as h5f:
+        cell_dataset = h5f['cellBin']['cell']
+        cell_ids = np.bitwise_or(np.left_shift(cell_dataset['x'].astype('uint64'), 32),
+                                 cell_dataset['y'].astype('uint64'))
+        for res_key, field in res_fields.items():
+            if field not in cell_dataset.dtype.names:
+                raise Exception(f'{field} is not a field of cellBin/cell in {gef_file}.')
+            clu_result = data.tl.result[res_key]
+            field_dtype = cell_dataset.dtype[field]
+            rows = _align_to_gef_cells(cell_ids, clu_result)
+            found = rows >= 0
+            if field_dtype.kind == 'f':
+                values = np.full(cell_ids.shape, np.nan, dtype=field_dtype)
+                values[found] = clu_result['group'].to_numpy()[rows[found]]
+            else:
+                values = np.zeros(cell_ids.shape, dtype=field_dtype)
+                values[found] = _group_to_ids(clu_result['group'])[rows[found]]
+            cell_dataset[field] = values
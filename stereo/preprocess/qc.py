@@ -9,6 +9,8 @@
 from scipy.sparse import issparse
 import numpy as np
 
+from ..core.lazy_matrix import LazyExpMatrix
+
 
 def cal_qc(data):
     """
@@ -72,7 +74,8 @@ def cal_n_cells(exp_matrix):
     :param exp_matrix: the express matrix.
     :return:
     """
-    n_cells = exp_matrix.getnnz(axis=0) if issparse(exp_matrix) else np.count_nonzero(exp_matrix, axis=0)
+    n_cells = exp_matrix.getnnz(axis=0) if issparse(exp_matrix) or isinstance(exp_matrix, LazyExpMatrix) \
+        else np.count_nonzero(exp_matrix, axis=0)
     return n_cells
 
 
@@ -86,7 +89,8 @@ def cal_gene_mean_umi(data):
 
 
 def cal_n_genes_by_counts(exp_matrix):
-    n_genes_by_counts = exp_matrix.getnnz(axis=1) if issparse(exp_matrix) else np.count_nonzero(exp_matrix, axis=1)
+    n_genes_by_counts = exp_matrix.getnnz(axis=1) if issparse(exp_matrix) or isinstance(exp_matrix, LazyExpMatrix) \
+        else np.count_nonzero(exp_matrix, axis=1)
     return n_genes_by_counts
 
 
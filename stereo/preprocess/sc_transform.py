@@ -1,6 +1,7 @@
 import numpy as np
 from scipy.sparse import issparse, csr_matrix
 from stereo.algorithm.sctransform import SCTransform
+from stereo.core.lazy_matrix import LazyExpMatrix
 
 
 def sc_transform(
@@ -31,6 +32,8 @@ def sc_transform(
         **kwargs
     )
     new_exp_matrix = res[0][exp_matrix_key]
+    if isinstance(new_exp_matrix, LazyExpMatrix):
+        new_exp_matrix = new_exp_matrix.tocsr()
     if issparse(new_exp_matrix):
         data.exp_matrix = new_exp_matrix.T.tocsr()
         gene_index = np.isin(data.gene_names, res[1]['umi_genes'])
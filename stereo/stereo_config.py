@@ -31,7 +31,9 @@ class StereoConfig(object):
             log_level: str = "info",
             log_format: str = "[%(asctime)s][%(name)s][%(process)d][%(threadName)s][%(thread)d][%(module)s][%(lineno)d][%(levelname)s]: %(message)s",
             output: str = "./output",
-            data_dir: str = None
+            data_dir: str = None,
+            cache_dir: Optional[str] = None,
+            cache_max_size: int = 10 * 1024 ** 3
     ):
         self._file_format = file_format
         self._auto_show = auto_show
@@ -41,6 +43,8 @@ class StereoConfig(object):
         self._log_format = log_format
         self.out_dir = output
         self.data_dir = data_dir if data_dir else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+        self._cache_dir = cache_dir
+        self._cache_max_size = cache_max_size
 
     @property
     def colormaps(self):
@@ -190,6 +194,29 @@ class StereoConfig(object):
     def n_jobs(self, value):
         self._n_jobs = value
 
+    @property
+    def cache_dir(self) -> Optional[str]:
+        """
+        the directory to cache the results of the analysis steps, such as `pca`, `neighbors`, `umap`, clustering
+        and `find_marker_genes`, the cache is disabled if it is `None`.
+        """
+        return self._cache_dir
+
+    @cache_dir.setter
+    def cache_dir(self, value: Optional[str]):
+        self._cache_dir = value
+
+    @property
+    def cache_max_size(self) -> int:
+        """
+        the maximum size in bytes of the cached results, the least recently used results are evicted beyond it.
+        """
+        return self._cache_max_size
+
+    @cache_max_size.setter
+    def cache_max_size(self, value: int):
+        self._cache_max_size = value
+
     @staticmethod
     def set_plot_param(fontsize: int = 14, figsize: Optional[int] = None, color_map: Optional[str] = None,
                        facecolor: Optional[str] = None, transparent: bool = False, ):
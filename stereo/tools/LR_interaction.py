@@ -3,6 +3,8 @@ from ..core.tool_base import ToolBase
 from ..core.stereo_exp_data import StereoExpData
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
+from scipy.sparse import csr_matrix, issparse
 from typing import Dict, List, Optional, Tuple, Union
 
 
@@ -18,7 +20,7 @@ class LrInteraction(ToolBase):
     bin_scale : int, optional
         to scale the distance `distance = bin_scale * distance`, by default 1
     n_jobs : Optional[int], optional
-        num of workers for parallel jobs, by default None
+        num of threads for the permutation over batches of LR pairs, by default None
     min_exp : Union[int, float], optional
         the min expression of ligand or receptor gene when caculate reaction strength, by default 0
     min_spots : `int`, optional
@@ -57,6 +59,9 @@ class LrInteraction(ToolBase):
         self.quantiles = quantiles
         self.n_pairs = n_pairs
         self.lr_paris = None
+        self.chunk_size = 10000
+        self._neighbor_graphs = dict()
+        self._csc_exp_matrix = None
     
     @staticmethod    
     def is_gene_name(data, gene):
@@ -65,6 +70,55 @@ class LrInteraction(ToolBase):
         else:
             return False
     
+    def get_neighbor_graph(self, neighbors_key):
+        """the row normalized adjacency matrix of spots, multiplying it by the expression gets the mean expression
+        of the neighbors of each spot."""
+        if neighbors_key not in self._neighbor_graphs:
+            neighbors = self.result[neighbors_key]
+            lengths = np.array([len(neighbor) for neighbor in neighbors], dtype=np.int64)
+            rows = np.repeat(np.arange(len(neighbors)), lengths)
+            cols = pd.Index(self.data.cell_names).get_indexer(
+                np.concatenate(neighbors) if lengths.sum() > 0 else np.array([], dtype=str)
+            )
+            values = 1 / np.repeat(np.where(lengths > 0, lengths, 1), lengths)
+            self._neighbor_graphs[neighbors_key] = csr_matrix(
+                (values, (rows, cols)), shape=(len(neighbors), self.data.cell_names.size)
+            )
+        return self._neighbor_graphs[neighbors_key]
+
+    def _get_exp_matrix(self, genes):
+        gene_index = pd.Index(self.data.gene_names).get_indexer(genes)
+        exp_matrix = self.data.exp_matrix if self._csc_exp_matrix is None else self._csc_exp_matrix
+        if issparse(exp_matrix):
+            # a no-op for the matrix converted once in `fit`
+            return exp_matrix.tocsc()[:, gene_index].astype(np.float64)
+        return csr_matrix(exp_matrix[:, gene_index].astype(np.float64)).tocsc()
+
+    def _pair_scores(self, exp, nb_exp, l_indices, r_indices):
+        """the scores of LR pairs, keep the neighbor mean of receptor only when the ligand is also expressed on the
+        spot, and vice versa."""
+        l_exp, r_exp = exp[:, l_indices], exp[:, r_indices]
+        l_nb, r_nb = nb_exp[:, l_indices], nb_exp[:, r_indices]
+        return (l_exp * (r_nb > self.min_exp) + (l_exp > self.min_exp) * r_nb +
+                r_exp * (l_nb > self.min_exp) + (r_exp > self.min_exp) * l_nb)
+
+    def _iter_pair_scores(self, neighbors_key, lr_pairs):
+        """iterate over the scores of LR pairs chunk by chunk of spots."""
+        genes, gene_indices = np.unique(np.array([lr.split("_") for lr in lr_pairs]), return_inverse=True)
+        gene_indices = gene_indices.reshape(-1, 2)
+        exp = self._get_exp_matrix(genes)
+        nb_exp = (self.get_neighbor_graph(neighbors_key) @ exp).tocsr()
+        exp = exp.tocsr()
+        for start in range(0, exp.shape[0], self.chunk_size):
+            end = min(start + self.chunk_size, exp.shape[0])
+            yield start, end, self._pair_scores(exp[start:end].toarray(), nb_exp[start:end].toarray(),
+                                                gene_indices[:, 0], gene_indices[:, 1])
+
+    def _filter_lr_pairs(self, lr_pairs):
+        lr_pairs = np.unique(lr_pairs)
+        gene_names = set(self.data.gene_names)
+        return [item for item in lr_pairs if np.all([gene in gene_names for gene in item.split("_")])]
+
     def calculate_score(self, lr_pairs, neighbors_key, key_add, verbose):
         
         if isinstance(lr_pairs, str):
@@ -74,62 +128,15 @@ class LrInteraction(ToolBase):
             print('filtered out the lr pairs which ' 
                   'is not unique or has gene not in the `data.gene_names`')   
             
-        lr_pairs = np.unique(lr_pairs)
-        lr_pairs = [item for item in lr_pairs 
-                    if np.all([self.is_gene_name(self.data, gene) 
-                               for gene in item.split("_")])]
-        lr_genes = '_'.join(lr_pairs).split('_')
-        genes = np.unique('_'.join(lr_pairs).split('_'))
-        lr_pairs_rev = [item.split("_")[1] + "_" + item.split("_")[0]
-                        for item in lr_pairs]
-        lr_genes_rev = '_'.join(lr_pairs_rev).split('_')
-
-        df = self.data[:, genes].copy().to_df()
-        df[neighbors_key] = self.result[neighbors_key]
+        lr_pairs = self._filter_lr_pairs(lr_pairs)
         
         if verbose:
             print('calculating cci score...') 
             
-        spot_lr1 = df[lr_genes]
-        spot_lr2 = df[lr_genes_rev]
-
-        def mean_lr2(x):
-            # get lr2 expressions from the neighbour(s)
-            nbs = spot_lr2.loc[df.loc[x.name, neighbors_key], :]
-
-            if nbs.shape[0] > 0:  # if neighbour exists
-                return nbs.sum() / nbs.shape[0]
-            else:
-                return 0
-
-        # mean of lr2 expressions from neighbours of each spot
-        if self.n_jobs is not None:
-            try:
-                from pandarallel import pandarallel
-            except ImportError:
-                raise ImportError(
-                    'Please install the pandarallel, `pip3 install pandarallel')
-                
-            pandarallel.initialize(progress_bar=False, nb_workers=self.n_jobs, verbose=1)  
-            nb_lr2 = spot_lr2.parallel_apply(mean_lr2, axis=1)
-        
-        else:
-            nb_lr2 = spot_lr2.apply(mean_lr2, axis=1)
-            
-        # keep value of nb_lr2 only when lr1 is also expressed on the spots
-        spot_lr = (spot_lr1.values * (nb_lr2.values > self.min_exp) +
-                   (spot_lr1.values > self.min_exp) * nb_lr2.values)
-        
-        columns = [lr_pairs[i // 2] 
-                   for i in range(len(spot_lr2.columns))]
-        
-        # make multiindex so we can group it together
-        columns = pd.MultiIndex.from_arrays((columns, 
-                                             spot_lr2.columns))
-        scores = pd.DataFrame(spot_lr, 
+        scores = np.vstack([chunk for _, _, chunk in self._iter_pair_scores(neighbors_key, lr_pairs)])
+        scores = pd.DataFrame(scores, 
                               index=self.data.cell_names, 
-                              columns=columns)
-        scores = scores.T.reset_index().groupby(['level_0']).sum().T
+                              columns=pd.Index(lr_pairs, name='level_0'))
         scores.index.name = 'LR pairs'
         
         if self.min_spots is not None and isinstance(self.min_spots, int):
@@ -172,20 +179,14 @@ class LrInteraction(ToolBase):
     @staticmethod
     def gene_rand_pairs(genes1: np.array, genes2: np.array, n_pairs: int):
         """Generates random pairs of genes."""
-
-        rand_pairs = list()
-        for _ in range(0, n_pairs):
-            l_rand = np.random.choice(genes1, 1)[0]
-            r_rand = np.random.choice(genes2, 1)[0]
-            rand_pair = "_".join([l_rand, r_rand])
-            while rand_pair in rand_pairs or l_rand == r_rand:
-                l_rand = np.random.choice(genes1, 1)[0]
-                r_rand = np.random.choice(genes2, 1)[0]
-                rand_pair = "_".join([l_rand, r_rand])
-
-            rand_pairs.append(rand_pair)
-
-        return rand_pairs
+        genes1, genes2 = np.asarray(genes1), np.asarray(genes2)
+        l_indices, r_indices = np.meshgrid(np.arange(genes1.size), np.arange(genes2.size), indexing='ij')
+        l_indices, r_indices = l_indices.ravel(), r_indices.ravel()
+        candidates = np.flatnonzero(genes1[l_indices] != genes2[r_indices])
+        if candidates.size < n_pairs:
+            raise ValueError(f"can not generate {n_pairs} distinct pairs from {genes1.size} and {genes2.size} genes")
+        chosen = np.random.choice(candidates, n_pairs, replace=False)
+        return ["_".join(pair) for pair in zip(genes1[l_indices[chosen]], genes2[r_indices[chosen]])]
     
     def get_lr_bg(
         self,
@@ -313,9 +314,9 @@ class LrInteraction(ToolBase):
         n_pairs = self.n_pairs
         
         lr_genes = np.unique([lr_.split("_") for lr_ in lr_pairs])
+        lr_genes_set = set(lr_genes)
         genes = np.array([gene for gene in self.data.gene_names 
-                          if gene not in lr_genes])
-        candidate_expr = self.data[:, genes].to_df().values
+                          if gene not in lr_genes_set])
 
         n_genes = round(np.sqrt(n_pairs) * 2) 
         if len(genes) < n_genes:
@@ -331,7 +332,8 @@ class LrInteraction(ToolBase):
                 "get accurate backgrounds (e.g. 1000)."
             )
             return
-        lr_expr = self.data[:, lr_genes].copy().to_df()
+        lr_expr = pd.DataFrame(self._get_exp_matrix(lr_genes).toarray(), 
+                               index=self.data.cell_names, columns=lr_genes)
         lr_feats = self.get_lr_features(lr_expr)
         l_quants = lr_feats.loc[lr_pairs, 
                                 [col for col in lr_feats.columns if "L_" in col]
@@ -340,55 +342,108 @@ class LrInteraction(ToolBase):
                                 [col for col in lr_feats.columns if "R_" in col]
                                 ].values
         
-        candidate_quants = np.apply_along_axis(np.quantile, 0, candidate_expr, 
-                                               q=quantiles, interpolation="nearest"
-                                               )
+        candidate_quants = self._gene_quantiles(genes, quantiles)
         
         pvals = np.ones(lr_scores.shape, dtype=np.float32)
         # do permutation
         from tqdm import tqdm 
-        gene_bg_genes = dict()
-        pbar = tqdm(lr_pairs)
         if self.verbose: 
             print("Performing permutation...")
-            
-        for idx, lr_ in enumerate(pbar):
-            pbar.set_description(f"LR pairs {idx + 1}")
-            pbar.set_postfix(LR=lr_pairs[idx])
-            background = self.get_lr_bg(
-                neighbors_key=neighbors_key,
-                lr_=lr_,
-                l_quant=l_quants[idx, :],
-                r_quant=r_quants[idx, :],
-                genes=genes,
-                candidate_quants=candidate_quants,
-                gene_bg_genes=gene_bg_genes,
-                n_genes=n_genes,
-                n_pairs=n_pairs,
-            )
+
+        # the background genes of each L/R gene and the random pairs of each LR pair are generated in order,
+        # so the result only depends on the global random state
+        gene_bg_genes = dict()
+        rand_pairs_list = []
+        for idx, lr_ in enumerate(lr_pairs):
+            l_, r_ = lr_.split("_")
+            for gene, quant in ((l_, l_quants[idx, :]), (r_, r_quants[idx, :])):
+                if gene not in gene_bg_genes:
+                    gene_bg_genes[gene] = self.get_similar_genes(quant, n_genes, candidate_quants, genes)
+            rand_pairs_list.append(self.gene_rand_pairs(gene_bg_genes[l_], gene_bg_genes[r_], n_pairs))
+        if save_bg:
+            self.result.setdefault("lrs_to_bg", dict())
+
+        def permutation_test(idx):
+            lr_ = lr_pairs[idx]
             lr_score = lr_scores[lr_].values
             spot_indices = np.where(lr_score > 0)[0]
-            
+            background, n_positive = self._background_scores(neighbors_key, rand_pairs_list[idx], spot_indices,
+                                                             save_bg)
+            if self.min_spots is not None and isinstance(self.min_spots, int):
+                lrs_bool = n_positive > self.min_spots
+                if lrs_bool.sum() == 0:
+                    raise ValueError(f"lrs expressed on less than {self.min_spots}， try to decrease min_exp")
+                background = background.loc[:, lrs_bool]
+            bg_values = background.values
             if save_bg:
                 self.result["lrs_to_bg"][lr_] = background
-
-            n_greater = (background.values[spot_indices, :] 
-                         >= lr_score[spot_indices].reshape(-1, 1)).sum(axis=1)
-            
+                bg_values = bg_values[spot_indices, :]
+            n_greater = (bg_values >= lr_score[spot_indices].reshape(-1, 1)).sum(axis=1)
             n_greater = np.where(n_greater != 0, n_greater, 1)
-            pvals[spot_indices, idx] = n_greater / background.shape[0]
+            return spot_indices, n_greater / bg_values.shape[1]
+
+        n_jobs = 1 if self.n_jobs is None else self.n_jobs
+        pbar = tqdm(total=len(lr_pairs), desc='LR pairs')
+        for start in range(0, len(lr_pairs), max(abs(n_jobs), 1) * 4):
+            batch = range(start, min(start + max(abs(n_jobs), 1) * 4, len(lr_pairs)))
+            results = Parallel(n_jobs=n_jobs, backend='threading')(delayed(permutation_test)(idx) for idx in batch)
+            for idx, (spot_indices, pval) in zip(batch, results):
+                pvals[spot_indices, idx] = pval
+            pbar.update(len(batch))
+        pbar.close()
         
         if self.verbose:
             print('adjust p value...')        
         # adjust p value
-        from statsmodels.stats.multitest import multipletests
+        if adj_method == "fdr_bh":
+            pvals_adj = self.fdr_bh(pvals)
+        else:
+            from statsmodels.stats.multitest import multipletests
         
-        def MHT(ar, adj_method):
-            return multipletests(ar, method=adj_method)[1]
+            def MHT(ar, adj_method):
+                return multipletests(ar, method=adj_method)[1]
         
-        pvals_adj = np.apply_along_axis(MHT, 1, pvals, adj_method=adj_method)
-        log10pvals_adj = -np.log1p(pvals_adj)
+            pvals_adj = np.apply_along_axis(MHT, 1, pvals, adj_method=adj_method)
         self.result['LR_Pvals'] = pvals_adj
+
+    def _gene_quantiles(self, genes, quantiles):
+        """the quantiles of expression of each gene, calculated in batches of genes."""
+        exp = self._get_exp_matrix(genes)
+        batch_size = max(1, (1 << 25) // max(exp.shape[0], 1))
+        return np.hstack([
+            np.quantile(exp[:, start:start + batch_size].toarray(), q=quantiles, axis=0, interpolation="nearest")
+            for start in range(0, exp.shape[1], batch_size)
+        ])
+
+    def _background_scores(self, neighbors_key, rand_pairs, spot_indices, keep_all=False):
+        """the scores of the random pairs on `spot_indices` (or on all spots if `keep_all`) and the number of spots
+        where each random pair scores > 0."""
+        rand_pairs = self._filter_lr_pairs(rand_pairs)
+        n_positive = np.zeros(len(rand_pairs), dtype=np.int64)
+        scores = []
+        for start, end, chunk in self._iter_pair_scores(neighbors_key, rand_pairs):
+            n_positive += (chunk > 0).sum(axis=0)
+            if keep_all:
+                scores.append(chunk)
+            else:
+                in_chunk = spot_indices[(spot_indices >= start) & (spot_indices < end)]
+                scores.append(chunk[in_chunk - start])
+        index = self.data.cell_names if keep_all else self.data.cell_names[spot_indices]
+        return pd.DataFrame(np.vstack(scores), index=index, columns=rand_pairs), n_positive
+
+    @staticmethod
+    def fdr_bh(pvals: np.ndarray):
+        """Benjamini/Hochberg correction applied on each row, the same as `multipletests(method='fdr_bh')`."""
+        pvals = np.asarray(pvals)
+        n_tests = pvals.shape[1]
+        order = np.argsort(pvals, axis=1, kind='mergesort')
+        sorted_pvals = np.take_along_axis(pvals, order, axis=1)
+        adjusted = sorted_pvals * n_tests / np.arange(1, n_tests + 1)
+        adjusted = np.minimum.accumulate(adjusted[:, ::-1], axis=1)[:, ::-1]
+        adjusted = np.minimum(adjusted, 1)
+        pvals_adj = np.empty_like(adjusted)
+        np.put_along_axis(pvals_adj, order, adjusted, axis=1)
+        return pvals_adj
             
     def fit(
         self,
@@ -425,28 +480,36 @@ class LrInteraction(ToolBase):
 
         # get neighbors 
         import scipy.spatial as spatial
-        neighbors = []
-        point_tree = spatial.cKDTree(self.data.position)
         distance = self.bin_scale * self.distance
-
-        for idx, point in enumerate(self.data.position):
-            neighbor = point_tree.query_ball_point(point, distance)  # 这里5是指距离
-            self_neighbor = [self.data.cell_names[idx]]
-            neighbor.remove(idx)
-            other_neighbor = self.data.cell_names[neighbor]
-            
-            if distance == 0:
-                neighbors.append(self_neighbor)
-            elif distance > 0:
-                neighbors.append(other_neighbor)
-            else:
-                raise ValueError("`distance` should > 0")
+        if distance < 0:
+            raise ValueError("`distance` should > 0")
+        if distance == 0:
+            neighbors = [self.data.cell_names[[idx]] for idx in range(self.data.cell_names.size)]
+        else:
+            point_tree = spatial.cKDTree(self.data.position)
+            n_jobs = -1 if self.n_jobs is None else self.n_jobs
+            neighbor_indices = point_tree.query_ball_point(self.data.position, distance, workers=n_jobs)
+            lengths = np.array([len(neighbor) for neighbor in neighbor_indices], dtype=np.int64)
+            rows = np.repeat(np.arange(lengths.size), lengths)
+            cols = np.concatenate(neighbor_indices).astype(np.int64)
+            # exclude the spot itself
+            not_self = rows != cols
+            rows, cols = rows[not_self], cols[not_self]
+            indptr = np.searchsorted(rows, np.arange(lengths.size + 1))
+            neighbors = np.split(self.data.cell_names[cols], indptr[1:-1])
+            self._neighbor_graphs[f'neighbors_{distance}'] = csr_matrix(
+                (1 / np.diff(indptr).clip(min=1)[rows], (rows, cols)),
+                shape=(lengths.size, lengths.size)
+            )
         neighbors_key = f'neighbors_{distance}'
           
         self.result[neighbors_key] = neighbors
         
         if use_raw:
             self.data = self.data.raw
+        # the batches of pairs slice the genes from the matrix converted to CSC once
+        if issparse(self.data.exp_matrix):
+            self._csc_exp_matrix = self.data.exp_matrix.tocsc()
         
         # calulate lr scores
         self.calculate_score(lr_pairs=lr_pairs,
@@ -461,8 +524,7 @@ class LrInteraction(ToolBase):
         self._permutation(lr_scores=lr_scores,
                           lr_pairs=lr_pairs,
                           neighbors_key=neighbors_key,
-                          adj_method=adj_method, 
-                          verbose=False)
+                          adj_method=adj_method)
         
         return self.result
     
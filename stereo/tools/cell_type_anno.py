@@ -10,16 +10,18 @@ change log:
     2021/05/20 rst supplement. by: qindanhua.
     2021/07/08 adjust for restructure base class . by: qindanhua.
 """
-import pandas as pd
-import numpy as np
 import os
-from multiprocessing import Pool
-import traceback
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy.sparse import csr_matrix, issparse
+
 from ..log_manager import logger
-from ..utils.correlation import spearmanr_corr, pearson_corr
-from ..preprocess.normalize import normalize_total
+from ..algorithm.normalization import normalize_total
+from ..algorithm.single_r.utils import normalized_ranks, corr_spearman_sparse
 from ..stereo_config import stereo_conf
-from ..utils import remove_file
 from ..core.tool_base import ToolBase
 
 
@@ -36,7 +38,8 @@ class CellTypeAnno(ToolBase):
     :param n_estimators: prediction times
     :param strategy:
     :param method: calculate correlation's method
-    :param split_num:
+    :param split_num: split the cells to N parts, each part is computed in batches of at most `batch_size` cells.
+    :param batch_size: the maximum number of cells of each batch.
 
     Example
     -------
@@ -61,6 +64,7 @@ class CellTypeAnno(ToolBase):
             n_estimators: int = 20,
             strategy='1',
             split_num: int = 1,
+            batch_size: int = 1000,
     ):
         super(CellTypeAnno, self).__init__(data=data, method=method)
         self.ref_dir = ref_dir
@@ -71,7 +75,8 @@ class CellTypeAnno(ToolBase):
         self.n_estimators = n_estimators
         self.strategy = strategy
         self.split_num = split_num
-        self.output = stereo_conf.out_dir
+        self.batch_size = batch_size
+        self.all_result = None
 
     @property
     def ref_dir(self):
@@ -99,153 +104,168 @@ class CellTypeAnno(ToolBase):
         m_range = ['spearmanr', 'pearson']
         self._method_check(method, m_range)
 
-    def split_dataframe(self, df):
+    def split_batches(self, n_cells):
         """
-        split input data to N(split_num) part
+        split the cells to batches
 
-        :param df: input expression data frame
-        :return: N part of data frame
+        :param n_cells: the number of cells
+        :return: the slices of the cells of each batch
         """
-        datas = []
-        logger.info(f'input data:  {df.shape[0]} genes, {df.shape[1]} cells.')
-        if self.split_num > 1:
-            logger.info(f'split the exp matrix to {self.split_num} matrixs')
-            step_size = int(df.shape[1]/self.split_num) + 1
-            for i in range(self.split_num):
-                start = i * step_size
-                end = start + step_size if start + step_size < df.shape[1] else df.shape[1]
-                datas.append(df.iloc[:, start: end])
-        else:
-            datas.append(df)
-        return datas
-
-    @staticmethod
-    def concat_top_corr_files(files, output_dir, prefix=None):
-        """
-        concat correlation files from n-times prediction's result
-
-        :param files: all prediction results
-        :param output_dir: output directory
-        :param prefix: prefix of output files
-        :return: correlation dataframe
-        """
-        df = pd.read_csv(files[0])
-        for f in files[1:]:
-            df1 = pd.read_csv(f)
-            df = df.append(df1)
-        file_name = f'{prefix}_top_annotation.csv' if prefix else 'top_annotation.csv'
-        df.to_csv(os.path.join(output_dir, file_name), index=False)
-        return df
+        logger.info(f'input data:  {self.data.gene_names.size} genes, {n_cells} cells.')
+        step_size = int(np.ceil(n_cells / max(self.split_num, 1)))
+        step_size = max(min(step_size, self.batch_size), 1)
+        return [slice(start, min(start + step_size, n_cells)) for start in range(0, n_cells, step_size)]
 
-    def merge_subsample_result(self, input_dir, prefix, output_dir):
+    def merge_subsample_result(self, cells, cell_types, scores):
         """
-        generate result
+        generate result from n-times prediction's result, keep the cell type predicted the most times and with the
+        highest mean score of each cell
 
-        :param input_dir: input directory, output of previous step
-        :param prefix: prefix of output file
-        :param output_dir: output directory
+        :param cells: the cell of each prediction
+        :param cell_types: the predicted cell type of each prediction
+        :param scores: the correlation score of each prediction
         :return: result data frame
         """
-        files = [os.path.join(input_dir, f) for f in os.listdir(input_dir) if prefix in f]
-        df = pd.read_csv(files[0])
-        for f in files[1:]:
-            df1 = pd.read_csv(f)
-            df = df.append(df1)
-        type_cnt = df.groupby(['cell', 'cell type']).count()[['corr_score']]
-        type_cnt['type_rate'] = type_cnt / self.n_estimators
-        type_cnt.columns = ['type_cnt', 'type_rate']
-        type_cnt.reset_index(inplace=True)
-        score_mean = df.groupby(['cell', 'cell type']).mean()[['corr_score']]
-        score_mean.columns = ['score_mean']
-        score_mean.reset_index(inplace=True)
-        df = score_mean.merge(type_cnt, on=['cell', 'cell type'])
-        df.to_csv(os.path.join(output_dir, 'all_annotation.csv'), index=False)
+        pair_cells, pair_types, pair_index = group_predictions(cells, cell_types)
+        type_cnt = np.bincount(pair_index, minlength=pair_cells.size)
+        score_mean = np.bincount(pair_index, weights=scores, minlength=pair_cells.size) / type_cnt
+        df = pd.DataFrame({
+            'cell': pair_cells,
+            'cell type': pair_types,
+            'score_mean': score_mean,
+            'type_cnt': type_cnt,
+            'type_rate': type_cnt / self.n_estimators,
+        })
+        self.all_result = df
         df = df[(df.groupby('cell')['type_cnt'].transform('max') == df['type_cnt']) & (
                     df.groupby('cell')['score_mean'].transform('max') == df['score_mean'])]
-        df.to_csv(os.path.join(output_dir, 'top_annotation.csv'), index=False)
         return df
 
-    @staticmethod
-    def merge_subsample_result_filter(input_dir, prefix, output_dir):
+    def merge_subsample_result_filter(self, cells, cell_types, scores):
         """
-        filter and generate result
+        filter and generate result, only the predictions not lower than the mean score of their cell type are counted
 
-        :param input_dir: input directory, output of previous step
-        :param prefix: prefix of output file
-        :param output_dir: output directory
+        :param cells: the cell of each prediction
+        :param cell_types: the predicted cell type of each prediction
+        :param scores: the correlation score of each prediction
         :return: result data frame
         """
-        files = [os.path.join(input_dir, f) for f in os.listdir(input_dir) if prefix in f]
-        df = pd.read_csv(files[0])
-        for f in files[1:]:
-            df_1 = pd.read_csv(f)
-            df = df.append(df_1)
-        score_mean = df.groupby(['cell', 'cell type']).mean()[['corr_score']]
-        score_mean.columns = ['score_mean']
-        score_mean.reset_index(inplace=True)
-        tmp = score_mean.merge(df, on=['cell', 'cell type'])
-        tmp = tmp[tmp['score_mean'] <= tmp['corr_score']]
-        type_cnt = tmp.groupby(['cell', 'cell type']).count()[['score_mean']].reset_index()
-        type_sum = tmp.groupby(['cell']).count()[['corr_score']].reset_index()
-        score_mean = tmp.groupby(['cell', 'cell type']).mean()[['corr_score']]
-        score_mean.columns = ['score_mean']
-        score_mean.reset_index(inplace=True)
-        type_rate = type_cnt.merge(type_sum, on=['cell'])
-        type_rate['type_rate'] = type_rate['score_mean'] / type_rate['corr_score']
-        type_rate.columns = ['cell', 'cell type', 'type_cnt', 'type_cnt_sum', 'type_rate']
-        df = score_mean.merge(type_rate, on=['cell', 'cell type'])
-        df.to_csv(os.path.join(output_dir, 'all_annotation.csv'), index=False)
+        pair_cells, pair_types, pair_index = group_predictions(cells, cell_types)
+        n_pairs = pair_cells.size
+        # the same mean as `groupby`, the scores equal to the mean of their group are kept
+        kept = pd.Series(scores).groupby(pair_index).transform('mean').values <= scores
+        pair_index, scores = pair_index[kept], scores[kept]
+        type_cnt = np.bincount(pair_index, minlength=n_pairs)
+        counted = type_cnt > 0
+        score_mean = np.bincount(pair_index, weights=scores, minlength=n_pairs)[counted] / type_cnt[counted]
+        df = pd.DataFrame({
+            'cell': pair_cells[counted],
+            'cell type': pair_types[counted],
+            'score_mean': score_mean,
+            'type_cnt': type_cnt[counted],
+        })
+        df['type_cnt_sum'] = df.groupby('cell')['type_cnt'].transform('sum')
+        df['type_rate'] = df['type_cnt'] / df['type_cnt_sum']
+        df.reset_index(drop=True, inplace=True)
+        self.all_result = df
         df = df[df.groupby('cell')['type_cnt'].transform('max') == df['type_cnt']]
         df = df[df.groupby('cell')['score_mean'].transform('max') == df['score_mean']]
-        df.to_csv(os.path.join(output_dir, 'top_annotation.csv'), index=False)
         return df
 
     def fit(self):
         """
         run
         """
-        exp_matrix = self.data.exp_matrix().T
-        df = pd.DataFrame(exp_matrix, index=list(self.data.gene_names),
-                          columns=list(self.data.cell_names))
-        datas = self.split_dataframe(df) if self.split_num > 1 else [df]
-        tmp_output = os.path.join(self.output, 'tmp')
+        exp_matrix = self.data.exp_matrix
+        exp_matrix = exp_matrix.tocsr() if issparse(exp_matrix) else csr_matrix(exp_matrix)
+        cell_names = np.asarray(self.data.cell_names)
+        ref = load_reference(self.ref_dir)
+        genes = ref.genes if self.keep_zeros else ref.genes[np.isin(ref.genes, self.data.gene_names)]
+        model = ref.model(self.method, genes)
+        gene_map = gene_selector(self.data.gene_names, genes)
+        batches = self.split_batches(exp_matrix.shape[0])
+        n_estimators = self.n_estimators if self.use_rf else 1
+        # the seeds are drawn before running in threads to keep the results reproducible by `np.random.seed`
+        seeds = np.random.randint(np.iinfo(np.int32).max, size=(len(batches), n_estimators))
         logger.info('start to run annotation.')
-        if not os.path.exists(tmp_output):
-            os.makedirs(tmp_output)
+        results = Parallel(n_jobs=self.n_jobs, backend='threading')(
+            delayed(annotation_batch)(exp_matrix[batch], gene_map, model, self.method, n_estimators,
+                                      self.sample_rate if self.use_rf else None, batch_seeds)
+            for batch, batch_seeds in zip(batches, seeds)
+        )
+        # the shape of each result is (n_estimators, n_cells of the batch)
+        samples = np.concatenate([r[0] for r in results], axis=1)
+        scores = np.concatenate([r[1] for r in results], axis=1)
+        logger.info(f'start to merge top result ...')
+        cell_types = ref.cell_types[samples]
         if self.use_rf:
-            pool = Pool(self.n_jobs)
-            for i in range(self.n_estimators):
-                for j in range(len(datas)):
-                    sub_index = f'subsample_{i}_{j}'
-                    pool.apply_async(run_annotation, (datas[j], self.ref_dir, self.method, self.keep_zeros, tmp_output,
-                                                      sub_index, self.use_rf, self.sample_rate),
-                                     error_callback=subprocess_error)
-            pool.close()
-            pool.join()
-            logger.info(f'start to merge top result ...')
-            for i in range(self.n_estimators):
-                files = [os.path.join(tmp_output, f'subsample_{i}_{j}.top_{self.method}_corr.csv')
-                         for j in range(self.split_num)]
-                index = f'subsample_{i}'
-                self.concat_top_corr_files(files, tmp_output, index)
+            cells = np.tile(cell_names, n_estimators)
             if self.strategy == 1:
-                self.result.matrix = self.merge_subsample_result(tmp_output, 'top_annotation.csv', self.output)
+                self.result = self.merge_subsample_result(cells, cell_types.ravel(), scores.ravel())
             else:
-                self.result.matrix = self.merge_subsample_result_filter(tmp_output, 'top_annotation.csv', self.output)
+                self.result = self.merge_subsample_result_filter(cells, cell_types.ravel(), scores.ravel())
         else:
-            pool = Pool(self.n_jobs)
-            for i in range(len(datas)):
-                sub_index = f'sub_{i}'
-                pool.apply_async(run_annotation, (datas[i], self.ref_dir, self.method, self.keep_zeros, tmp_output,
-                                                  sub_index, self.use_rf, self.sample_rate),
-                                 error_callback=subprocess_error)
-            pool.close()
-            pool.join()
-            logger.info(f'start to merge top result ...')
-            files = [os.path.join(tmp_output, f'sub_{i}.top_{self.method}_corr.csv') for i in range(len(datas))]
-            self.result.matrix = self.concat_top_corr_files(files, self.output)
-        # clear tmp directory
-        remove_file(tmp_output)
+            self.result = pd.DataFrame({
+                'cell': cell_names,
+                'cell type': cell_types[0],
+                'corr_score': scores[0],
+                'corr_sample': ref.samples[samples[0]],
+            })
+        return self.result
+
+
+class _Reference(object):
+    """
+    The reference expression of the samples and the cell type of each sample, the correlation models of the
+    `model_cache_size` gene sets used most recently are kept.
+    """
+
+    def __init__(self, ref_db: pd.DataFrame, cell_map: pd.DataFrame, model_cache_size: int = 4):
+        self.genes = ref_db.index.values
+        self.samples = ref_db.columns.values
+        self.values = ref_db.values.astype(np.float64)
+        self.cell_types = cell_map.loc[self.samples, 'cell type'].values
+        self._cached_model = lru_cache(maxsize=model_cache_size)(self._model)
+
+    def model(self, method, genes):
+        """
+        get the dense reference model of shape (n_genes, n_samples), the product of the expression of a cell with it
+        divided by the norm of the cell returns the correlation with each sample.
+        """
+        return self._cached_model(method, tuple(genes))
+
+    def _model(self, method, genes):
+        values = self.values[pd.Index(self.genes).get_indexer(genes)]
+        if method == 'pearson':
+            centered = values - values.mean(axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                model = centered / (values.std(axis=0) * len(genes))
+        else:
+            model = normalized_ranks(csr_matrix(values.T))
+        model.flags.writeable = False
+        return model
+
+
+@lru_cache(maxsize=2)
+def _load_reference(ref_sample_path, cell_map_path, mtime):
+    ref_db = parse_ref_data(os.path.dirname(ref_sample_path))
+    cell_map = pd.read_csv(cell_map_path, index_col=0, header=0, sep=',')
+    return _Reference(ref_db, cell_map)
+
+
+def load_reference(ref_dir):
+    """
+    load the reference database, which is cached until the files are modified.
+
+    :param ref_dir: reference directory
+    :return: the reference
+    """
+    ref_sample_path = os.path.abspath(os.path.join(ref_dir, 'ref_sample_epx.csv'))
+    cell_map_path = os.path.abspath(os.path.join(ref_dir, 'cell_map.csv'))
+    if not os.path.exists(ref_sample_path):
+        raise ValueError('can not load reference file, download from https://github.com/BGIResearch/stereopy')
+    mtime = (os.path.getmtime(ref_sample_path), os.path.getmtime(cell_map_path))
+    return _load_reference(ref_sample_path, cell_map_path, mtime)
 
 
 def parse_ref_data(ref_dir):
@@ -266,119 +286,112 @@ def parse_ref_data(ref_dir):
     return ref_db
 
 
-def random_choose_genes(df, sample_rate):
+def group_predictions(cells, cell_types):
     """
-    select genes randomly
+    group the predictions by cell and cell type
 
-    :param df: input data frame
-    :param sample_rate: percentage of sampling
-    :return: sampling data frame
+    :param cells: the cell of each prediction
+    :param cell_types: the predicted cell type of each prediction
+    :return: the cell and the cell type of each group sorted by them, and the group of each prediction
     """
-    sample_cnt = pd.Series(np.int32(df.sum(axis=0) * sample_rate), index=df.columns)
-    gene_rate = df / df.sum(axis=0)
-    sample_df = gene_rate.apply(lambda x: choose_gene(x, sample_cnt), axis=0)
-    sample_df.fillna(0, inplace=True)
-    return sample_df
+    cell_uniques, cell_codes = np.unique(cells, return_inverse=True)
+    type_uniques, type_codes = np.unique(cell_types, return_inverse=True)
+    pairs, pair_index = np.unique(cell_codes.astype(np.int64) * type_uniques.size + type_codes, return_inverse=True)
+    return cell_uniques[pairs // type_uniques.size], type_uniques[pairs % type_uniques.size], pair_index.ravel()
 
 
-def choose_gene(x, num):
+def gene_selector(gene_names, genes):
     """
-    gene selection
+    the sparse matrix mapping the genes of the expression matrix to the `genes`, the genes not in `genes` are dropped
 
-    :param x:
-    :param num:
-    :return:
+    :param gene_names: the genes of the expression matrix
+    :param genes: the genes to map to
+    :return: a csr_matrix of shape (n_genes of the expression matrix, n_genes of `genes`)
     """
-    gene_list = list(x.index)
-    p = x.values
-    res = np.random.choice(a=gene_list, size=num[x.name], p=p)
-    res = np.unique(res, return_counts=True)
-    res = pd.Series(data=res[1], index=res[0], name=x.name)
-    return res
+    positions = pd.Index(genes).get_indexer(gene_names)
+    rows = np.flatnonzero(positions >= 0)
+    return csr_matrix((np.ones(rows.size), (rows, positions[rows])), shape=(len(gene_names), len(genes)))
 
 
-def annotation(df, ref_db, method, keep_zeros):
+def random_choose_genes(mat, sample_rate, random_state):
     """
+    resample the counts of each cell, `sample_rate` of the counts are drawn from the genes by their proportions
 
-    :param df:
-    :param ref_db:
-    :param method:
-    :param keep_zeros:
-    :return:
-    """
-    # find common genes between test data and ref data
-    test_genes = set(df.index)
-    ref_genes = set(ref_db.index)
-    if keep_zeros:
-        common_genes = list(ref_genes)
-    else:
-        common_genes = list(ref_genes.intersection(test_genes))
-    # only keep non-zero genes
-    df = df.reindex(common_genes, fill_value=0.0)
-    ref_db = ref_db.reindex(common_genes, fill_value=0.0)
-    if method == 'pearson':
-        corr_score = pearson_corr(ref_db, df)
-    else:
-        corr_score = spearmanr_corr(ref_db, df)
-    corr_score = corr_score.fillna(0)
-    return corr_score
-
+    The multinomial draw of each cell is made of a binomial draw per nonzero conditioned on the counts left, the k-th
+    nonzeros of all the cells are drawn at once.
 
-def get_top_corr(score, cell_map, output):
+    :param mat: the csr_matrix of counts, cells as rows
+    :param sample_rate: percentage of sampling
+    :param random_state: a `np.random.RandomState`
+    :return: the csr_matrix of sampling counts
     """
+    mat = csr_matrix(mat, dtype=np.float64, copy=True)
+    mat.sum_duplicates()
+    counts = np.diff(mat.indptr)
+    totals = np.asarray(mat.sum(axis=1)).ravel()
+    sample_cnt = np.int32(totals * sample_rate)
+    sample_cnt[sample_cnt < 0] = 0
+    # the probability of each nonzero given the nonzeros before it in its cell are not drawn, the last one takes the rest
+    cumsum = np.concatenate([[0], np.cumsum(mat.data)])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        conditional_p = np.clip(mat.data / (np.repeat(cumsum[mat.indptr[1:]], counts) - cumsum[:-1]), 0, 1)
+    conditional_p[~np.isfinite(conditional_p)] = 0
+    conditional_p[mat.indptr[1:][counts > 0] - 1] = 1
+    # the cells sorted by their number of nonzeros, the cells having a k-th nonzero are a prefix of them
+    order = np.argsort(-counts, kind='stable')
+    starts = mat.indptr[order]
+    sorted_counts = counts[order]
+    remaining_cnt = sample_cnt[order].astype(np.int64)
+    for k in range(sorted_counts[0] if order.size else 0):
+        n_cells = np.searchsorted(-sorted_counts, -k, side='left')
+        index = starts[:n_cells] + k
+        drawn = random_state.binomial(remaining_cnt[:n_cells], conditional_p[index])
+        mat.data[index] = drawn
+        remaining_cnt[:n_cells] -= drawn
+    mat.eliminate_zeros()
+    return mat
+
+
+def get_top_corr(mat, model, method):
+    """
+    the reference sample most correlated with each cell
 
-    :param score:
-    :param cell_map:
-    :param output:
-    :return:
+    :param mat: the csr_matrix of expression, cells as rows and the genes of the model as columns
+    :param model: the reference model
+    :param method: calculate correlation's method
+    :return: the index of the top sample and the score of each cell
     """
-    max_index = score.values.argmax(axis=1)
-    max_value = score.values.max(axis=1)
-    samples = score.columns[max_index]
-    cell_type = cell_map.loc[samples, 'cell type']
-    cell = score.index
-    df = pd.DataFrame({'cell': cell, 'cell type': cell_type, 'corr_score': max_value, 'corr_sample': samples})
-    df.to_csv(output, index=False)
-    return df
+    if method == 'pearson':
+        n_genes = mat.shape[1]
+        mean = np.asarray(mat.mean(axis=1)).ravel()
+        std = np.sqrt(np.maximum(np.asarray(mat.multiply(mat).sum(axis=1)).ravel() / n_genes - mean ** 2, 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = np.asarray(mat @ model) / std[:, None]
+    else:
+        score = corr_spearman_sparse(mat, model)
+    score[np.isnan(score)] = 0
+    top = score.argmax(axis=1)
+    return top, score[np.arange(top.size), top]
 
 
-def run_annotation(sub_df, ref_dir, method, keep_zero, output, sub_index, use_rf, sample_rate):
+def annotation_batch(mat, gene_map, model, method, n_estimators, sample_rate, seeds):
     """
+    predict the cells of a batch n times
 
-    :param sub_df:
-    :param ref_dir:
-    :param method:
-    :param keep_zero:
-    :param output:
-    :param sub_index:
-    :param use_rf:
-    :param sample_rate:
-    :return:
-    """
-    ref_db = parse_ref_data(ref_dir)
-    cell_map = pd.read_csv(os.path.join(ref_dir, 'cell_map.csv'), index_col=0, header=0, sep=',')
-    if use_rf:
-        logger.info('random choose')
-        sub_df = random_choose_genes(sub_df, sample_rate)
-    nor_x = normalize_total(sub_df.transpose().values, target_sum=10000)  # TODO  select some of normalize method
-    nor_x = np.log1p(nor_x, out=nor_x)
-    sub_df = pd.DataFrame(nor_x.T, columns=sub_df.columns, index=sub_df.index)
-    logger.info('annotation')
-    corr_df = annotation(sub_df, ref_db, method, keep_zero)
-    all_out = os.path.join(output, f'{sub_index}.all_{method}_corr.csv')
-    top_out = os.path.join(output, f'{sub_index}.top_{method}_corr.csv')
-    corr_df.to_csv(all_out)
-    get_top_corr(corr_df, cell_map, top_out)
-    logger.info(f'subsample {sub_index} DONE!')
-
-
-def subprocess_error(value):
-    """
-    Print subprocess error info
-    :param value:
-    :return:
+    :param mat: the csr_matrix of counts, cells as rows
+    :param gene_map: the matrix returned by `gene_selector`
+    :param model: the reference model
+    :param method: calculate correlation's method
+    :param n_estimators: prediction times
+    :param sample_rate: percentage of sampling, the counts are not resampled if `None`
+    :param seeds: the random seed of each prediction
+    :return: the index of the top samples and the scores, shape (n_estimators, n_cells)
     """
-    logger.error(f"error: {value}")
-    logger.error("========")
-    logger.error(traceback.format_exc())
-    raise
+    samples = np.empty((n_estimators, mat.shape[0]), dtype=np.int64)
+    scores = np.empty((n_estimators, mat.shape[0]), dtype=np.float64)
+    for i in range(n_estimators):
+        sub_mat = mat if sample_rate is None else random_choose_genes(mat, sample_rate, np.random.RandomState(seeds[i]))
+        nor_x = normalize_total(sub_mat, target_sum=10000)
+        nor_x = nor_x.log1p().astype(np.float64)
+        samples[i], scores[i] = get_top_corr(csr_matrix(nor_x @ gene_map), model, method)
+    return samples, scores
@@ -12,14 +12,14 @@ change log:
 """
 import pandas as pd
 
-from ..utils.data_helper import select_group
+from ..utils.group_stats import GroupStats
 from ..utils.time_consume import log_consumed_time
 from ..core.tool_base import ToolBase
 from ..log_manager import logger
 from tqdm import tqdm
 from typing import Union, Sequence
 import numpy as np
-from scipy import stats
+from scipy import sparse
 from ..algorithm import mannwhitneyu, statistics
 
 
@@ -35,6 +35,7 @@ class FindMarker(ToolBase):
     :param control_groups: rest of groups
     :param method: t-test or wilcoxon_test
     :param corr_method: correlation method
+    :param n_jobs: the number of threads to rank the blocks of genes for wilcoxon_test, `-1` means all CPUs.
 
     Examples
     --------
@@ -55,7 +56,8 @@ class FindMarker(ToolBase):
             raw_data=None,
             sort_by='scores',
             n_genes: Union[str, int] = 'all',
-            ascending: Union[bool] = False
+            ascending: Union[bool] = False,
+            n_jobs: int = -1
     ):
         super(FindMarker, self).__init__(data=data, groups=groups, method=method)
         self.corr_method = corr_method.lower()
@@ -66,6 +68,7 @@ class FindMarker(ToolBase):
         self.sort_by = sort_by
         self.n_genes = n_genes
         self.ascending = ascending
+        self.n_jobs = n_jobs
         self.fit()
 
     @ToolBase.method.setter
@@ -126,8 +129,6 @@ class FindMarker(ToolBase):
             raise ValueError('self.n_genes can not be zero')
         if self.sort_by not in {'scores', 'log2fc'}:
             raise ValueError('sort_by must be in {\'scores\', \'log2fc\'}')
-        if self.method == 'wilcoxon_test':
-            self.data.sparse2array()
         if self.groups is None:
             raise ValueError(f'group information must be set')
         group_info = self.groups
@@ -138,17 +139,12 @@ class FindMarker(ToolBase):
             case_groups = self.case_groups
         control_str = self.control_groups if isinstance(self.control_groups, str) else '-'.join(self.control_groups)
         self.result = {}
+        group_stats = GroupStats(self.data.exp_matrix, group_info['group'].values)
 
         # only used when method is wilcoxon
-        ranks = None
-        tie_term = None
-        if self.method == 'wilcoxon_test' and self.control_groups == 'rest':
-            self.logger.info('cal rankdata')
-            ranks = stats.rankdata(self.data.exp_matrix.T, axis=-1)
-            self.logger.info('cal tie_term')
-            if self.tie_term:
-                tie_term = mannwhitneyu.cal_tie_term(ranks)
-            self.logger.info('cal tie_term end')
+        wilcoxon_data = None
+        if self.method == 'wilcoxon_test':
+            wilcoxon_data = self.prepare_wilcoxon(group_stats)
 
         logres_score = None
         if self.case_groups == 'all' and self.control_groups == 'rest' and self.method == 'logreg':
@@ -163,22 +159,19 @@ class FindMarker(ToolBase):
                 other_g = list(other_g)
             else:
                 other_g = self.control_groups
-            # self.logger.info('start to select group')
-            g_data, g_index = select_group(st_data=self.data, groups=g, cluster=group_info)
-            other_data, _ = select_group(st_data=self.data, groups=other_g, cluster=group_info)
-            # self.logger.info('end selelct group')
-            if self.method == 't_test':
-                result = statistics.ttest(g_data, other_data, self.corr_method)
-            elif self.method == 'logreg':
+            if self.method == 'wilcoxon_test':
+                result = self.run_wilcoxon(wilcoxon_data, group_stats, g, other_g)
+            elif self.method == 't_test':
+                result = statistics.ttest_from_stats(
+                    group_stats.mean(g), group_stats.var(g), group_stats.size(g),
+                    group_stats.mean(other_g), group_stats.var(other_g), group_stats.size(other_g),
+                    self.corr_method
+                )
+                result['log2fc'] = statistics.cal_log2fc_from_means(group_stats.mean(g), group_stats.mean(other_g))
+            else:
                 if logres_score is None:
                     logres_score = self.logres_score()
-                result = self.run_logres(logres_score, g_data, other_data, g)
-            else:
-                if self.control_groups != 'rest' and self.tie_term:
-                    xy = np.concatenate((g_data.values, other_data.values), axis=-1)
-                    ranks = stats.rankdata(xy, axis=-1)
-                    tie_term = mannwhitneyu.cal_tie_term(ranks)
-                result = statistics.wilcoxon(g_data, other_data, self.corr_method, ranks, tie_term, g_index)
+                result = self.run_logres(logres_score, group_stats, g, other_g)
             result['genes'] = self.data.gene_names
             result.sort_values(by=self.sort_by, ascending=self.ascending, inplace=True)
 
@@ -195,28 +188,58 @@ class FindMarker(ToolBase):
             self.result[f"{g}.vs.{control_str}"]['pct'] = self.result['pct'].iloc[result.index][g].values
             self.result[f"{g}.vs.{control_str}"]['pct_rest'] = self.result['pct_rest'].iloc[result.index][g].values
 
+    @log_consumed_time
+    def prepare_wilcoxon(self, group_stats: GroupStats):
+        """
+        Prepare the csc expression matrix, when the control groups are the rest,
+        the ranks of all the cells are computed here once for all groups.
+        """
+        x = self.data.exp_matrix
+        if not sparse.issparse(x) and not isinstance(x, np.ndarray):
+            x = x.tocsr()
+        x = sparse.csc_matrix(x)
+        x.sort_indices()
+        rank_sums, tie_term = None, None
+        if self.control_groups == 'rest':
+            self.logger.info('cal rank sums')
+            rank_sums, tie_term = mannwhitneyu.rank_sums_by_group(
+                x, group_stats.codes, group_stats.n_groups, with_tie_term=self.tie_term, n_jobs=self.n_jobs
+            )
+        return {'x': x, 'rank_sums': rank_sums, 'tie_term': tie_term}
+
+    def run_wilcoxon(self, wilcoxon_data, group_stats: GroupStats, group_name, other_groups):
+        code = group_stats.get_codes([group_name])[0]
+        other_codes = group_stats.get_codes(other_groups)
+        if wilcoxon_data['rank_sums'] is not None:
+            rank_sums, tie_term = wilcoxon_data['rank_sums'][:, code], wilcoxon_data['tie_term']
+        else:
+            # rank among the cells of the group and the control groups
+            cell_mask = np.isin(group_stats.codes, np.append(other_codes, code))
+            rank_sums, tie_term = mannwhitneyu.rank_sums_by_group(
+                wilcoxon_data['x'], group_stats.codes, group_stats.n_groups, cell_mask=cell_mask,
+                with_tie_term=self.tie_term, n_jobs=self.n_jobs
+            )
+            rank_sums = rank_sums[:, code]
+        log2fc = statistics.cal_log2fc_from_means(group_stats.mean(group_name), group_stats.mean(other_groups))
+        return statistics.wilcoxon_from_rank_sums(
+            rank_sums, group_stats.size(group_name), group_stats.size(other_groups), log2fc, self.corr_method,
+            tie_term
+        )
+
     @log_consumed_time
     def calc_pct_and_pct_rest(self):
         self.raw_data.array2sparse()
         raw_cells_isin_data = np.isin(self.raw_data.cell_names, self.data.cell_names)
         raw_genes_isin_data = np.isin(self.raw_data.gene_names, self.data.gene_names)
         raw_exp_matrix = self.raw_data.exp_matrix[raw_cells_isin_data][:, raw_genes_isin_data]
-        exp_matrix_one_hot = (raw_exp_matrix > 0).astype(np.uint8)
-        cluster_result: pd.DataFrame = self.groups.copy()
-        cluster_result.reset_index(drop=True, inplace=True)
-        cluster_result.reset_index(inplace=True)
-        cluster_result.sort_values(by=['group', 'index'], inplace=True)
-        group_index = cluster_result.groupby('group').agg(cell_index=('index', list))
-        def _calc(a, exp_matrix_one_hot):
-            cell_index = a[0]
-            sub_exp = exp_matrix_one_hot[cell_index].sum(axis=0).A[0]
-            sub_exp_rest = exp_matrix_one_hot.sum(axis=0).A[0] - sub_exp
-            sub_pct = sub_exp / len(cell_index)
-            sub_pct_rest = sub_exp_rest / (self.data.cell_names.size - len(cell_index))
-            return sub_pct, sub_pct_rest
-        pct_all = np.apply_along_axis(_calc, 1, group_index.values, exp_matrix_one_hot)
-        pct = pd.DataFrame(pct_all[:, 0], columns=self.data.gene_names, index=group_index.index).T
-        pct_rest = pd.DataFrame(pct_all[:, 1], columns=self.data.gene_names, index=group_index.index).T
+        group_stats = GroupStats(raw_exp_matrix, self.groups['group'].values)
+        n_expressed = group_stats.n_expressed()
+        sizes = group_stats.size()[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pct_all = n_expressed / sizes
+            pct_rest_all = (n_expressed.sum(axis=0) - n_expressed) / (self.data.cell_names.size - sizes)
+        pct = pd.DataFrame(pct_all, columns=self.data.gene_names, index=group_stats.group_index).T
+        pct_rest = pd.DataFrame(pct_rest_all, columns=self.data.gene_names, index=group_stats.group_index).T
         pct.columns.name = None
         pct.reset_index(inplace=True)
         pct.rename(columns={'index': 'genes'}, inplace=True)
@@ -247,14 +270,14 @@ class FindMarker(ToolBase):
         score_df.columns = self.data.gene_names
         return score_df
 
-    def run_logres(self, score_df, g_data, other_data, group_name):
-        from ..algorithm.statistics import cal_log2fc
+    def run_logres(self, score_df, group_stats: GroupStats, group_name, other_groups):
+        from ..algorithm.statistics import cal_log2fc_from_means
         res = pd.DataFrame()
         # res['genes'] = g_data.columns
         gene_index = score_df.columns.isin(self.data.gene_names)
         scores = score_df.loc[str(group_name)].values if score_df.shape[0] > 1 else score_df.values[0]
         res['scores'] = scores[gene_index]
-        res['log2fc'] = cal_log2fc(g_data, other_data)
+        res['log2fc'] = cal_log2fc_from_means(group_stats.mean(group_name), group_stats.mean(other_groups))
         return res
 
     @staticmethod
@@ -5,6 +5,7 @@
 @time:2021/08/12
 """
 from ..core.tool_base import ToolBase
+from ..core.lazy_matrix import LazyExpMatrix
 from typing import Optional
 import numpy as np
 import pandas as pd
@@ -84,8 +85,10 @@ class HighlyVariableGenes(ToolBase):
         # group_info = None if self.groups is None else np.array(self.groups['group'])
         group_info = None if self.groups is None else self.groups['group'].astype('category')
         if self.method == 'seurat_v3':
+            # seurat_v3 needs the counts of each batch in memory to clip them
+            exp_matrix = self.data.exp_matrix
             df = highly_variable_genes_seurat_v3(
-                self.data.exp_matrix,
+                exp_matrix.tocsr() if isinstance(exp_matrix, LazyExpMatrix) else exp_matrix,
                 n_top_genes=self.n_top_genes,
                 span=self.span,
                 batch_info=group_info
@@ -53,14 +53,14 @@ class RnaVelocity(object):
                 logger.info("Exon information not found in gem file")
                 raise Exception("Exon information not found in gem file")
             df = self.colchange(df)
-            df_exp_bin = self.parse_bin_coor(df, self.bin_size)
-            layers = self.get_layers(df_exp_bin)
+            cell_codes, cell_names = self.parse_bin_coor(df, self.bin_size)
+            layers, gene_names = self.get_layers(df, cell_codes, cell_names.size)
 
             logger.info("Getting row attrs from gtf")
-            df_row_attrs = self.get_row_attrs(layers["total"])
+            df_row_attrs = self.get_row_attrs(gene_names)
 
             logger.info("Generating loom")
-            output_loom_file = self.loom_generate(df_row_attrs, layers)
+            output_loom_file = self.loom_generate(df_row_attrs, layers, cell_names)
 
         else:
             logger.info("Getting layers")
@@ -73,12 +73,12 @@ class RnaVelocity(object):
                 gene_list = []
                 uniq_cell, gene_names, count, cell_ind, gene_ind, exon = gef.get_filtered_data_exon(region, gene_list)
 
-                layers = self.get_layers_gef(uniq_cell, gene_names, count, cell_ind, gene_ind, exon)
+                layers, cell_names = self.get_layers_gef(uniq_cell, gene_names, count, cell_ind, gene_ind, exon)
                 logger.info("Getting row attrs from gtf")
-                df_row_attrs = self.get_row_attrs(layers["total"])
+                df_row_attrs = self.get_row_attrs(gene_names)
 
                 logger.info("Generating loom")
-                output_loom_file = self.loom_generate(df_row_attrs, layers)
+                output_loom_file = self.loom_generate(df_row_attrs, layers, cell_names)
 
             else:
                 logger.info("Exon information not found in gef file")
@@ -95,14 +95,14 @@ class RnaVelocity(object):
                 logger.info("Exon information not found in gem file")
                 raise Exception("Exon information not found in gem file")
             df = self.colchange(df)
-            df_exp_bin = self.parse_cell_bin_coor(df)
-            layers = self.get_layers(df_exp_bin)
+            cell_codes, cell_names = self.parse_cell_bin_coor(df)
+            layers, gene_names = self.get_layers(df, cell_codes, cell_names.size)
 
             logger.info("Getting row attrs from gtf")
-            df_row_attrs = self.get_row_attrs(layers["total"])
+            df_row_attrs = self.get_row_attrs(gene_names)
 
             logger.info("Generating loom")
-            output_loom_file = self.loom_generate(df_row_attrs, layers)
+            output_loom_file = self.loom_generate(df_row_attrs, layers, cell_names)
 
         else:
             logger.info("Getting layers")
@@ -115,12 +115,12 @@ class RnaVelocity(object):
                 gene_list = []
                 uniq_cell, gene_names, count, cell_ind, gene_ind, exon = gef.get_filtered_data_exon(region, gene_list)
 
-                layers = self.get_layers_gef(uniq_cell, gene_names, count, cell_ind, gene_ind, exon)
+                layers, cell_names = self.get_layers_gef(uniq_cell, gene_names, count, cell_ind, gene_ind, exon)
                 logger.info("Getting row attrs from gtf")
-                df_row_attrs = self.get_row_attrs(layers["total"])
+                df_row_attrs = self.get_row_attrs(gene_names)
 
                 logger.info("Generating loom")
-                output_loom_file = self.loom_generate(df_row_attrs, layers)
+                output_loom_file = self.loom_generate(df_row_attrs, layers, cell_names)
 
             else:
                 logger.info("Exon information not found in gef file")
@@ -129,10 +129,17 @@ class RnaVelocity(object):
         return output_loom_file
 
     def parse_cell_bin_coor(self, df):
-        gdf = df.groupby('CellID').apply(lambda x: self.make_multipoint(x))
-        df = pd.merge(df, gdf, on='CellID')
-        exp_bin = df.groupby(["cell_id", "geneID"]).agg({"MIDCount": "sum", "ExonCount": "sum"})
-        return exp_bin
+        """
+        generate cell id of each cell using the centroid of its convex hull.
+
+        :param df: a dataframe of the cell bin file.
+        :return: the cell index of each row of `df` and the cell ids.
+        """
+        cell_codes, _ = pd.factorize(df['CellID'])
+        gdf = df.groupby(cell_codes).apply(lambda x: self.make_multipoint(x))
+        # the cells sharing the same centroid are merged
+        centroid_codes, cell_names = pd.factorize(gdf['cell_id'].values)
+        return centroid_codes[cell_codes], np.asarray(cell_names)
 
     def make_multipoint(self, x):
         p = [Point(i) for i in zip(x['x'], x['y'])]
@@ -163,34 +170,39 @@ class RnaVelocity(object):
 
         :param df: a dataframe of the bin file.
         :param bin_size: the size of bin to merge.
-        :return:
+        :return: the bin unit index of each row of `df` and the cell ids of the bin units.
         """
         x_min = df['x'].min()
         y_min = df['y'].min()
-        df['bin_x'] = self.merge_bin_coor(df['x'].values, x_min, bin_size)
-        df['bin_y'] = self.merge_bin_coor(df['y'].values, y_min, bin_size)
-        df['cell_id'] = df['bin_x'].astype(str) + '_' + df['bin_y'].astype(str)
-        exp_bin = df.groupby(["cell_id", "geneID"]).agg({"MIDCount": "sum", "ExonCount": "sum"})
+        bin_x = self.merge_bin_coor(df['x'].values, x_min, bin_size).astype(np.int64)
+        bin_y = self.merge_bin_coor(df['y'].values, y_min, bin_size).astype(np.int64)
+        n_y = bin_y.max() + 1
+        bin_keys, cell_codes = np.unique(bin_x * n_y + bin_y, return_inverse=True)
+        cell_names = self.make_cell_names(bin_keys // n_y, bin_keys % n_y)
+        return cell_codes.ravel(), cell_names
 
-        return exp_bin
+    @staticmethod
+    def make_cell_names(x, y):
+        return np.char.add(np.char.add(np.asarray(x).astype('U'), '_'), np.asarray(y).astype('U'))
 
     def merge_bin_coor(self, coor: np.ndarray, coor_min: int, bin_size: int):
         return np.floor((coor - coor_min) / bin_size).astype(np.int)
 
-    def get_layers(self, df_exp_bin):
+    def get_layers(self, df, cell_codes, n_cells):
         """
         generate total_count, extron, intron matrix information according gem file.
 
-        :df_exp_bin: dataframe of gene expression.
+        :df: dataframe of gene expression.
+        :cell_codes: the cell index of each row of `df`.
+        :n_cells: the number of cells.
 
-        :return: dictionnary of total_count, extron, intron matrix information.
+        :return: dictionnary of total_count, extron, intron matrix information, the rows of each matrix are genes and
+                    the columns are cells, and the gene names.
         """
-        layer_total = self.cal_layer(df_exp_bin, "matrix")
-        layer_extron = self.cal_layer(df_exp_bin, "extron")
-        layer_intron = layer_total - layer_extron
-        layer_ambiguous = layer_total - layer_extron - layer_intron
-
-        return {"total": layer_total, "extron": layer_extron, "intron": layer_intron, "ambiguous": layer_ambiguous}
+        gene_codes, gene_names = pd.factorize(df['geneID'], sort=True)
+        layer_total = self.cal_layer(df['MIDCount'].values, gene_codes, cell_codes, (gene_names.size, n_cells))
+        layer_extron = self.cal_layer(df['ExonCount'].values, gene_codes, cell_codes, (gene_names.size, n_cells))
+        return self.make_layers(layer_total, layer_extron), np.asarray(gene_names)
 
     def get_layers_gef(self, uniq_cell, gene_names, count, cell_ind, gene_ind, exon):
         """
@@ -203,61 +215,51 @@ class RnaVelocity(object):
         :gene_ind: list of gene index.
         :exon: list of extron expression count.
 
-        :return: dictionnary of total_count, extron, intron matrix information
+        :return: dictionnary of total_count, extron, intron matrix information, and the cell names.
         """
-
-        x_array = np.right_shift(uniq_cell, 32).astype('str')
-        y_array = np.bitwise_and(uniq_cell, 0xffffffff).astype('str')
-        position_cell_name = ['_'.join(map(str, i)) for i in zip(x_array, y_array)]
-        cn = len(uniq_cell)
-        gn = len(gene_names)
-        total_exp_matrix_coo = sparse.coo_matrix((count, (gene_ind, cell_ind)), shape=(gn, cn), dtype=np.uint32)
-        layer_total = pd.DataFrame(total_exp_matrix_coo.toarray(), columns=position_cell_name, index=gene_names)
-
-        eson_exp_matrix_coo = sparse.coo_matrix((exon, (gene_ind, cell_ind)), shape=(gn, cn), dtype=np.uint32)
-        layer_extron = pd.DataFrame(eson_exp_matrix_coo.toarray(), columns=position_cell_name, index=gene_names)
+        uniq_cell = np.asarray(uniq_cell)
+        cell_names = self.make_cell_names(np.right_shift(uniq_cell, 32), np.bitwise_and(uniq_cell, 0xffffffff))
+        shape = (len(gene_names), len(uniq_cell))
+        layer_total = self.cal_layer(count, gene_ind, cell_ind, shape)
+        layer_extron = self.cal_layer(exon, gene_ind, cell_ind, shape)
+        return self.make_layers(layer_total, layer_extron), cell_names
+
+    @staticmethod
+    def make_layers(layer_total, layer_extron):
         layer_intron = layer_total - layer_extron
-        layer_ambiguous = layer_total - layer_extron - layer_intron
-
+        layer_intron.eliminate_zeros()
+        layer_ambiguous = sparse.csr_matrix(layer_total.shape, dtype=layer_total.dtype)
         return {"total": layer_total, "extron": layer_extron, "intron": layer_intron, "ambiguous": layer_ambiguous}
 
-    def cal_layer(self, df, which):
+    def cal_layer(self, values, gene_codes, cell_codes, shape):
         """
-        calculate sum value of MIDCount and ExonCount
+        calculate sum value of MIDCount or ExonCount
 
-        :df: dataframe of gene expression.
-        :which: matrix or extron.
+        :values: the count of each row.
+        :gene_codes: the gene index of each row.
+        :cell_codes: the cell index of each row.
+        :shape: the number of genes and cells.
 
-        :return: dataframe summed based on geneID and cellID.
+        :return: csr_matrix summed based on gene and cell, genes as rows.
         """
-
-        df = df.reset_index()
-        bin_cell = list(set(df["geneID"]))
-        chunks = [bin_cell[x:x+5000] for x in range(0, len(bin_cell), 5000)]
-        chunks_exp = []
-        if which == "matrix":
-            for i in tqdm(chunks):
-                chunks_exp.append(pd.pivot(df[df["geneID"].isin(i)], columns="cell_id", index="geneID", values='MIDCount'))
-        elif which == "extron":
-            for i in tqdm(chunks):
-                chunks_exp.append(pd.pivot(df[df["geneID"].isin(i)], columns="cell_id", index="geneID", values='ExonCount'))
-        else:
-            raise
-
-        c_df = pd.concat(chunks_exp, join="outer").fillna(0)
-
-        return c_df
-
-    def get_row_attrs(self, layer_total):
+        layer = sparse.csr_matrix(
+            (np.asarray(values, dtype=np.uint32), (np.asarray(gene_codes), np.asarray(cell_codes))),
+            shape=shape, dtype=np.uint32
+        )
+        layer.sum_duplicates()
+        layer.eliminate_zeros()
+        return layer
+
+    def get_row_attrs(self, gene_names):
         """
         get row attrs from gtf
 
-        :layer_total: dataframe of total_count matrix(row: cell_id; col:gene_id).
+        :gene_names: the genes of the rows of layers.
 
         :return: dataframe of annotaion information.
         """
         base = gp.read_gtf(self.gtf_path)
-        gene_list = list(layer_total.index)
+        gene_list = list(gene_names)
 
         base_sub = base.loc[base["feature"] == "gene", ["gene_id", "gene_name", "seqname", "strand", "start", "end"]].copy()
         base_sub.drop_duplicates(keep="first", inplace=True)
@@ -272,12 +274,14 @@ class RnaVelocity(object):
 
         return df_row_attrs
 
-    def loom_generate(self, df_row_attrs, layers):
+    def loom_generate(self, df_row_attrs, layers, cell_names, chunk_size=None):
         """
-        generate loom file by using loompy
+        generate loom file by using loompy, the layers are appended in chunks of columns.
 
         :df_row_attrs: dataframe of annotaion information.
         :layers: total_count, extron, intron matrix information.
+        :cell_names: the cells of the columns of layers.
+        :chunk_size: the number of columns of each chunk, by default each chunk of a layer has about 16M values.
 
         :return: the output loom path.
         """
@@ -288,16 +292,21 @@ class RnaVelocity(object):
                         "Start": np.array(df_row_attrs.start),
                         "Strand": np.array(df_row_attrs.strand)}
 
-        col_attrs = {"CellID": np.array(layers["total"].columns)}
-
         file_out = os.path.join(self.out_dir, "rna_velocity.loom")
-        
-        loompy.create(file_out, sparse.coo_matrix(np.array(layers["total"])), row_attrs=row_attrs, col_attrs=col_attrs)
 
-        with loompy.connect(file_out) as ds:
-            ds.layers['spliced'] = sparse.coo_matrix(np.array(layers["extron"]), dtype='uint32')
-            ds.layers['unspliced'] = sparse.coo_matrix(np.array(layers["intron"]), dtype='uint32')
-            ds.layers['ambiguous'] = sparse.coo_matrix(np.array(layers["ambiguous"]), dtype='uint32')
+        layer_names = {"": "total", "spliced": "extron", "unspliced": "intron", "ambiguous": "ambiguous"}
+        layers = {name: layers[key].tocsc() for name, key in layer_names.items()}
+        n_genes, n_cells = layers[""].shape
+        if chunk_size is None:
+            chunk_size = max((1 << 24) // max(n_genes, 1), 1)
+        with loompy.new(file_out) as ds:
+            for start in tqdm(range(0, n_cells, chunk_size)):
+                end = min(start + chunk_size, n_cells)
+                ds.add_columns(
+                    {name: layer[:, start:end].toarray() for name, layer in layers.items()},
+                    col_attrs={"CellID": np.array(cell_names[start:end])},
+                    row_attrs=row_attrs if start == 0 else None
+                )
 
         return file_out
 
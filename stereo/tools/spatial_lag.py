@@ -7,10 +7,12 @@
 @time:2021/04/19
 """
 from ..core.tool_base import ToolBase
-from pysal.model import spreg
 from pysal.lib import weights
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
+from scipy.sparse import issparse, csc_matrix
+from scipy.stats import norm
 from tqdm import tqdm
 from random import sample
 from ..core.stereo_result import SpatialLagResult
@@ -27,6 +29,8 @@ class SpatialLag(ToolBase):
     :param random_drop: randomly drop bin-cells if True
     :param drop_dummy: drop specify clusters
     :param n_neighbors: number of neighbors
+    :param n_jobs: number of threads to fit the chunks of genes
+    :param chunk_size: number of genes fitted together in one batch
     """
     def __init__(
             self,
@@ -35,23 +39,26 @@ class SpatialLag(ToolBase):
             genes=None,
             random_drop=True,
             drop_dummy=None,
-            n_neighbors=8
+            n_neighbors=8,
+            n_jobs=1,
+            chunk_size=1000
     ):
         super(SpatialLag, self).__init__(data=data, groups=groups, method='gm_lag')
         self.genes = genes
         self.random_drop = random_drop
         self.drop_dummy = drop_dummy
         self.n_neighbors = n_neighbors
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
 
     def fit(self):
         """
         run analysis
         """
-        self.data.sparse2array()
         x, uniq_group = self.get_data()
         res = self.gm_model(x, uniq_group)
-        result = SpatialLagResult(res)
-        return result
+        self.result = SpatialLagResult(res)
+        return self.result
 
     def get_data(self):
         """
@@ -86,12 +93,15 @@ class SpatialLag(ToolBase):
         if self.genes is None:
             genes = self.data.gene_names
         else:
-            genes = self.data.gene_names.intersection(self.genes)
+            genes = pd.Index(self.data.gene_names).intersection(self.genes)
         return genes
 
     def gm_model(self, x, uniq_group):
         """
-        run gm model
+        run gm model, the spatial two stage least squares of `spreg.GM_Lag` with the default `w_lags=1`.
+
+        The exogenous variables, the spatial weights and the instruments are shared by all genes,
+        so the genes are fitted chunk by chunk as multiple right hand sides.
 
         :param x:
         :param uniq_group:
@@ -99,32 +109,95 @@ class SpatialLag(ToolBase):
         """
         knn = weights.distance.KNN.from_array(self.data.position, k=self.n_neighbors)
         knn.transform = 'R'
+        w = knn.sparse.tocsr()
         genes = self.get_genes()
-        result = pd.DataFrame(index=genes)
         vars_info = ['const'] + uniq_group + ['W_log_exp']
-        for i in vars_info:
-            result[str(i) + '_lag_coeff'] = None
-            result[str(i) + '_lag_zstat'] = None
-            result[str(i) + '_lag_pval'] = None
-        data_pd = pd.DataFrame(self.data.exp_matrix, columns=self.data.gene_names, index=self.data.cell_names)
-        for i, cur_g in tqdm(enumerate(genes),
-                             desc="performing GM_lag_model and assign coefficient and p-val to cell type"):
-            x['log_exp'] = data_pd[cur_g].values
-            try:
-                model = spreg.GM_Lag(x[['log_exp']].values, x.values,
-                                     w=knn, name_y='log_exp')
-                a = pd.DataFrame(model.betas, model.name_x + ['W_log_exp'], columns=['coef'])
-                b = pd.DataFrame(model.z_stat, model.name_x + ['W_log_exp'], columns=['z_stat', 'p_val'])
-                df = a.merge(b, left_index=True, right_index=True)
-                for ind, g in enumerate(vars_info):
-                    result.loc[cur_g, str(g) + '_lag_coeff'] = df.iloc[ind, 0]
-                    result.loc[cur_g, str(g) + '_lag_zstat'] = df.iloc[ind, 1]
-                    result.loc[cur_g, str(g) + '_lag_pval'] = df.iloc[ind, 2]
-            except Exception as e:
-                logger.error(f'spatial lag get an error: {e}.')
-                for ind, g in enumerate(vars_info):
-                    result.loc[cur_g, str(g) + '_lag_coeff'] = np.nan
-                    result.loc[cur_g, str(g) + '_lag_zstat'] = np.nan
-                    result.loc[cur_g, str(g) + '_lag_pval'] = np.nan
-        self.result.matrix = result
+
+        exog = np.hstack([np.ones((x.shape[0], 1)), x.values.astype(np.float64)])
+        # instruments: the exogenous variables and their spatial lags
+        instruments = np.hstack([exog, w @ exog[:, 1:]])
+        hth_inv = np.linalg.inv(instruments.T @ instruments)
+        shared = {
+            'w': w,
+            'exog': exog,
+            'instruments': instruments,
+            'hth_inv': hth_inv,
+            'hx': instruments.T @ exog,
+            'xx': exog.T @ exog,
+        }
+
+        exp_matrix = self.data.exp_matrix
+        exp_matrix = exp_matrix.tocsc() if issparse(exp_matrix) else exp_matrix
+        gene_index = pd.Index(self.data.gene_names).get_indexer(genes)
+        chunks = [gene_index[i:i + self.chunk_size] for i in range(0, gene_index.size, self.chunk_size)]
+        results = Parallel(n_jobs=self.n_jobs, backend='threading')(
+            delayed(self._gm_lag_batch)(exp_matrix[:, chunk], shared)
+            for chunk in tqdm(chunks, desc="performing GM_lag_model and assign coefficient and p-val to cell type")
+        )
+        betas = np.vstack([r[0] for r in results])
+        z_stat = np.vstack([r[1] for r in results])
+        p_val = np.vstack([r[2] for r in results])
+
+        result = pd.DataFrame(index=genes)
+        for ind, g in enumerate(vars_info):
+            result[str(g) + '_lag_coeff'] = betas[:, ind]
+            result[str(g) + '_lag_zstat'] = z_stat[:, ind]
+            result[str(g) + '_lag_pval'] = p_val[:, ind]
         return result
+
+    @staticmethod
+    def _gm_lag_batch(y, shared):
+        """
+        fit the GM lag model for each column of `y`.
+
+        :return: the betas, z-stats and p-values, each with a gene per row.
+        """
+        w, exog, instruments, hth_inv = shared['w'], shared['exog'], shared['instruments'], shared['hth_inv']
+        n_obs, n_genes = y.shape
+        if issparse(y):
+            y = csc_matrix(y, dtype=np.float64)
+            wy = csc_matrix(w @ y)
+            col_dot = lambda a, b: np.asarray(a.multiply(b).sum(axis=0)).reshape(-1)  # noqa
+        else:
+            y = np.asarray(y, dtype=np.float64)
+            wy = w @ y
+            col_dot = lambda a, b: (a * b).sum(axis=0)  # noqa
+        # the cross products with the instruments and the exogenous variables, one column per gene
+        hy = np.asarray(y.T @ instruments).T
+        hwy = np.asarray(wy.T @ instruments).T
+        xy = np.asarray(y.T @ exog).T
+        xwy = np.asarray(wy.T @ exog).T
+        yy, wywy, wyy = col_dot(y, y), col_dot(wy, wy), col_dot(wy, y)
+
+        # z = [exog, wy], z'h and z'z of each gene
+        n_vars = exog.shape[1] + 1
+        zth = np.concatenate([np.broadcast_to(shared['hx'].T, (n_genes,) + shared['hx'].T.shape),
+                              hwy.T[:, np.newaxis, :]], axis=1)
+        ztz = np.empty((n_genes, n_vars, n_vars))
+        ztz[:, :-1, :-1] = shared['xx']
+        ztz[:, :-1, -1] = xwy.T
+        ztz[:, -1, :-1] = xwy.T
+        ztz[:, -1, -1] = wywy
+        zty = np.concatenate([xy.T, wyy[:, np.newaxis]], axis=1)
+
+        factor_1 = zth @ hth_inv
+        factor_2 = factor_1 @ zth.transpose(0, 2, 1)
+        try:
+            varb = np.linalg.inv(factor_2)
+        except np.linalg.LinAlgError:
+            varb = np.full_like(factor_2, np.nan)
+            for i in range(n_genes):
+                try:
+                    varb[i] = np.linalg.inv(factor_2[i])
+                except np.linalg.LinAlgError as e:
+                    logger.error(f'spatial lag get an error: {e}.')
+        betas = (varb @ (factor_1 @ hy.T[:, :, np.newaxis]))[:, :, 0]
+
+        # u'u = y'y - 2 * b'z'y + b'z'zb
+        utu = yy - 2 * (betas * zty).sum(axis=1) + np.einsum('gi,gij,gj->g', betas, ztz, betas)
+        sig2 = np.clip(utu, 0, None) / n_obs
+        with np.errstate(divide='ignore', invalid='ignore'):
+            se = np.sqrt(np.diagonal(varb, axis1=1, axis2=2) * sig2[:, np.newaxis])
+            z_stat = betas / se
+        p_val = norm.sf(np.abs(z_stat)) * 2
+        return betas, z_stat, p_val
@@ -11,7 +11,6 @@ change log:
     2021/06/20 adjust for restructure base class . by: qindanhua.
 """
 
-import pandas as pd
 from ..core.tool_base import ToolBase
 
 
@@ -30,9 +29,8 @@ class SpatialPatternScore(ToolBase):
         """
         run
         """
-        self.data.sparse2array()
-        df = pd.DataFrame(self.data.exp_matrix, columns=self.data.gene_names, index=self.data.cell_names)
-        result = self.get_func_by_path('stereo.algorithm.spatial_pattern_score', 'spatial_pattern_score')(df)
+        result = self.get_func_by_path('stereo.algorithm.spatial_pattern_score', 'spatial_pattern_score')(
+            self.data.exp_matrix, gene_names=self.data.gene_names)
         self.result = result
 
     def plot(self):
@@ -15,22 +15,11 @@ from typing import Optional, Union
 from ..core.stereo_exp_data import StereoExpData
 from typing import Optional, Iterable
 from datetime import datetime
+from functools import reduce
 from stereo.core.cell import Cell
 from stereo.core.gene import Gene
 
 
-def select_group(st_data, groups, cluster):
-    all_groups = set(cluster['group'].values)
-    groups = [groups] if isinstance(groups, str) else groups
-    for g in groups:
-        if g not in all_groups:
-            raise ValueError(f"cluster {g} is not in all cluster.")
-    group_index = cluster['group'].isin(groups)
-    # exp_matrix = st_data.exp_matrix.toarray() if sp.issparse(st_data.exp_matrix) else st_data.exp_matrix
-    group_sub = st_data.exp_matrix[group_index]
-    return group_sub, group_index
-
-
 def get_cluster_res(adata, data_key='clustering'):
     cluster_data = adata.uns[data_key].cluster
     cluster = cluster_data['cluster'].astype(str).astype('category').values
@@ -71,7 +60,9 @@ def merge(data1: StereoExpData = None,
           data2: StereoExpData = None, 
           *args, 
           reorganize_coordinate: Union[bool,int]=2,
-          coordinate_offset_additional: Union[bool,int]=0):
+          coordinate_offset_additional: Union[bool,int]=0,
+          var_type: str = 'intersect',
+          lazy: bool = False):
     """
     Merge two or more batches of data.
 
@@ -89,77 +80,93 @@ def merge(data1: StereoExpData = None,
     :param coordinate_offset_additional: the offset value on up/down/left/right 
         after reorganizing the coordinates, between a pair of adjacent datas, for example, data1 & data2, 
         data1 & data3, data2 & data4, ... which would be ignored if set to `False`.
+    :param var_type: `'intersect'` to keep the genes shared by all datas, `'union'` to keep the genes of any data,
+        the expression of a gene missing in a data is 0.
+    :param lazy: keep the expression matrices of datas as row blocks of a `LazyExpMatrix` rather than
+        copying them into a new matrix.
 
     :return: A merged StereoExpData object.
     """
     assert data1 is not None, 'the first parameter `data1` must be input'
     if data2 is None:
         return data1
+    if var_type not in ('intersect', 'union'):
+        raise Exception("var_type must be 'intersect' or 'union'.")
     datas = [data1, data2]
     if len(args) > 0:
         datas.extend(args)
     data_count = len(datas)
     new_data = StereoExpData(merged=True)
     new_data.sn = {}
+
+    for i, data in enumerate(datas):
+        data.cells.batch = i
+        data.array2sparse()
+        new_data.sn[str(i)] = data.sn
+
+    # the genes and the columns of each data in the merged matrix
+    gene_names_list = [np.asarray(data.gene_names) for data in datas]
+    if var_type == 'intersect':
+        gene_names = reduce(np.intersect1d, gene_names_list)
+    else:
+        gene_names = reduce(np.union1d, gene_names_list)
+    col_maps = [pd.Index(gene_names).get_indexer(names) for names in gene_names_list]
+    exp_matrices = [sp.csr_matrix(data.exp_matrix) for data in datas]
+    if lazy:
+        from ..core.lazy_matrix import LazyExpMatrix, RowBlocksSource
+        new_data.exp_matrix = LazyExpMatrix(RowBlocksSource(exp_matrices, col_maps, gene_names.size))
+    else:
+        new_data.exp_matrix = _stack_csr_with_col_maps(exp_matrices, col_maps, gene_names.size)
+
+    new_data.cells = Cell(
+        cell_name=np.concatenate([np.char.add(data.cells.cell_name.astype('U'), f'-{i}')
+                                  for i, data in enumerate(datas)]),
+        cell_border=np.concatenate([data.cells.cell_boder for data in datas])
+        if all(data.cells.cell_boder is not None for data in datas) else None,
+        batch=np.concatenate([data.cells.batch for data in datas])
+    )
+    new_data.genes = Gene(gene_name=gene_names)
+    new_data.position = np.concatenate([data.position for data in datas])
+    new_data.bin_type = data1.bin_type
+    new_data.bin_size = data1.bin_size
+    new_data.offset_x = data1.offset_x
+    new_data.offset_y = data1.offset_y
+    new_data.attr = data1.attr
+    attr_merged = False
+    for data in datas[1:]:
+        if new_data.offset_x is not None and data.offset_x is not None:
+            new_data.offset_x = min(new_data.offset_x, data.offset_x)
+        if new_data.offset_y is not None and data.offset_y is not None:
+            new_data.offset_y = min(new_data.offset_y, data.offset_y)
+        if new_data.attr is not None and data.attr is not None:
+            new_data.attr = {
+                'minX': min(new_data.attr['minX'], data.attr['minX']),
+                'minY': min(new_data.attr['minY'], data.attr['minY']),
+                'maxX': max(new_data.attr['maxX'], data.attr['maxX']),
+                'maxY': max(new_data.attr['maxY'], data.attr['maxY']),
+            }
+            attr_merged = True
+    if attr_merged:
+        new_data.attr['minExp'] = new_data.exp_matrix.min()
+        new_data.attr['maxExp'] = new_data.exp_matrix.max()
+        new_data.attr['resolution'] = 0
+
     if reorganize_coordinate:
         from math import ceil
         position_row_count = ceil(data_count / reorganize_coordinate)
         position_column_count = reorganize_coordinate
         max_xs = [0] * (position_column_count + 1)
         max_ys = [0] * (position_row_count + 1)
-    for i in range(data_count):
-        data: StereoExpData = datas[i]
-        data.cells.batch = i
-        cell_names = np.array([f"{cell_name}-{i}" for cell_name in data.cells.cell_name])
-        data.array2sparse()
-        new_data.sn[str(i)] = data.sn
-        if i == 0:
-            new_data.exp_matrix = data.exp_matrix.copy()
-            new_data.cells = Cell(cell_name=cell_names, cell_border=data.cells.cell_boder, batch=data.cells.batch)
-            new_data.genes = Gene(gene_name=data.gene_names)
-            new_data.position = data.position
-            new_data.bin_type = data.bin_type
-            new_data.bin_size = data.bin_size
-            new_data.offset_x = data.offset_x
-            new_data.offset_y = data.offset_y
-            new_data.attr = data.attr
-        else:
-            new_data.cells.cell_name = np.concatenate([new_data.cells.cell_name, cell_names])
-            new_data.cells.batch = np.concatenate([new_data.cells.batch, data.cells.batch])
-            if new_data.cell_borders is not None and data.cell_borders is not None:
-                new_data.cells.cell_boder = np.concatenate([new_data.cells.cell_boder, data.cells.cell_boder])
-            new_data.position = np.concatenate([new_data.position, data.position])
-            new_data.genes.gene_name, ind1, ind2 = np.intersect1d(new_data.genes.gene_name, data.genes.gene_name, return_indices=True)
-            new_data.exp_matrix = sp.vstack([new_data.exp_matrix[:, ind1], data.exp_matrix[:, ind2]])
-            if new_data.offset_x is not None and data.offset_x is not None:
-                new_data.offset_x = min(new_data.offset_x, data.offset_x)
-            if new_data.offset_y is not None and data.offset_y is not None:
-                new_data.offset_y = min(new_data.offset_y, data.offset_y)
-            if new_data.attr is not None and data.attr is not None:
-                new_data.attr = {
-                    'minX': min(new_data.attr['minX'], data.attr['minX']),
-                    'minY': min(new_data.attr['minY'], data.attr['minY']),
-                    'maxX': max(new_data.attr['maxX'], data.attr['maxX']),
-                    'maxY': max(new_data.attr['maxY'], data.attr['maxY']),
-                    'minExp': new_data.exp_matrix.min(),
-                    'maxExp': new_data.exp_matrix.min(),
-                    'resolution': 0,
-                }
-        if reorganize_coordinate:
+        for i, data in enumerate(datas):
             position_row_number = i // reorganize_coordinate
             position_column_number = i % reorganize_coordinate
-            max_x = data.position[:, 0].max()
-            max_y = data.position[:, 1].max()
-            if max_x > max_xs[position_column_number + 1]:
-                max_xs[position_column_number + 1] = max_x
-            if max_y > max_ys[position_row_number + 1]:
-                max_ys[position_row_number + 1] = max_y
-    if reorganize_coordinate:
+            max_xs[position_column_number + 1] = max(max_xs[position_column_number + 1], data.position[:, 0].max())
+            max_ys[position_row_number + 1] = max(max_ys[position_row_number + 1], data.position[:, 1].max())
         coordinate_offset_additional = 0 if coordinate_offset_additional < 0 else coordinate_offset_additional
-        batches = np.unique(new_data.cells.batch).tolist()
-        batches.sort(key=lambda x: int(x))
-        for i, bno in enumerate(batches):
-            idx = np.where(new_data.cells.batch == bno)[0]
+        cell_offsets = np.concatenate([[0], np.cumsum([data.cell_names.size for data in datas])])
+        new_data.position_offset = {}
+        for i in range(data_count):
+            bno = str(i)
             position_row_number = i // reorganize_coordinate
             position_column_number = i % reorganize_coordinate
             x_add = max_xs[position_column_number]
@@ -168,23 +175,121 @@ def merge(data1: StereoExpData = None,
                 x_add += sum(max_xs[0:position_column_number]) + coordinate_offset_additional * position_column_number
             if position_row_number > 0:
                 y_add += sum(max_ys[0:position_row_number]) + coordinate_offset_additional * position_row_number
-            # position_offset = np.repeat([[x_add, y_add]], repeats=len(idx), axis=0).astype(np.uint32)
             position_offset = np.array([x_add, y_add], dtype=np.uint32)
-            new_data.position[idx] += position_offset
-            if new_data.position_offset is None:
-                new_data.position_offset = {bno: position_offset}
-            else:
-                # new_data.position_offset = np.concatenate([new_data.position_offset, position_offset])
-                new_data.position_offset[bno] = position_offset
+            new_data.position[cell_offsets[i]:cell_offsets[i + 1]] += position_offset
+            new_data.position_offset[bno] = position_offset
 
     return new_data
 
 
-def split(data: StereoExpData = None):
+def _stack_csr_with_col_maps(matrices: list, col_maps: list, n_cols: int):
+    """
+    Stack csr matrices by rows into one preallocated csr matrix, mapping the columns of each matrix by its col_map,
+    the columns mapped to -1 are dropped.
+    """
+    masks = [col_map[m.indices] >= 0 for m, col_map in zip(matrices, col_maps)]
+    nnz = sum(int(mask.sum()) for mask in masks)
+    n_rows = sum(m.shape[0] for m in matrices)
+    dtype = np.result_type(*[m.dtype for m in matrices])
+    index_dtype = np.int64 if max(nnz, n_cols) > np.iinfo(np.int32).max else np.int32
+    data = np.empty(nnz, dtype=dtype)
+    indices = np.empty(nnz, dtype=index_dtype)
+    indptr = np.empty(n_rows + 1, dtype=index_dtype)
+    indptr[0] = 0
+    row_start, nnz_start = 0, 0
+    for m, col_map, mask in zip(matrices, col_maps, masks):
+        count = int(mask.sum())
+        data[nnz_start:nnz_start + count] = m.data[mask]
+        indices[nnz_start:nnz_start + count] = col_map[m.indices[mask]]
+        kept = np.concatenate([[0], np.cumsum(mask)])[m.indptr]
+        indptr[row_start + 1:row_start + m.shape[0] + 1] = kept[1:] + nnz_start
+        row_start += m.shape[0]
+        nnz_start += count
+    exp_matrix = sp.csr_matrix((data, indices, indptr), shape=(n_rows, n_cols))
+    exp_matrix.has_sorted_indices = False
+    exp_matrix.sort_indices()
+    return exp_matrix
+
+
+def _read_only(array: np.ndarray):
+    """
+    Get a read-only view of an array, so that writing into the memory shared with the merged data raises.
+    """
+    array = array.view()
+    array.flags.writeable = False
+    return array
+
+
+def _read_only_attrs(obj):
+    """
+    Replace the arrays of an object, such as `Cell` and `Gene`, with their read-only views.
+    """
+    for name, value in list(vars(obj).items()):
+        if isinstance(value, np.ndarray):
+            setattr(obj, name, _read_only(value))
+    return obj
+
+
+def _take_rows(matrix, rows):
+    """
+    Take the rows of a matrix, a slice of the rows of a csr_matrix or a dense array references the original memory
+    through read-only arrays, a slice of a dataframe is copied.
+    """
+    if isinstance(rows, slice) and sp.isspmatrix_csr(matrix):
+        start, stop = rows.start, rows.stop
+        lo, hi = matrix.indptr[start], matrix.indptr[stop]
+        # the constructor of csr_matrix copies the arrays which are small views, so they are assigned directly
+        sub_matrix = sp.csr_matrix((stop - start, matrix.shape[1]), dtype=matrix.dtype)
+        sub_matrix.data = _read_only(matrix.data[lo:hi])
+        sub_matrix.indices = _read_only(matrix.indices[lo:hi])
+        sub_matrix.indptr = (matrix.indptr[start:stop + 1] - lo).astype(matrix.indptr.dtype, copy=False)
+        return sub_matrix
+    if isinstance(matrix, pd.DataFrame):
+        return matrix.iloc[rows].copy() if isinstance(rows, slice) else matrix.iloc[rows]
+    if isinstance(rows, slice) and isinstance(matrix, np.ndarray):
+        return _read_only(matrix[rows])
+    return matrix[rows]
+
+
+def _as_rows(index: np.ndarray, view: bool):
+    """
+    Use a slice instead of the index array if the index covers a contiguous range, so that the rows can be viewed.
+    """
+    if view and index.size > 0 and index[-1] - index[0] + 1 == index.size and np.all(np.diff(index) == 1):
+        return slice(int(index[0]), int(index[-1]) + 1)
+    return index
+
+
+def _raw_view(raw: StereoExpData, cell_names: np.ndarray):
+    """
+    Get the cells of raw data, sharing the memory of raw data whenever they are contiguous in it.
+    """
+    from copy import copy
+    from ..preprocess.qc import cal_total_counts
+    raw_idx = pd.Index(raw.cell_names).get_indexer(cell_names)
+    # same as `filter_cells(cell_list=cell_names)`, the cells keep the order in raw data
+    raw_idx = np.sort(raw_idx[raw_idx >= 0])
+    rows = _as_rows(raw_idx, True)
+    raw_data = StereoExpData(bin_type=raw.bin_type, bin_size=raw.bin_size, cells=copy(raw.cells),
+                             genes=_read_only_attrs(copy(raw.genes)))
+    raw_data.cells = _read_only_attrs(raw_data.cells.sub_set(rows))
+    raw_data.exp_matrix = _take_rows(raw.exp_matrix, rows)
+    raw_data.position = _take_rows(raw.position, rows) if raw.position is not None else None
+    if raw_data.cells.total_counts is None:
+        raw_data.cells.total_counts = cal_total_counts(raw_data.exp_matrix)
+    return raw_data
+
+
+def split(data: StereoExpData = None, view: bool = False):
     """
     Split a data object which is merged from different batches of data, according to the batch number.
 
     :param data: a merged data object.
+    :param view: whether to reference the rows of each batch in the merged data instead of copying them,
+                the expression matrix, the cells, the genes and the raw data of each split data share memory
+                with the merged data whenever the cells of the batch are contiguous, these arrays are read-only
+                so that modifying them in place raises an error instead of changing the merged data,
+                which suits writing the split datas to files.
 
     :return: A split data list.
     """
@@ -192,20 +297,29 @@ def split(data: StereoExpData = None):
     if data is None:
         return None
 
-    from copy import deepcopy
+    from copy import copy, deepcopy
     from .pipeline_utils import cell_cluster_to_gene_exp_cluster
 
     all_data = []
     data.array2sparse()
-    batch = np.unique(data.cells.batch)
+    batch, batch_codes = np.unique(data.cells.batch, return_inverse=True)
+    batch_order = np.argsort(batch_codes, kind='stable')
+    batch_bounds = np.concatenate([[0], np.cumsum(np.bincount(batch_codes, minlength=batch.size))])
     result = data.tl.result
-    for bno in batch:
-        cell_idx = np.where(data.cells.batch == bno)[0]
-        cell_names = data.cell_names[cell_idx]
-        new_data = StereoExpData(bin_type=data.bin_type, bin_size=data.bin_size, cells=deepcopy(data.cells), genes=deepcopy(data.genes))
-        new_data.cells = new_data.cells.sub_set(cell_idx)
-        new_data.position = data.position[cell_idx] - data.position_offset[bno]
-        new_data.exp_matrix = data.exp_matrix[cell_idx]
+    for i, bno in enumerate(batch):
+        cell_idx = batch_order[batch_bounds[i]:batch_bounds[i + 1]]
+        rows = _as_rows(cell_idx, view)
+        cell_names = data.cell_names[rows]
+        if view:
+            new_data = StereoExpData(bin_type=data.bin_type, bin_size=data.bin_size, cells=copy(data.cells),
+                                     genes=_read_only_attrs(copy(data.genes)))
+            new_data.cells = _read_only_attrs(new_data.cells.sub_set(rows))
+        else:
+            new_data = StereoExpData(bin_type=data.bin_type, bin_size=data.bin_size, cells=deepcopy(data.cells),
+                                     genes=deepcopy(data.genes))
+            new_data.cells = new_data.cells.sub_set(rows)
+        new_data.position = data.position[rows] - data.position_offset[bno]
+        new_data.exp_matrix = _take_rows(data.exp_matrix, rows)
         new_data.tl.key_record = deepcopy(data.tl.key_record)
         new_data.sn = data.sn[bno]
         for key, all_res_key in data.tl.key_record.items():
@@ -216,18 +330,17 @@ def split(data: StereoExpData = None):
                     new_data.tl.result[res_key] = result[res_key]
             elif key in ['pca', 'cluster', 'umap']:
                 for res_key in all_res_key:
-                    new_data.tl.result[res_key] = result[res_key].iloc[cell_idx]
-                    new_data.tl.result[res_key].reset_index(drop=True, inplace=True)
+                    res = _take_rows(result[res_key], rows)
+                    res.reset_index(drop=True, inplace=True)
+                    new_data.tl.result[res_key] = res
             elif key == 'neighbors':
-                min_idx = cell_idx.min()
-                max_idx = cell_idx.max() + 1
                 for res_key in all_res_key:
                     connectivities = result[res_key]['connectivities']
                     nn_dist = result[res_key]['nn_dist']
                     new_data.tl.result[res_key] = {
                         'neighbor': result[res_key]['neighbor'],
-                        'connectivities': connectivities[min_idx:max_idx, min_idx:max_idx],
-                        'nn_dist': nn_dist[min_idx:max_idx, min_idx:max_idx]
+                        'connectivities': _take_rows(connectivities, rows)[:, rows],
+                        'nn_dist': _take_rows(nn_dist, rows)[:, rows]
                     }
             elif key == 'marker_genes':
                 for res_key in all_res_key:
@@ -254,7 +367,11 @@ def split(data: StereoExpData = None):
                 for res_key in all_res_key:
                     new_data.tl.result[res_key] = result[res_key]
         if data.tl.raw is not None:
-            new_data.tl.raw = data.tl.raw.tl.filter_cells(cell_list=cell_names, inplace=False)
+            if view:
+                # the setter of raw deep copies the data
+                new_data.tl._raw = _raw_view(data.tl.raw, cell_names)
+            else:
+                new_data.tl.raw = data.tl.raw.tl.filter_cells(cell_list=cell_names, inplace=False)
         if 'gene_exp_cluster' in data.tl.key_record:
             for cluster_res_key in data.tl.key_record['cluster']:
                 gene_exp_cluster_res = cell_cluster_to_gene_exp_cluster(new_data.tl, cluster_res_key)
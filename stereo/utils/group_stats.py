@@ -0,0 +1,124 @@
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, issparse
+
+from ..core.lazy_matrix import LazyExpMatrix
+
+
+class GroupStats(object):
+    """
+    Per-group statistics of all genes, the sparse one-hot indicator of the groups is built once and each statistic
+    is one product of the indicator with the (transformed) expression matrix, which is never sliced by groups.
+
+    Each statistic returns an array of shape (n_groups, n_genes) in the order of `categories`, or the pooled
+    statistic of the union of `groups` of shape (n_genes, ) when `groups` is given.
+
+    :param exp_matrix: the expression matrix, shape (n_cells, n_genes), ndarray, sparse matrix or `LazyExpMatrix`.
+    :param groups: the group of each cell, the cells whose group is NaN are left out.
+    """
+
+    def __init__(self, exp_matrix, groups: Sequence):
+        self.exp_matrix = exp_matrix
+        categorical = pd.Categorical(groups)
+        self._is_categorical = isinstance(getattr(groups, 'dtype', None), pd.CategoricalDtype)
+        self.categories = categorical.categories
+        self.codes = categorical.codes.astype(np.int64)
+        self.n_groups = self.categories.size
+        self.sizes = np.bincount(self.codes[self.codes >= 0], minlength=self.n_groups)
+        cells = np.flatnonzero(self.codes >= 0)
+        self.indicator = csr_matrix(
+            (np.ones(cells.size), (self.codes[cells], cells)), shape=(self.n_groups, self.codes.size)
+        )
+        self._sum = None
+        self._sum_sq = None
+        self._n_expressed = None
+
+    @property
+    def group_index(self) -> pd.Index:
+        """
+        the index of the groups named `'group'`, the same as the one of `groupby` on the groups.
+        """
+        if self._is_categorical:
+            return pd.CategoricalIndex(self.categories, categories=self.categories, name='group')
+        return pd.Index(self.categories, name='group')
+
+    def _product(self, transform):
+        x = self.exp_matrix
+        if isinstance(x, LazyExpMatrix):
+            if x.source.axis == 0:
+                result = np.zeros((self.n_groups, x.shape[1]))
+                for positions, block in x.iter_blocks():
+                    result += _to_dense(self.indicator[:, positions] @ transform(block))
+                return result
+            return np.hstack([_to_dense(self.indicator @ transform(block)) for _, block in x.iter_blocks()])
+        return _to_dense(self.indicator @ transform(x))
+
+    def get_codes(self, groups: Sequence) -> np.ndarray:
+        groups = [groups] if isinstance(groups, str) else groups
+        for g in groups:
+            if g not in self.categories:
+                raise ValueError(f"cluster {g} is not in all cluster.")
+        return self.categories.get_indexer(groups)
+
+    def _pool(self, values, groups):
+        if groups is None:
+            return values
+        return values[self.get_codes(groups)].sum(axis=0)
+
+    def size(self, groups: Optional[Sequence] = None):
+        return self._pool(self.sizes, groups)
+
+    def sum(self, groups: Optional[Sequence] = None):
+        if self._sum is None:
+            self._sum = self._product(lambda x: x)
+        return self._pool(self._sum, groups)
+
+    def sum_sq(self, groups: Optional[Sequence] = None):
+        if self._sum_sq is None:
+            self._sum_sq = self._product(lambda x: x.multiply(x) if issparse(x) else np.multiply(x, x))
+        return self._pool(self._sum_sq, groups)
+
+    def n_expressed(self, groups: Optional[Sequence] = None):
+        """
+        the number of cells expressing (greater than 0) each gene.
+        """
+        if self._n_expressed is None:
+            self._n_expressed = self._product(_expressed_indicator)
+        return self._pool(self._n_expressed, groups)
+
+    def mean(self, groups: Optional[Sequence] = None):
+        size = self.size(groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.sum(groups) / (size if groups is not None else size[:, None])
+
+    def pct(self, groups: Optional[Sequence] = None):
+        """
+        the fraction of cells expressing each gene.
+        """
+        size = self.size(groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.n_expressed(groups) / (size if groups is not None else size[:, None])
+
+    def var(self, groups: Optional[Sequence] = None):
+        """
+        the unbiased variance.
+        """
+        size = self.size(groups)
+        size = size if groups is not None else size[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.sum(groups) / size
+            return (self.sum_sq(groups) / size - mean ** 2) * size / (size - 1)
+
+
+def _to_dense(x):
+    return np.asarray(x.toarray() if issparse(x) else x, dtype=np.float64)
+
+
+def _expressed_indicator(x):
+    if issparse(x):
+        x = x.tocsr(copy=True)
+        x.data = (x.data > 0).astype(np.float64)
+        return x
+    return (x > 0).astype(np.float64)
@@ -11,6 +11,7 @@ import numpy as np
 from typing import Optional, Union, Tuple
 from functools import singledispatch
 from ..core.stereo_result import StereoResult
+from ..core.lazy_matrix import LazyExpMatrix
 from scipy.sparse import spmatrix, csr_matrix, issparse, csc_matrix
 import numba
 from ..log_manager import logger
@@ -42,6 +43,19 @@ def _(X, *, axis=0):
     return mean, var
 
 
+@get_mean_var.register(LazyExpMatrix)
+def _(X, *, axis=0):
+    # two block-wise passes over the file, the sums and the sums of squares
+    X = X.astype(np.float64)
+    n = X.shape[axis]
+    mean = np.asarray(X.sum(axis=axis)).ravel() / n
+    mean_sq = np.asarray(np.square(X).sum(axis=axis)).ravel() / n
+    var = mean_sq - mean ** 2
+    # enforce R convention (unbiased estimator) for variance
+    var *= n / (n - 1)
+    return mean, var
+
+
 def sparse_mean_variance_axis(mtx: spmatrix, axis: int):
     """
     This code and internal functions are based on sklearns
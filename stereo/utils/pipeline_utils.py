@@ -2,6 +2,7 @@ from typing import Sequence, Optional, Union
 import pandas as pd
 import numpy as np
 from stereo.log_manager import logger
+from stereo.utils.group_stats import GroupStats
 
 def cell_cluster_to_gene_exp_cluster(
     tl,
@@ -25,15 +26,7 @@ def cell_cluster_to_gene_exp_cluster(
         logger.warn(f"The cluster_res_key '{cluster_res_key}' is not exists")
         return False
 
-    cluster_result: pd.DataFrame = tl.result[cluster_res_key].copy()
-    cluster_result.reset_index(inplace=True)
-    cluster_result.sort_values(by=['group', 'index'], inplace=True)
-    group_index = cluster_result.groupby('group').agg(cell_index=('index', list))
-    if groups is not None:
-        if isinstance(groups, str):
-            groups = [groups]
-        group_index = group_index.loc[groups]
-    tmp = []
+    cluster_result: pd.DataFrame = tl.result[cluster_res_key]
     tl.raw.array2sparse()
     raw_cells_isin_data = np.isin(tl.raw.cell_names, tl.data.cell_names)
     raw_genes_isin_data = np.isin(tl.raw.gene_names, tl.data.gene_names)
@@ -46,14 +39,16 @@ def cell_cluster_to_gene_exp_cluster(
     exp_matrix = tl.raw.exp_matrix[raw_cells_isin_data][:, (raw_genes_isin_data & all_genes_isin)]
     gene_names = tl.raw.gene_names[(raw_genes_isin_data & all_genes_isin)]
 
-    if kind != 'mean':
-        kind = 'sum'
-    for _, cell_index in group_index.iterrows():
-        cell_index = cell_index.to_numpy()[0]
-        if kind == 'sum':
-            exp_tmp = exp_matrix[cell_index].sum(axis=0).A[0]
-        else:
-            exp_tmp = exp_matrix[cell_index].mean(axis=0).A[0]
-        tmp.append(exp_tmp)
-    cluster_exp_matrix = np.vstack(tmp)
-    return pd.DataFrame(cluster_exp_matrix, columns=gene_names, index=group_index.index).T
+    group_stats = GroupStats(exp_matrix, cluster_result['group'].values)
+    cluster_exp_matrix = group_stats.mean() if kind == 'mean' else group_stats.sum()
+    # keep the dtype of the sums and the means of the expression matrix
+    if exp_matrix.dtype.kind == 'f':
+        cluster_exp_matrix = cluster_exp_matrix.astype(exp_matrix.dtype)
+    elif kind != 'mean':
+        cluster_exp_matrix = np.rint(cluster_exp_matrix).astype(np.int64)
+    cluster_exp = pd.DataFrame(cluster_exp_matrix, columns=gene_names, index=group_stats.group_index)
+    if groups is not None:
+        if isinstance(groups, str):
+            groups = [groups]
+        cluster_exp = cluster_exp.loc[groups]
+    return cluster_exp.T
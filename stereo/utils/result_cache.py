@@ -0,0 +1,229 @@
+import os
+import pickle
+import hashlib
+import inspect
+from functools import wraps
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse
+
+from ..log_manager import logger
+from ..stereo_config import stereo_conf
+
+
+class ResultCache(object):
+    """
+    An on-disk cache of the results of pipeline steps, each entry is a pickle file named by its key in `cache_dir`,
+    the least recently used entries are evicted when the total size exceeds `max_size`.
+
+    :param cache_dir: the directory to store the entries.
+    :param max_size: the maximum size in bytes of all the entries.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key: str):
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+    def get(self, key: str):
+        """
+        get the entry of the key, `None` if it is not in the cache.
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except Exception as e:
+            logger.warning(f'failed to load the result cache {path}, {e}')
+            self._remove(path)
+            self.misses += 1
+            return None
+        # the modification time is the last access time of the entry
+        os.utime(path)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value):
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f'failed to save the result cache {path}, {e}')
+            self._remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        remove the least recently used entries until the total size is not larger than `max_size`.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pkl'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            self._remove(path)
+            total_size -= size
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                self._remove(os.path.join(self.cache_dir, name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_result_cache = None
+
+
+def get_result_cache():
+    """
+    get the result cache set by `stereo_conf.cache_dir`, `None` if the cache is disabled.
+    """
+    global _result_cache
+    if stereo_conf.cache_dir is None:
+        return None
+    if _result_cache is None or _result_cache.cache_dir != os.path.abspath(stereo_conf.cache_dir):
+        _result_cache = ResultCache(stereo_conf.cache_dir, stereo_conf.cache_max_size)
+    _result_cache.max_size = stereo_conf.cache_max_size
+    return _result_cache
+
+
+def _update_array(h, array: np.ndarray):
+    h.update(np.ascontiguousarray(array).reshape(-1).view(np.uint8))
+
+
+def _update_hash(h, obj):
+    from ..core.lazy_matrix import LazyExpMatrix
+    if obj is None:
+        h.update(b'None')
+    elif isinstance(obj, LazyExpMatrix):
+        file_path = obj.source.file_path
+        if file_path is None:
+            _update_hash(h, obj.tocsr())
+        else:
+            _update_hash(h, (file_path, os.path.getmtime(file_path), getattr(obj.source, 'key', None),
+                             obj._rows, obj._cols, obj._ops, str(obj.dtype)))
+    elif issparse(obj):
+        obj = obj if obj.format in ('csr', 'csc') else obj.tocsr()
+        h.update(f'{obj.format}{obj.shape}{obj.dtype}'.encode())
+        for array in (obj.data, obj.indices, obj.indptr):
+            _update_array(h, array)
+    elif isinstance(obj, np.ndarray):
+        h.update(f'{obj.shape}{obj.dtype}'.encode())
+        if obj.dtype.kind == 'O':
+            h.update('\0'.join(map(str, obj.ravel())).encode())
+        else:
+            _update_array(h, obj)
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        h.update(repr(obj.columns.tolist() if isinstance(obj, pd.DataFrame) else obj.name).encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).values)
+    elif isinstance(obj, dict):
+        for key in sorted(obj.keys(), key=str):
+            h.update(str(key).encode())
+            _update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(f'{type(obj).__name__}{len(obj)}'.encode())
+        for item in obj:
+            _update_hash(h, item)
+    elif hasattr(obj, '__dict__') and not callable(obj):
+        # such as the `Neighbors` of the neighbors result, whose repr is the address of the object
+        h.update(type(obj).__name__.encode())
+        _update_hash(h, vars(obj))
+    else:
+        h.update(f'{type(obj).__name__}:{obj!r}'.encode())
+
+
+def _data_fingerprint(h, data):
+    _update_hash(h, data.exp_matrix)
+    _update_hash(h, data.cell_names)
+    _update_hash(h, data.gene_names)
+
+
+def cache_result(bypass_args: tuple = ()):
+    """
+    Cache the result of a method of `StPipeline` in the directory set by `stereo_conf.cache_dir`.
+
+    The key of the cache is the fingerprint of the expression matrix, the cells and genes, the results referenced
+    by the arguments, the raw data if there is one and the other arguments, the results stored to
+    `res_key` (and `gene_exp_{res_key}` of clustering) are restored from the cache when the key is hit.
+
+    :param bypass_args: the arguments which cause side effects other than the results, such as writing files,
+                        the cache is bypassed when any of them is not `None`.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        ignored_args = {list(signature.parameters)[0], 'n_jobs'}
+
+        @wraps(func)
+        def wrapped(pipeline, *args, **kwargs):
+            cache = get_result_cache()
+            if cache is None:
+                return func(pipeline, *args, **kwargs)
+            bound = signature.bind(pipeline, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = {name: value for name, value in bound.arguments.items() if name not in ignored_args}
+            if any(arguments.get(name) is not None for name in bypass_args):
+                return func(pipeline, *args, **kwargs)
+
+            h = hashlib.blake2b(digest_size=20)
+            _update_hash(h, (func.__qualname__, arguments))
+            _data_fingerprint(h, pipeline.data)
+            for name, value in arguments.items():
+                if name != 'res_key' and isinstance(value, str) and value in pipeline.result:
+                    h.update(value.encode())
+                    _update_hash(h, pipeline.result[value])
+            # the clusterings and the marker genes read the raw data whatever `use_raw` is
+            if pipeline.raw is not None:
+                _data_fingerprint(h, pipeline.raw)
+            key = h.hexdigest()
+
+            cached = cache.get(key)
+            if cached is not None:
+                results, records, res = cached
+                for res_key, value in results.items():
+                    pipeline.result[res_key] = value
+                for record_key, res_key in records:
+                    pipeline.reset_key_record(record_key, res_key)
+                logger.info(f'{func.__name__} hit the result cache, hits: {cache.hits}, misses: {cache.misses}.')
+                return res
+
+            logger.info(f'{func.__name__} missed the result cache, hits: {cache.hits}, misses: {cache.misses}.')
+            res = func(pipeline, *args, **kwargs)
+            res_keys = {arguments['res_key'], f"gene_exp_{arguments['res_key']}"}
+            records = [(record_key, res_key) for record_key, record in pipeline.key_record.items()
+                       for res_key in record if res_key in res_keys]
+            results = {res_key: pipeline.result[res_key] for _, res_key in records}
+            cache.put(key, (results, records, res))
+            return res
+
+        return wrapped
+
+    return decorator
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import random as sparse_random
+
+from stereo.core.stereo_exp_data import StereoExpData
+
+
+def make_data(seed, n_cells=200, n_genes=50, density=0.1, n_pcs=10, cell_prefix='cell'):
+    """
+    A StereoExpData of random counts with the raw data, a pca result and a leiden result.
+    """
+    rng = np.random.default_rng(seed)
+    exp_matrix = sparse_random(n_cells, n_genes, density=density, format='csr', random_state=seed)
+    exp_matrix.data = np.ceil(exp_matrix.data * 10).astype(np.float32)
+    data = StereoExpData(
+        exp_matrix=exp_matrix,
+        cells=np.array([f'{cell_prefix}_{i}' for i in range(n_cells)]),
+        genes=np.array([f'gene_{i}' for i in range(n_genes)]),
+        position=rng.integers(0, 10000, size=(n_cells, 2)).astype(np.uint32),
+        bin_type='bins',
+    )
+    data.tl.raw_checkpoint()
+    data.tl.result['pca'] = pd.DataFrame(rng.random((n_cells, n_pcs)))
+    data.tl.key_record['pca'] = ['pca']
+    data.tl.result['leiden'] = pd.DataFrame({
+        'bins': data.cell_names,
+        'group': pd.Categorical(rng.integers(0, 4, n_cells).astype(str))
+    })
+    data.tl.key_record['cluster'] = ['leiden']
+    return data
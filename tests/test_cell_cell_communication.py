@@ -0,0 +1,76 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from stereo.algorithm.cell_cell_communication.main import CellCellCommunication
+
+
+class TestShuffledAnalysis(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(1)
+        n_genes, n_cells = 120, 600
+        values = (rng.random((n_genes, n_cells)) < 0.2) * rng.poisson(3, (n_genes, n_cells))
+        self.counts = pd.DataFrame(values.astype(np.float32), index=np.arange(n_genes) + 10,
+                                   columns=[f'cell_{i}' for i in range(n_cells)])
+        self.meta = pd.DataFrame({'cell_type': rng.choice(['a', 'b', 'c', 'd'], n_cells)}, index=self.counts.columns)
+        self.complex_composition = pd.DataFrame({
+            'complex_multidata_id': [1000, 1000, 1001, 1001, 1001],
+            'protein_multidata_id': [10, 11, 12, 13, 14],
+        })
+        multidata_ids = list(self.counts.index) + [1000, 1001]
+        self.interactions = pd.DataFrame({
+            'multidata_1_id': rng.choice(multidata_ids, 80),
+            'multidata_2_id': rng.choice(multidata_ids, 80),
+        })
+        # the methods used here do not touch the database
+        self.ccc = CellCellCommunication.__new__(CellCellCommunication)
+
+    def baseline_pvalues(self, cluster_interactions, real_mean_analysis, real_percents_analysis, labels):
+        """
+        The p-values of the per-shuffle implementation, one `build_clusters` and `mean_analysis` per shuffle.
+        """
+        cluster_names = pd.Categorical(self.meta['cell_type']).categories
+        exceed = np.zeros(real_mean_analysis.shape)
+        for shuffled_labels in labels:
+            shuffled_meta = self.meta.copy()
+            shuffled_meta['cell_type'] = cluster_names[shuffled_labels]
+            shuffled_clusters = self.ccc.build_clusters(shuffled_meta, self.counts, self.complex_composition,
+                                                        skip_percent=True)
+            shuffled_mean_analysis = self.ccc.mean_analysis(self.interactions, shuffled_clusters,
+                                                            cluster_interactions, '|')
+            exceed += shuffled_mean_analysis.values > real_mean_analysis.values
+        percent_result = exceed / len(labels)
+        percent_result[(real_mean_analysis.values == 0) | (real_percents_analysis.values == 0)] = 1
+        return percent_result
+
+    def test_pvalues(self):
+        iterations = 60
+        clusters = self.ccc.build_clusters(self.meta, self.counts, self.complex_composition, skip_percent=False)
+        cluster_interactions = self.ccc.get_cluster_combinations(clusters['names'])
+        real_mean_analysis = self.ccc.mean_analysis(self.interactions, clusters, cluster_interactions, '|')
+        real_percents_analysis = self.ccc.percent_analysis(clusters, 0.1, self.interactions, cluster_interactions,
+                                                           '|')
+
+        np.random.seed(0)
+        statistical_mean_analysis = self.ccc.shuffled_analysis(iterations, self.meta, self.counts, self.interactions,
+                                                               cluster_interactions, self.complex_composition, 2)
+        pvalues = self.ccc.build_pvalue_result(real_mean_analysis, real_percents_analysis,
+                                               statistical_mean_analysis, real_mean_analysis)
+        self.assertEqual(list(pvalues.columns), list(real_mean_analysis.columns))
+
+        # the small input is shuffled in one batch, whose seed is drawn from the global random state
+        np.random.seed(0)
+        seed = np.random.randint(0, np.iinfo(np.int32).max, size=1)[0]
+        rng = np.random.default_rng(seed)
+        codes = pd.Categorical(self.meta['cell_type']).codes.astype(np.int64)
+        labels = [rng.permutation(codes) for _ in range(iterations)]
+        expected = self.baseline_pvalues(cluster_interactions, real_mean_analysis, real_percents_analysis, labels)
+        np.testing.assert_allclose(pvalues.values, expected)
+
+        # the same seed gives the same p-values with another number of threads
+        np.random.seed(0)
+        other = self.ccc.shuffled_analysis(iterations, self.meta, self.counts, self.interactions,
+                                           cluster_interactions, self.complex_composition, 1)
+        np.testing.assert_array_equal(other, statistical_mean_analysis)
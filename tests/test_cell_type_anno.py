@@ -0,0 +1,179 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.sparse import csr_matrix
+
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.tools.cell_type_anno import CellTypeAnno, load_reference, random_choose_genes
+
+
+class TestRandomChooseGenes(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        x = rng.poisson(2, size=(300, 40)).astype(np.float64)
+        x[rng.random(x.shape) < 0.6] = 0
+        # an empty cell, a cell of a single gene and a cell whose sampled count is 0
+        x[0] = 0
+        x[1] = 0
+        x[1, 5] = 7
+        x[2] = 0
+        x[2, 3] = 1
+        self.x = x
+
+    def test_counts(self):
+        sample_rate = 0.8
+        mat = csr_matrix(self.x)
+        sampled = random_choose_genes(mat, sample_rate, np.random.RandomState(0))
+        np.testing.assert_array_equal(mat.toarray(), self.x)
+        sampled = sampled.toarray()
+        np.testing.assert_array_equal(sampled.sum(axis=1), np.int32(self.x.sum(axis=1) * sample_rate))
+        self.assertTrue((sampled >= 0).all())
+        self.assertFalse(((sampled > 0) & (self.x == 0)).any())
+        np.testing.assert_array_equal(
+            random_choose_genes(mat, sample_rate, np.random.RandomState(0)).toarray(), sampled
+        )
+
+    def test_proportions(self):
+        # the mean of the draws is the multinomial mean of each cell
+        sample_rate, n_draws = 0.5, 2000
+        x = self.x[:20]
+        mat = csr_matrix(x)
+        random_state = np.random.RandomState(1)
+        total = sum(random_choose_genes(mat, sample_rate, random_state).toarray() for _ in range(n_draws))
+        sample_cnt = np.int32(x.sum(axis=1) * sample_rate)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p = np.nan_to_num(x / x.sum(axis=1)[:, None])
+        expected = sample_cnt[:, None] * p
+        std = np.sqrt(sample_cnt[:, None] * p * (1 - p) / n_draws)
+        self.assertTrue((np.abs(total / n_draws - expected) <= 5 * std + 1e-12).all())
+
+
+class TestCellTypeAnno(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        n_types, n_markers, n_ref_genes = 3, 15, 60
+        ref_genes = np.array([f'gene_{i}' for i in range(n_ref_genes)])
+        self.cell_types = np.array([f'type_{t}' for t in range(n_types)])
+        profiles = rng.uniform(1, 5, size=(n_types, n_ref_genes))
+        for t in range(n_types):
+            profiles[t, t * n_markers:(t + 1) * n_markers] *= 20
+        samples, ref_types, ref_values = [], [], []
+        for t in range(n_types):
+            for s in range(4):
+                samples.append(f'sample_{t}_{s}')
+                ref_types.append(self.cell_types[t])
+                ref_values.append(profiles[t] * rng.uniform(0.8, 1.2, n_ref_genes))
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        pd.DataFrame(np.array(ref_values).T, index=ref_genes, columns=samples).to_csv(
+            os.path.join(self.tmp_dir.name, 'ref_sample_epx.csv'))
+        pd.DataFrame({'cell type': ref_types}, index=pd.Index(samples, name='sample')).to_csv(
+            os.path.join(self.tmp_dir.name, 'cell_map.csv'))
+
+        # the data misses some genes of the reference and has others, in another order
+        n_cells = 90
+        self.true_types = rng.integers(0, n_types, n_cells)
+        gene_index = rng.permutation(np.arange(5, n_ref_genes))
+        rates = profiles[self.true_types][:, gene_index] / 4
+        x = np.hstack([rng.poisson(rates), rng.poisson(1, size=(n_cells, 8))]).astype(np.float64)
+        genes = np.concatenate([ref_genes[gene_index], [f'other_{i}' for i in range(8)]])
+        self.data = StereoExpData(
+            exp_matrix=csr_matrix(x),
+            cells=np.array([f'cell_{i}' for i in range(n_cells)]),
+            genes=genes,
+            position=np.zeros((n_cells, 2), dtype=np.uint32),
+            bin_type='bins',
+        )
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def baseline(self, method, n_estimators, sample_rate, seed):
+        """
+        The per-cell implementation, a dense correlation of each sampled cell with each reference sample and the
+        predictions merged by `groupby`.
+        """
+        ref = pd.read_csv(os.path.join(self.tmp_dir.name, 'ref_sample_epx.csv'), index_col=0)
+        cell_map = pd.read_csv(os.path.join(self.tmp_dir.name, 'cell_map.csv'), index_col=0)
+        np.random.seed(seed)
+        seeds = np.random.randint(np.iinfo(np.int32).max, size=(1, n_estimators))[0]
+        mat = self.data.exp_matrix
+        predictions = []
+        for i in range(n_estimators):
+            sampled = random_choose_genes(mat, sample_rate, np.random.RandomState(seeds[i])).toarray()
+            sampled = np.log1p(sampled * 10000 / sampled.sum(axis=1)[:, None])
+            exp = pd.DataFrame(sampled, columns=self.data.gene_names).reindex(columns=ref.index, fill_value=0)
+            corr_method = 'spearman' if method == 'spearmanr' else 'pearson'
+            for cell, values in zip(self.data.cell_names, exp.values):
+                corr = ref.corrwith(pd.Series(values, index=ref.index), method=corr_method).fillna(0)
+                predictions.append((cell, cell_map.loc[corr.idxmax(), 'cell type'], corr.max()))
+        df = pd.DataFrame(predictions, columns=['cell', 'cell type', 'corr_score'])
+        type_cnt = df.groupby(['cell', 'cell type']).count()[['corr_score']]
+        type_cnt['type_rate'] = type_cnt / n_estimators
+        type_cnt.columns = ['type_cnt', 'type_rate']
+        type_cnt.reset_index(inplace=True)
+        score_mean = df.groupby(['cell', 'cell type'])[['corr_score']].mean()
+        score_mean.columns = ['score_mean']
+        score_mean.reset_index(inplace=True)
+        df = score_mean.merge(type_cnt, on=['cell', 'cell type'])
+        return df[(df.groupby('cell')['type_cnt'].transform('max') == df['type_cnt']) & (
+                df.groupby('cell')['score_mean'].transform('max') == df['score_mean'])]
+
+    def test_fit(self):
+        n_estimators, sample_rate = 5, 0.8
+        for method in ('spearmanr', 'pearson'):
+            with self.subTest(method=method):
+                cta = CellTypeAnno(self.data, method=method, ref_dir=self.tmp_dir.name, n_estimators=n_estimators,
+                                   sample_rate=sample_rate, strategy=1)
+                np.random.seed(0)
+                result = cta.fit().reset_index(drop=True)
+                expected = self.baseline(method, n_estimators, sample_rate, 0).reset_index(drop=True)
+                self.assertEqual(list(result['cell']), list(expected['cell']))
+                self.assertEqual(list(result['cell type']), list(expected['cell type']))
+                np.testing.assert_array_equal(result['type_cnt'], expected['type_cnt'])
+                np.testing.assert_allclose(result['score_mean'], expected['score_mean'], rtol=1e-5)
+                np.testing.assert_allclose(result['type_rate'], expected['type_rate'])
+                true_types = pd.Series(self.cell_types[self.true_types], index=self.data.cell_names)
+                self.assertEqual(list(result['cell type']), list(true_types[result['cell']]))
+
+                # the same seed gives the same result with threads and batches
+                cta = CellTypeAnno(self.data, method=method, ref_dir=self.tmp_dir.name, n_estimators=n_estimators,
+                                   sample_rate=sample_rate, strategy=1, cores=2, batch_size=1000)
+                np.random.seed(0)
+                pd.testing.assert_frame_equal(cta.fit().reset_index(drop=True), result)
+
+    def test_merge_subsample_result(self):
+        rng = np.random.default_rng(2)
+        n_estimators, n_cells = 7, 40
+        cells = np.tile([f'cell_{i}' for i in range(n_cells)], n_estimators)
+        cell_types = rng.choice(self.cell_types, cells.size)
+        # few distinct scores make ties of the mean score
+        scores = rng.integers(0, 3, cells.size) / 2
+        cta = CellTypeAnno(self.data, ref_dir=self.tmp_dir.name, n_estimators=n_estimators)
+        result = cta.merge_subsample_result(cells, cell_types, scores)
+        df = pd.DataFrame({'cell': cells, 'cell type': cell_types, 'corr_score': scores})
+        grouped = df.groupby(['cell', 'cell type'])['corr_score']
+        expected = pd.DataFrame({'score_mean': grouped.mean(), 'type_cnt': grouped.count()}).reset_index()
+        expected['type_rate'] = expected['type_cnt'] / n_estimators
+        pd.testing.assert_frame_equal(cta.all_result, expected[cta.all_result.columns], check_dtype=False)
+        expected = expected[(expected.groupby('cell')['type_cnt'].transform('max') == expected['type_cnt']) & (
+                expected.groupby('cell')['score_mean'].transform('max') == expected['score_mean'])]
+        pd.testing.assert_frame_equal(result, expected[result.columns], check_dtype=False)
+
+    def test_model_cache(self):
+        ref = load_reference(self.tmp_dir.name)
+        model = ref.model('spearmanr', ref.genes)
+        self.assertIs(ref.model('spearmanr', ref.genes.copy()), model)
+        self.assertFalse(model.flags.writeable)
+        for i in range(10):
+            ref.model('pearson', ref.genes[i:])
+        self.assertLessEqual(ref._cached_model.cache_info().currsize, 4)
+        self.assertIsNot(ref.model('spearmanr', ref.genes), model)
+        ranks = stats.rankdata(ref.values, axis=0)
+        ranks = (ranks - ranks.mean(axis=0)) / np.linalg.norm(ranks - ranks.mean(axis=0), axis=0)
+        np.testing.assert_allclose(model, ranks)
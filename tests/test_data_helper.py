@@ -0,0 +1,124 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import random as sparse_random
+
+from stereo.core.lazy_matrix import LazyExpMatrix
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.utils.data_helper import merge, split
+
+
+class TestSplit(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        data_list = []
+        for i, n_cells in enumerate((50, 80, 30)):
+            exp_matrix = sparse_random(n_cells, 40, density=0.2, format='csr', random_state=i)
+            exp_matrix.data = np.ceil(exp_matrix.data * 10)
+            data_list.append(StereoExpData(
+                exp_matrix=exp_matrix,
+                cells=np.array([f'cell_{j}' for j in range(n_cells)]),
+                genes=np.array([f'gene_{j}' for j in range(40)]),
+                position=rng.integers(0, 100, size=(n_cells, 2)),
+                bin_type='bins',
+            ))
+        self.merged = merge(*data_list)
+        self.merged.tl.raw_checkpoint()
+        self.merged.tl.result['pca'] = pd.DataFrame(rng.random((self.merged.shape[0], 5)))
+        self.merged.tl.key_record['pca'] = ['pca']
+
+    def test_view(self):
+        copies = split(self.merged)
+        views = split(self.merged, view=True)
+        self.assertEqual(len(views), 3)
+        for copied, viewed in zip(copies, views):
+            self.assertTrue((copied.cell_names == viewed.cell_names).all())
+            self.assertTrue((copied.position == viewed.position).all())
+            self.assertEqual(abs(copied.exp_matrix - viewed.exp_matrix).max(), 0)
+            self.assertEqual(abs(copied.tl.raw.exp_matrix - viewed.tl.raw.exp_matrix).max(), 0)
+            self.assertTrue(copied.tl.result['pca'].equals(viewed.tl.result['pca']))
+
+        viewed = views[1]
+        self.assertTrue(np.shares_memory(viewed.exp_matrix.data, self.merged.exp_matrix.data))
+        for array in (viewed.exp_matrix.data, viewed.cells.cell_name, viewed.genes.gene_name,
+                      viewed.tl.raw.exp_matrix.data):
+            with self.assertRaises(ValueError):
+                array[0] = array[0]
+        # the merged data is still writable and the dataframes of results are copied
+        self.merged.exp_matrix.data[0] = self.merged.exp_matrix.data[0]
+        viewed.tl.result['pca'].iloc[0, 0] = -1
+        self.assertNotEqual(self.merged.tl.result['pca'].iloc[50, 0], -1)
+
+
+class TestMerge(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        self.data_list = []
+        # partly overlapping gene sets in different orders
+        for i, (n_cells, genes) in enumerate(((50, range(0, 30)), (80, range(10, 45)), (30, range(5, 35)))):
+            gene_names = rng.permutation([f'gene_{j}' for j in genes])
+            exp_matrix = sparse_random(n_cells, gene_names.size, density=0.2, format='csr', random_state=i)
+            exp_matrix.data = np.ceil(exp_matrix.data * 10 * (i + 1))
+            data = StereoExpData(
+                exp_matrix=exp_matrix,
+                cells=np.array([f'cell_{j}' for j in range(n_cells)]),
+                genes=gene_names,
+                position=rng.integers(0, 100, size=(n_cells, 2)),
+                bin_type='bins',
+            )
+            data.attr = {'minX': 10 * i, 'minY': 20 - i, 'maxX': 100 + i, 'maxY': 90 + 5 * i,
+                         'minExp': 0, 'maxExp': data.exp_matrix.max(), 'resolution': 500}
+            self.data_list.append(data)
+        self.expected = [
+            pd.DataFrame(data.exp_matrix.toarray(), index=np.char.add(data.cell_names.astype('U'), f'-{i}'),
+                         columns=data.gene_names)
+            for i, data in enumerate(self.data_list)
+        ]
+
+    def assertMergedEqual(self, merged, expected):
+        self.assertEqual(list(merged.gene_names), sorted(expected.columns))
+        expected = expected[merged.gene_names]
+        self.assertEqual(list(merged.cell_names), list(expected.index))
+        np.testing.assert_array_equal(merged.exp_matrix.toarray(), expected.values)
+        np.testing.assert_array_equal(merged.cells.batch.astype(int),
+                                      np.repeat(np.arange(3), [data.shape[0] for data in self.data_list]))
+        np.testing.assert_array_equal(merged.position, np.concatenate([data.position for data in self.data_list]))
+        self.assertEqual(merged.attr['minX'], 0)
+        self.assertEqual(merged.attr['minY'], 18)
+        self.assertEqual(merged.attr['maxX'], 102)
+        self.assertEqual(merged.attr['maxY'], 100)
+        self.assertEqual(merged.attr['minExp'], expected.values.min())
+        self.assertEqual(merged.attr['maxExp'], expected.values.max())
+
+    def test_union(self):
+        merged = merge(*self.data_list, reorganize_coordinate=False, var_type='union')
+        expected = pd.concat(self.expected).fillna(0)
+        self.assertEqual(merged.exp_matrix.shape, (160, 45))
+        self.assertMergedEqual(merged, expected)
+        # the maximum expression is taken over all datas rather than being the minimum
+        self.assertGreater(merged.attr['maxExp'], self.data_list[0].exp_matrix.max())
+
+    def test_intersect(self):
+        merged = merge(*self.data_list, reorganize_coordinate=False)
+        expected = pd.concat(self.expected, join='inner')
+        self.assertEqual(merged.exp_matrix.shape, (160, 20))
+        self.assertMergedEqual(merged, expected)
+
+    def test_lazy(self):
+        for var_type in ('union', 'intersect'):
+            with self.subTest(var_type=var_type):
+                eager = merge(*self.data_list, var_type=var_type)
+                lazy = merge(*self.data_list, var_type=var_type, lazy=True)
+                self.assertIsInstance(lazy.exp_matrix, LazyExpMatrix)
+                self.assertEqual(lazy.exp_matrix.shape, eager.exp_matrix.shape)
+                np.testing.assert_array_equal(lazy.exp_matrix.toarray(), eager.exp_matrix.toarray())
+                self.assertTrue((lazy.gene_names == eager.gene_names).all())
+                self.assertTrue((lazy.cell_names == eager.cell_names).all())
+                np.testing.assert_array_equal(lazy.position, eager.position)
+                self.assertEqual(lazy.position_offset.keys(), eager.position_offset.keys())
+                for key in eager.position_offset:
+                    np.testing.assert_array_equal(lazy.position_offset[key], eager.position_offset[key])
+                self.assertEqual(lazy.attr, eager.attr)
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from stereo.io.gef import GefTileReader, _gef_tile_reader, build_gef_tile_index
+
+
+def write_gef(file_path, seed, n_genes=40, width=200, height=150, min_x=1000, min_y=50):
+    rng = np.random.default_rng(seed)
+    records, genes, offset = [], [], 0
+    for g in range(n_genes):
+        # a gene without records
+        n = 0 if g == 7 else rng.integers(1, 300)
+        positions = rng.choice(width * height, n, replace=False)
+        for position, count in zip(positions, rng.integers(1, 9, n)):
+            records.append((position // height + min_x, position % height + min_y, count))
+        genes.append((f'G{g}'.encode(), offset, n))
+        offset += n
+    exp = np.array(records, dtype=[('x', np.uint32), ('y', np.uint32), ('count', np.uint16)])
+    gene = np.array(genes, dtype=[('gene', 'S32'), ('offset', np.uint32), ('count', np.uint32)])
+    with h5py.File(file_path, mode='w') as f:
+        f['geneExp/bin1/expression'] = exp
+        f['geneExp/bin1/gene'] = gene
+        for key, value in (('minX', exp['x'].min()), ('minY', exp['y'].min()),
+                           ('maxX', exp['x'].max()), ('maxY', exp['y'].max())):
+            f['geneExp/bin1/expression'].attrs[key] = np.array([value])
+    gene_index = np.repeat(np.arange(n_genes), gene['count'])
+    return exp, gene_index
+
+
+class TestGefTileIndex(unittest.TestCase):
+
+    REGIONS = [
+        # straddling the edges of tiles
+        ([1010, 1050, 60, 100], None),
+        ([1016, 1034, 66, 68], ['G3', 'G7', 'G11']),
+        # the whole file
+        ([1000, 1199, 50, 199], ['G3', 'G5']),
+        ([1000, 1199, 50, 199], None),
+        # outside of the file and inside a tile without records of the genes
+        ([5, 6, 7, 8], None),
+        ([1010, 1012, 60, 62], ['G7']),
+    ]
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, 'demo.gef')
+        self.exp, self.gene_index = write_gef(self.file_path, 0)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def assertQueryEqual(self, reader, exp, gene_index, region, gene_list):
+        cells, genes, exp_matrix = reader.query(region, gene_list)
+        flag = (exp['x'] >= region[0]) & (exp['x'] <= region[1]) & (exp['y'] >= region[2]) & (exp['y'] <= region[3])
+        if gene_list:
+            flag &= np.isin(np.char.add('G', gene_index.astype(str)), gene_list)
+        expected = {
+            ((int(x) << 32) | int(y), f'G{g}'): int(count)
+            for x, y, count, g in zip(exp['x'][flag], exp['y'][flag], exp['count'][flag], gene_index[flag])
+        }
+        self.assertEqual(exp_matrix.shape, (cells.size, genes.size))
+        coo = exp_matrix.tocoo()
+        result = {(int(cells[i]), genes[j]): int(v) for i, j, v in zip(coo.row, coo.col, coo.data)}
+        self.assertEqual(result, expected)
+
+    def test_query(self):
+        for chunk_size in (333, 10000000):
+            build_gef_tile_index(self.file_path, bin_size=1, tile_size=17, chunk_size=chunk_size)
+            self.assertTrue(os.path.exists(self.file_path + '.tile_index.h5'))
+            reader = GefTileReader(self.file_path, bin_size=1, cache_size=4)
+            for region, gene_list in self.REGIONS:
+                with self.subTest(chunk_size=chunk_size, region=region, gene_list=gene_list):
+                    self.assertQueryEqual(reader, self.exp, self.gene_index, region, gene_list)
+
+    def test_index_in_gef(self):
+        build_gef_tile_index(self.file_path, bin_size=1, tile_size=23, chunk_size=500, index_path=self.file_path)
+        self.assertFalse(os.path.exists(self.file_path + '.tile_index.h5'))
+        reader = GefTileReader(self.file_path, bin_size=1)
+        self.assertEqual(reader.index_path, self.file_path)
+        for region, gene_list in self.REGIONS:
+            self.assertQueryEqual(reader, self.exp, self.gene_index, region, gene_list)
+
+    def test_source_not_modified(self):
+        with open(self.file_path, 'rb') as f:
+            content = f.read()
+        build_gef_tile_index(self.file_path, bin_size=1, tile_size=17)
+        with open(self.file_path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_cached_reader(self):
+        other_path = os.path.join(self.tmp_dir.name, 'other.gef')
+        exp, gene_index = write_gef(other_path, 1)
+        build_gef_tile_index(other_path, bin_size=1, tile_size=29)
+        build_gef_tile_index(self.file_path, bin_size=1, tile_size=17)
+        reader = _gef_tile_reader(self.file_path, 1)
+        self.assertIs(_gef_tile_reader(self.file_path, 1), reader)
+
+        # the GEF file and its index are replaced, such as by another process
+        for suffix in ('', '.tile_index.h5'):
+            os.replace(other_path + suffix, self.file_path + suffix)
+            stat = os.stat(self.file_path + suffix)
+            os.utime(self.file_path + suffix, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        new_reader = _gef_tile_reader(self.file_path, 1)
+        self.assertIsNot(new_reader, reader)
+        self.assertEqual(new_reader.tile_size, 29)
+        for region, gene_list in self.REGIONS:
+            self.assertQueryEqual(new_reader, exp, gene_index, region, gene_list)
@@ -0,0 +1,160 @@
+import os
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.io.writer import update_gef, write_mid_gef
+
+
+class TestWriteMidGef(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        n_cells, n_genes = 150, 30
+        x = (rng.random((n_cells, n_genes)) < 0.2) * rng.integers(1, 20, (n_cells, n_genes))
+        # genes without expression
+        x[:, [0, 7, 29]] = 0
+        self.x = x.astype(np.float32)
+        self.position = rng.choice(10000, (n_cells, 2), replace=False) + 100
+        self.data = StereoExpData(
+            exp_matrix=csr_matrix(self.x),
+            cells=np.array([f'cell_{i}' for i in range(n_cells)]),
+            genes=np.array([f'gene_{i}' for i in range(n_genes)]),
+            position=self.position,
+            bin_type='bins',
+            bin_size=1,
+        )
+        self.data.attr = {'minX': 100, 'minY': 100, 'maxX': 10099, 'maxY': 10099, 'resolution': 500}
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def expected(self):
+        """
+        The records of the dense loop over genes.
+        """
+        final_exp, final_gene = [], []
+        for i in range(self.x.shape[1]):
+            gene_exp = self.x[:, i]
+            c_idx = np.nonzero(gene_exp)[0]
+            for k in np.concatenate((self.position[c_idx], gene_exp[c_idx].reshape(-1, 1)), axis=1):
+                final_exp.append(tuple(k.astype(int)))
+            offset = 0 if not final_gene else final_gene[-1][1] + final_gene[-1][2]
+            final_gene.append((self.data.gene_names[i].encode(), offset, c_idx.size))
+        return final_exp, final_gene
+
+    def assertGefEqual(self, output):
+        expected_exp, expected_gene = self.expected()
+        with h5py.File(output, 'r') as f:
+            expression = f['geneExp/bin1/expression']
+            self.assertEqual(expression.dtype, np.dtype([('x', np.uint32), ('y', np.uint32), ('count', np.uint16)]))
+            self.assertEqual(expression[()].tolist(), expected_exp)
+            self.assertEqual(f['geneExp/bin1/gene'][()].tolist(), expected_gene)
+            self.assertEqual(dict(expression.attrs), self.data.attr)
+            self.assertEqual(f.attrs['version'], 2)
+
+    def test_write(self):
+        for chunk_size in (7, 1000000):
+            with self.subTest(chunk_size=chunk_size):
+                output = os.path.join(self.tmp_dir.name, f'{chunk_size}.gef')
+                write_mid_gef(self.data, output, chunk_size=chunk_size)
+                self.assertGefEqual(output)
+
+    def test_explicit_zeros(self):
+        self.data.exp_matrix.data[::5] = 0
+        self.x = self.data.exp_matrix.toarray()
+        output = os.path.join(self.tmp_dir.name, 'zeros.gef')
+        write_mid_gef(self.data, output, chunk_size=11)
+        self.assertGefEqual(output)
+
+    def test_dense(self):
+        self.data.exp_matrix = self.x
+        output = os.path.join(self.tmp_dir.name, 'dense.gef')
+        write_mid_gef(self.data, output)
+        self.assertGefEqual(output)
+
+
+class TestUpdateGef(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.gef_file = os.path.join(self.tmp_dir.name, 'demo.cellbin.gef')
+        rng = np.random.default_rng(0)
+        n_cells = 500
+        xy = rng.choice(4000 * 4000, n_cells, replace=False)
+        cell_type = np.dtype([('x', np.int32), ('y', np.int32), ('area', np.uint16),
+                              ('clusterID', np.uint16), ('cellTypeID', np.uint16)])
+        cells = np.zeros(n_cells, dtype=cell_type)
+        cells['x'], cells['y'] = xy // 4000, xy % 4000
+        cells['area'] = rng.integers(1, 500, n_cells)
+        with h5py.File(self.gef_file, 'w') as f:
+            f['cellBin/cell'] = cells
+        self.cells = cells
+        self.cell_ids = (cells['x'].astype(np.uint64) << np.uint64(32)) | cells['y'].astype(np.uint64)
+
+        # the results miss a part of the cells of the GEF and have cells not in the GEF
+        other_ids = np.arange(5, 45, dtype=np.uint64) << np.uint64(32)
+        result_ids = np.concatenate([rng.permutation(self.cell_ids)[:400], other_ids])
+        rng.shuffle(result_ids)
+        self.data = StereoExpData(
+            exp_matrix=csr_matrix((result_ids.size, 3)),
+            cells=result_ids,
+            genes=np.array(['gene_0', 'gene_1', 'gene_2']),
+            bin_type='cell_bins',
+        )
+        self.data.tl.result['leiden'] = pd.DataFrame({
+            'bins': result_ids,
+            'group': pd.Categorical(rng.integers(0, 12, result_ids.size).astype(str))
+        })
+        self.data.tl.result['anno'] = pd.DataFrame({
+            'bins': result_ids,
+            'group': rng.choice(['T cell', 'B cell', 'NK', 'Fibroblast'], result_ids.size)
+        })
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def expected(self, res_key, to_id):
+        """
+        The ids of the per-cell lookup in a dict of the result.
+        """
+        cluster = {}
+        for _, v in self.data.tl.result[res_key].iterrows():
+            cluster[v['bins']] = to_id(v['group'])
+        celltid = np.zeros(self.cell_ids.shape, dtype='uint16')
+        for n, cell_name in enumerate(self.cell_ids):
+            if cell_name in cluster:
+                celltid[n] = cluster[cell_name]
+        return celltid
+
+    def test_update(self):
+        update_gef(self.data, self.gef_file, {'leiden': 'clusterID', 'anno': 'cellTypeID'})
+        categories = sorted(set(self.data.tl.result['anno']['group']))
+        with h5py.File(self.gef_file, 'r') as f:
+            cells = f['cellBin/cell'][()]
+        np.testing.assert_array_equal(cells['clusterID'], self.expected('leiden', lambda group: int(group) + 1))
+        np.testing.assert_array_equal(cells['cellTypeID'],
+                                      self.expected('anno', lambda group: categories.index(group) + 1))
+        self.assertTrue((cells['clusterID'] == 0).any())
+        for field in ('x', 'y', 'area'):
+            np.testing.assert_array_equal(cells[field], self.cells[field])
+
+        # a single key is written to the clusterID
+        self.data.tl.result['leiden']['group'] = self.data.tl.result['leiden']['group'].cat.rename_categories(
+            lambda group: str(11 - int(group)))
+        update_gef(self.data, self.gef_file, 'leiden')
+        with h5py.File(self.gef_file, 'r') as f:
+            np.testing.assert_array_equal(f['cellBin/cell']['clusterID'],
+                                          self.expected('leiden', lambda group: int(group) + 1))
+
+    def test_missing(self):
+        with self.assertRaises(Exception):
+            update_gef(self.data, self.gef_file, 'louvain')
+        with self.assertRaises(Exception):
+            update_gef(self.data, self.gef_file, {'leiden': 'clusterID', 'anno': 'cellType'})
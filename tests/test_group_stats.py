@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csc_matrix, csr_matrix
+
+from stereo.core.lazy_matrix import LazyExpMatrix
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.io.reader import read_stereo_h5ad
+from stereo.io.writer import write_h5ad
+from stereo.utils.group_stats import GroupStats
+
+
+class TestGroupStats(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        n_cells, n_genes = 400, 30
+        x = rng.poisson(1, size=(n_cells, n_genes)).astype(np.float64)
+        x[rng.random((n_cells, n_genes)) < 0.5] = 0
+        x[:, 3] = -x[:, 3]
+        self.x = x
+        groups = rng.choice(['a', 'b', 'c', 'd'], size=n_cells).astype(object)
+        groups[rng.random(n_cells) < 0.1] = np.nan
+        self.groups = groups
+        # `e` is an unobserved category
+        self.categorical_groups = pd.Categorical(groups, categories=['d', 'c', 'b', 'a', 'e'])
+
+    def expected(self, groups):
+        grouped = pd.DataFrame(self.x).groupby(groups, observed=False)
+        expressed = pd.DataFrame(self.x > 0).groupby(groups, observed=False)
+        return {
+            'index': grouped.size().index,
+            'size': grouped.size().values,
+            'sum': grouped.sum().values,
+            'mean': grouped.mean().values,
+            'var': grouped.var().values,
+            'n_expressed': expressed.sum().values,
+        }
+
+    def assertStatsEqual(self, group_stats, groups):
+        expected = self.expected(groups)
+        self.assertTrue(group_stats.group_index.equals(expected['index']))
+        self.assertEqual(group_stats.group_index.name, 'group')
+        np.testing.assert_array_equal(group_stats.size(), expected['size'])
+        np.testing.assert_allclose(group_stats.sum(), expected['sum'])
+        np.testing.assert_allclose(group_stats.mean(), expected['mean'])
+        np.testing.assert_allclose(group_stats.var(), expected['var'])
+        np.testing.assert_allclose(group_stats.n_expressed(), expected['n_expressed'])
+        np.testing.assert_allclose(group_stats.pct(), expected['n_expressed'] / expected['size'][:, None])
+
+        pooled = ['a', 'c']
+        mask = pd.Series(self.groups).isin(pooled).values
+        self.assertEqual(group_stats.size(pooled), mask.sum())
+        np.testing.assert_allclose(group_stats.sum(pooled), self.x[mask].sum(axis=0))
+        np.testing.assert_allclose(group_stats.mean(pooled), self.x[mask].mean(axis=0))
+        np.testing.assert_allclose(group_stats.var(pooled), self.x[mask].var(axis=0, ddof=1))
+        np.testing.assert_allclose(group_stats.n_expressed(pooled), (self.x[mask] > 0).sum(axis=0))
+
+    def test_matrix_types(self):
+        for exp_matrix in (self.x, csr_matrix(self.x), csc_matrix(self.x)):
+            for groups in (self.groups, self.categorical_groups):
+                with self.subTest(matrix=type(exp_matrix).__name__, groups=type(groups).__name__):
+                    self.assertStatsEqual(GroupStats(exp_matrix, groups), groups)
+
+    def test_unobserved_category(self):
+        group_stats = GroupStats(csr_matrix(self.x), self.categorical_groups)
+        self.assertEqual(list(group_stats.categories), ['d', 'c', 'b', 'a', 'e'])
+        self.assertEqual(group_stats.size()[-1], 0)
+        self.assertTrue((group_stats.sum()[-1] == 0).all())
+        self.assertTrue(np.isnan(group_stats.mean()[-1]).all())
+        self.assertEqual(group_stats.size(['e', 'a']), group_stats.size('a'))
+        with self.assertRaises(ValueError):
+            group_stats.get_codes(['f'])
+
+    def test_lazy_matrix(self):
+        n_cells, n_genes = self.x.shape
+        for matrix_type in (csr_matrix, csc_matrix):
+            data = StereoExpData(
+                exp_matrix=matrix_type(self.x),
+                cells=np.array([f'cell_{i}' for i in range(n_cells)]),
+                genes=np.array([f'gene_{i}' for i in range(n_genes)]),
+                position=np.zeros((n_cells, 2), dtype=np.uint32),
+                bin_type='bins',
+            )
+            with self.subTest(matrix=matrix_type.__name__), tempfile.TemporaryDirectory() as tmp_dir:
+                file_path = os.path.join(tmp_dir, 'data.h5ad')
+                write_h5ad(data, use_raw=False, use_result=False, output=file_path)
+                lazy_data = read_stereo_h5ad(file_path, use_raw=False, use_result=False, lazy=True)
+                self.assertIsInstance(lazy_data.exp_matrix, LazyExpMatrix)
+                lazy_data.exp_matrix.block_size = 7
+                self.assertStatsEqual(GroupStats(lazy_data.exp_matrix, self.categorical_groups),
+                                      self.categorical_groups)
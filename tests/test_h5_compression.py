@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from stereo.core.ms_data import MSData
+from stereo.io.h5ad import ChunkEncoder
+from stereo.io.reader import read_h5ms, read_stereo_h5ad
+from stereo.io.writer import write_h5ad, write_h5ms
+from synthetic_data import make_data
+
+
+class TestCompressedWrite(unittest.TestCase):
+
+    SIZE = dict(n_cells=3000, n_genes=200, density=0.05, n_pcs=20)
+
+    OPTIONS = [
+        dict(compression='gzip', shuffle=True),
+        dict(compression='gzip', compression_level=6),
+        dict(compression='lzf', shuffle=True),
+        dict(compression='lzf'),
+    ]
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def assertDataEqual(self, data, expected, check_raw=True):
+        self.assertEqual(abs(data.exp_matrix - expected.exp_matrix).max(), 0)
+        if check_raw:
+            self.assertEqual(abs(data.tl.raw.exp_matrix - expected.tl.raw.exp_matrix).max(), 0)
+        self.assertTrue((data.cell_names == expected.cell_names).all())
+        self.assertTrue((data.gene_names == expected.gene_names).all())
+        self.assertTrue((data.position == expected.position).all())
+        np.testing.assert_array_equal(data.tl.result['pca'].values, expected.tl.result['pca'].values)
+
+    def test_chunk_encoder_n_jobs(self):
+        for n_jobs in (None, -1, 0, 3):
+            with ChunkEncoder(n_jobs) as encoder:
+                self.assertEqual(encoder.n_jobs, os.cpu_count() if n_jobs != 3 else 3)
+        with ChunkEncoder() as encoder:
+            self.assertEqual(encoder.n_jobs, os.cpu_count())
+
+    def test_write_h5ad(self):
+        data = make_data(0, **self.SIZE)
+        for options in self.OPTIONS:
+            for n_jobs in (1, 4, -1):
+                with self.subTest(n_jobs=n_jobs, **options):
+                    output = os.path.join(self.tmp_dir.name, 'data.h5ad')
+                    write_h5ad(data, output=output, chunks=1000, n_jobs=n_jobs, **options)
+                    with h5py.File(output, mode='r') as f:
+                        dataset = f['exp_matrix']['data']
+                        self.assertEqual(dataset.compression, options['compression'])
+                        self.assertEqual(dataset.shuffle, options.get('shuffle', False))
+                        self.assertEqual(dataset.chunks, (1000,))
+                        self.assertEqual(f['pca@pca'].chunks, (1000, 20))
+                    self.assertDataEqual(read_stereo_h5ad(output), data)
+
+    def test_write_h5ms(self):
+        data_list = [make_data(1, **self.SIZE), make_data(2, **dict(self.SIZE, n_cells=2500))]
+        ms_data = MSData(_data_list=data_list, _names=['a', 'b'])
+        for options in self.OPTIONS:
+            for n_jobs in (1, 4, -1):
+                with self.subTest(n_jobs=n_jobs, **options):
+                    output = os.path.join(self.tmp_dir.name, 'data.h5ms')
+                    write_h5ms(ms_data, output, chunks=1000, n_jobs=n_jobs, **options)
+                    with h5py.File(output, mode='r') as f:
+                        dataset = f['slice']['slice_1']['exp_matrix']['data']
+                        self.assertEqual(dataset.compression, options['compression'])
+                        self.assertEqual(dataset.chunks, (1000,))
+                    result = read_h5ms(output)
+                    self.assertEqual(list(result.names), ['a', 'b'])
+                    # the raw data of slices are not written into h5ms files
+                    for data, expected in zip(result.data_list, ms_data.data_list):
+                        self.assertDataEqual(data, expected, check_raw=False)
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from stereo.core.lazy_matrix import LazyExpMatrix
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.io.reader import read_stereo_h5ad
+from stereo.io.writer import write_h5ad
+from stereo.utils.hvg_utils import get_mean_var
+
+
+class TestLazyExpMatrix(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        n_cells, n_genes = 500, 120
+        exp_matrix = csr_matrix(rng.poisson(rng.gamma(0.3, 2, size=(1, n_genes)), size=(n_cells, n_genes)))
+        data = StereoExpData(
+            exp_matrix=exp_matrix,
+            cells=np.array([f'cell_{i}' for i in range(n_cells)]),
+            genes=np.array([f'gene_{i}' for i in range(n_genes)]),
+            position=rng.integers(0, 1000, size=(n_cells, 2)),
+            bin_type='bins',
+        )
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, 'demo.h5ad')
+        write_h5ad(data, use_raw=False, use_result=False, output=self.file_path)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def read(self, lazy, block_size=37):
+        data = read_stereo_h5ad(self.file_path, use_raw=False, use_result=False, lazy=lazy)
+        if lazy:
+            self.assertIsInstance(data.exp_matrix, LazyExpMatrix)
+            data.exp_matrix.block_size = block_size
+        return data
+
+    def assertMatrixEqual(self, lazy_matrix, matrix):
+        self.assertEqual(lazy_matrix.shape, matrix.shape)
+        np.testing.assert_allclose(lazy_matrix.toarray(), matrix.toarray(), rtol=1e-6)
+
+    def test_sub_by_index(self):
+        data = self.read(False)
+        lazy_data = self.read(True)
+        cell_index = np.array([0, 3, 250, 251, 499, 3])
+        gene_index = np.arange(0, 120, 7)
+        data.sub_by_index(cell_index=cell_index, gene_index=gene_index)
+        lazy_data.sub_by_index(cell_index=cell_index, gene_index=gene_index)
+        self.assertMatrixEqual(lazy_data.exp_matrix, data.exp_matrix)
+        self.assertTrue((lazy_data.cell_names == data.cell_names).all())
+        self.assertTrue((lazy_data.gene_names == data.gene_names).all())
+
+    def test_sparse_selection_reads_runs(self):
+        lazy_data = self.read(True, block_size=10)
+        source = lazy_data.exp_matrix.source
+        spans = []
+        read = source.read
+
+        def read_and_record(start, stop):
+            spans.append(stop - start)
+            return read(start, stop)
+
+        source.read = read_and_record
+        # the first and the last cells should not read the whole file
+        subset = lazy_data.exp_matrix[[0, 499]]
+        self.assertMatrixEqual(subset, self.read(False).exp_matrix[[0, 499]])
+        self.assertLessEqual(max(spans), 1)
+
+    def test_preprocess(self):
+        data = self.read(False)
+        lazy_data = self.read(True)
+        for d in (data, lazy_data):
+            d.tl.cal_qc()
+            d.tl.normalize_total(target_sum=1e4)
+            d.tl.log1p()
+        self.assertIsInstance(lazy_data.exp_matrix, LazyExpMatrix)
+        for column in ('total_counts', 'n_genes_by_counts', 'pct_counts_mt'):
+            np.testing.assert_allclose(getattr(lazy_data.cells, column), getattr(data.cells, column), rtol=1e-6)
+        np.testing.assert_array_equal(lazy_data.genes.n_cells, data.genes.n_cells)
+        self.assertMatrixEqual(lazy_data.exp_matrix, data.exp_matrix)
+
+        for d in (data, lazy_data):
+            d.tl.highly_variable_genes(min_mean=0.0125, max_mean=3, min_disp=0.5, n_top_genes=None)
+        lazy_hvg = lazy_data.tl.result['highly_variable_genes']
+        hvg = data.tl.result['highly_variable_genes']
+        np.testing.assert_allclose(lazy_hvg['means'], hvg['means'], rtol=1e-5)
+        np.testing.assert_allclose(lazy_hvg['dispersions'], hvg['dispersions'], rtol=1e-4)
+        self.assertTrue((lazy_hvg['highly_variable'] == hvg['highly_variable']).all())
+
+        for d in (data, lazy_data):
+            d.tl.pca(use_highly_genes=True, n_pcs=5, svd_solver='arpack')
+        np.testing.assert_allclose(
+            np.abs(lazy_data.tl.result['pca'].values), np.abs(data.tl.result['pca'].values), rtol=1e-3, atol=1e-4
+        )
+
+    def test_ufunc(self):
+        data = self.read(False)
+        lazy_data = self.read(True)
+        self.assertMatrixEqual(np.expm1(np.log1p(lazy_data.exp_matrix)), data.exp_matrix)
+        self.assertMatrixEqual(np.square(lazy_data.exp_matrix), data.exp_matrix.multiply(data.exp_matrix))
+        # not mapping 0 to 0, computed in memory
+        np.testing.assert_allclose(np.exp(lazy_data.exp_matrix), np.exp(data.exp_matrix.toarray()))
+        for axis in (0, 1):
+            lazy_mean, lazy_var = get_mean_var(lazy_data.exp_matrix, axis=axis)
+            mean, var = get_mean_var(data.exp_matrix.astype(np.float64), axis=axis)
+            np.testing.assert_allclose(lazy_mean, mean)
+            np.testing.assert_allclose(lazy_var, var)
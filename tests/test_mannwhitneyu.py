@@ -0,0 +1,70 @@
+import unittest
+
+import numpy as np
+from scipy import stats
+from scipy.sparse import csc_matrix
+
+from stereo.algorithm.mannwhitneyu import mannwhitneyu_from_rank_sums, rank_sums_by_group
+
+
+class TestRankSumsByGroup(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        n_cells, n_genes = 300, 25
+        # small integers make many ties, the negative values rank before the zeros
+        x = rng.integers(-3, 6, size=(n_cells, n_genes)).astype(np.float64)
+        x[rng.random((n_cells, n_genes)) < 0.5] = 0
+        x[:, 0] = 0
+        x[:, 1] = rng.normal(size=n_cells)
+        self.x = x
+        self.n_groups = 4
+        self.codes = rng.integers(0, self.n_groups, size=n_cells)
+
+    def expected_rank_sums(self, cell_mask):
+        x, codes = self.x[cell_mask], self.codes[cell_mask]
+        ranks = stats.rankdata(x, axis=0)
+        return np.stack([ranks[codes == code].sum(axis=0) for code in range(self.n_groups)], axis=1)
+
+    def test_rank_sums(self):
+        matrix = csc_matrix(self.x)
+        # the explicit zeros are ranked the same as the other zeros
+        matrix.data[matrix.data == 5] = 0
+        self.assertLess((matrix.data != 0).sum(), matrix.nnz)
+        x = self.x = matrix.toarray()
+        rng = np.random.default_rng(1)
+        for cell_mask in (None, rng.random(x.shape[0]) < 0.6):
+            for n_jobs, block_size in ((1, 1000), (2, 7)):
+                rank_sums, tie_term = rank_sums_by_group(matrix, self.codes, self.n_groups, cell_mask=cell_mask,
+                                                         with_tie_term=True, block_size=block_size, n_jobs=n_jobs)
+                mask = np.ones(x.shape[0], dtype=bool) if cell_mask is None else cell_mask
+                np.testing.assert_allclose(rank_sums, self.expected_rank_sums(mask))
+                counts = [np.unique(x[mask, i], return_counts=True)[1].astype(np.float64) for i in range(x.shape[1])]
+                np.testing.assert_allclose(tie_term, [(t ** 3 - t).sum() for t in counts])
+
+    def test_negative_codes(self):
+        codes = self.codes.copy()
+        codes[::5] = -1
+        rank_sums, _ = rank_sums_by_group(csc_matrix(self.x), codes, self.n_groups)
+        self.codes = codes
+        np.testing.assert_allclose(rank_sums, self.expected_rank_sums(codes >= 0))
+
+    def test_mannwhitneyu(self):
+        rng = np.random.default_rng(2)
+        cell_mask = rng.random(self.x.shape[0]) < 0.7
+        group, other_groups = 1, [0, 3]
+        cell_mask &= np.isin(self.codes, other_groups + [group])
+        rank_sums, tie_term = rank_sums_by_group(csc_matrix(self.x), self.codes, self.n_groups,
+                                                 cell_mask=cell_mask, with_tie_term=True)
+        in_group = cell_mask & (self.codes == group)
+        in_rest = cell_mask & (self.codes != group)
+        n1, n2 = in_group.sum(), in_rest.sum()
+        z, p = mannwhitneyu_from_rank_sums(rank_sums[:, group], n1, n2, tie_term=tie_term)
+        # the first gene is constant
+        self.assertEqual(p[0], 1)
+        for i in range(1, self.x.shape[1]):
+            expected = stats.mannwhitneyu(self.x[in_group, i], self.x[in_rest, i], use_continuity=True,
+                                          alternative='two-sided', method='asymptotic')
+            np.testing.assert_allclose(p[i], expected.pvalue, rtol=1e-10)
+            u1 = rank_sums[i, group] - n1 * (n1 + 1) / 2
+            np.testing.assert_allclose(u1, expected.statistic)
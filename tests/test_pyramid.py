@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+import tifffile as tifi
+
+from stereo.image.pyramid import PyramidReader, create_pyramid, merge_pyramid
+
+
+class TestPyramid(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        # neither the height nor the width is a multiple of the patch size
+        self.img = rng.integers(0, 4000, size=(203, 157)).astype(np.uint16)
+        self.img_path = os.path.join(self.tmp_dir.name, 'image.tif')
+        tifi.imwrite(self.img_path, self.img)
+        self.img_size = 50
+        self.mag = [1, 2, 4, 6, 3]
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        for compression in (None, 1):
+            with self.subTest(compression=compression):
+                h5_path = os.path.join(self.tmp_dir.name, f'pyramid_{compression}.h5')
+                create_pyramid(self.img_path, h5_path, self.img_size, 0, 0, self.mag, n_jobs=2,
+                               compression=compression)
+                with h5py.File(h5_path, 'r') as h5:
+                    self.assertEqual(h5['bin_1/1/1'].compression, None if compression is None else 'gzip')
+
+                reader = PyramidReader(h5_path, cache_size=8)
+                self.assertEqual(sorted(reader.levels), sorted(self.mag))
+                for bin_size in self.mag:
+                    expected = self.img[::bin_size, ::bin_size]
+                    height, width = expected.shape
+                    level = reader.levels[bin_size]
+                    self.assertEqual((level['sizey'], level['sizex']), (height, width))
+
+                    # the patches, including the empty ones past the edges
+                    for x in range(level['XimageNumber']):
+                        for y in range(level['YimageNumber']):
+                            tile = reader.read_tile(bin_size, x, y)
+                            np.testing.assert_array_equal(
+                                tile, expected[y * self.img_size:(y + 1) * self.img_size,
+                                               x * self.img_size:(x + 1) * self.img_size])
+
+                    np.testing.assert_array_equal(reader.read_region(bin_size, 0, 0, width, height), expected)
+                    for x0, y0, x1, y1 in ((3, 7, 61, 55), (49, 49, 51, 101), (-5, -5, 1000, 1000)):
+                        np.testing.assert_array_equal(reader.read_region(bin_size, x0, y0, x1, y1),
+                                                      expected[max(y0, 0):y1, max(x0, 0):x1])
+
+                    out_path = os.path.join(self.tmp_dir.name, f'merged_{compression}_{bin_size}')
+                    merged = merge_pyramid(h5_path, bin_size, out_path, n_jobs=2)
+                    np.testing.assert_array_equal(merged, expected)
+                    np.testing.assert_array_equal(tifi.imread(out_path + '.tiff'), expected)
@@ -0,0 +1,78 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import stereo as st
+
+
+class TestReadGem(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        n = 20000
+        df = pd.DataFrame({
+            'geneID': rng.choice([f'gene_{i}' for i in range(300)], n),
+            'x': rng.integers(1000, 3000, n),
+            'y': rng.integers(500, 2500, n),
+            'MIDCount': rng.integers(1, 5, n),
+        }).drop_duplicates(['geneID', 'x', 'y'])
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.gem_file = os.path.join(self.tmp_dir.name, 'demo.gem.gz')
+        with gzip.open(self.gem_file, 'wt') as f:
+            f.write('#FileFormat=GEMv0.1\n')
+            df.to_csv(f, sep='\t', index=False)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_read_gem_by_chunks(self):
+        data = st.io.read_gem(self.gem_file, bin_size=100)
+        data_by_chunks = st.io.read_gem(self.gem_file, bin_size=100, chunk_size=1000)
+        self.assertEqual(data.shape, data_by_chunks.shape)
+        self.assertTrue((data.cell_names == data_by_chunks.cell_names).all())
+        self.assertTrue((data.gene_names == data_by_chunks.gene_names).all())
+        self.assertTrue((data.position == data_by_chunks.position).all())
+        self.assertEqual((data.exp_matrix != data_by_chunks.exp_matrix).nnz, 0)
+        self.assertEqual(data.offset_x, data_by_chunks.offset_x)
+        self.assertEqual(data.offset_y, data_by_chunks.offset_y)
+
+    def test_read_gem_cell_bins(self):
+        from shapely.geometry import MultiPoint
+        from stereo.io.reader import parse_cell_bin_coor
+
+        rng = np.random.default_rng(1)
+        n = 5000
+        df = pd.DataFrame({
+            'geneID': rng.choice([f'gene_{i}' for i in range(50)], n),
+            'x': rng.integers(0, 400, n),
+            'y': rng.integers(0, 400, n),
+            'MIDCount': rng.integers(1, 5, n),
+        })
+        df['CellID'] = (df['x'] // 20) * 100 + df['y'] // 20 + 1
+        # the cells with a single dnb and with collinear dnbs
+        df.loc[0, ['x', 'y', 'CellID']] = [1000, 1000, 99999]
+        df.loc[1:3, ['x', 'y', 'CellID']] = [[2000, 2000, 99998], [2001, 2001, 99998], [2002, 2002, 99998]]
+        cell_bin_file = os.path.join(self.tmp_dir.name, 'demo_cell_bin.gem')
+        df.to_csv(cell_bin_file, sep='\t', index=False)
+
+        expected = {
+            cell_id: MultiPoint(list(zip(x['x'], x['y']))).convex_hull
+            for cell_id, x in df.groupby('CellID')
+        }
+        data = st.io.read_gem(cell_bin_file, bin_type='cell_bins')
+        self.assertEqual(data.cell_names.size, len(expected))
+        for cell_id, hull, position in zip(data.cell_names, data.cells.cell_point, data.position):
+            self.assertTrue(hull.equals(expected[cell_id]))
+            self.assertAlmostEqual(position[0], expected[cell_id].centroid.x)
+            self.assertAlmostEqual(position[1], expected[cell_id].centroid.y)
+
+        # several blocks of cells in parallel
+        gdf = parse_cell_bin_coor(df.rename(columns={'CellID': 'cell_id'}), n_jobs=2, block_size=7)
+        for cell_id, row in gdf.iterrows():
+            self.assertTrue(row['cell_point'].equals(expected[cell_id]))
+            self.assertAlmostEqual(row['x_center'], expected[cell_id].centroid.x)
+            self.assertAlmostEqual(row['y_center'], expected[cell_id].centroid.y)
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from stereo.core.lazy_matrix import LazyExpMatrix
+from stereo.core.ms_data import MSData
+from stereo.core.st_pipeline import LazyResult
+from stereo.io.reader import read_h5ms, read_stereo_h5ad
+from stereo.io.writer import write_h5ad, write_h5ms
+from synthetic_data import make_data
+
+
+class TestReadH5ms(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_result_keys(self):
+        data = make_data(0)
+        output = os.path.join(self.tmp_dir.name, 'data.h5ad')
+        write_h5ad(data, output=output)
+        expected = read_stereo_h5ad(output)
+        result = read_stereo_h5ad(output, result_keys=['leiden'])
+        self.assertIsInstance(result.tl.result, LazyResult)
+        self.assertEqual(sorted(result.tl.result.keys()), sorted(expected.tl.result.keys()))
+        self.assertEqual(result.tl.key_record, expected.tl.key_record)
+        self.assertTrue(result.tl.result.is_loaded('leiden'))
+        self.assertFalse(result.tl.result.is_loaded('pca'))
+        # the other results are read on their first access
+        self.assertTrue(result.tl.result['pca'].equals(expected.tl.result['pca']))
+        self.assertTrue(result.tl.result.is_loaded('pca'))
+        self.assertTrue(result.tl.result['leiden'].equals(expected.tl.result['leiden']))
+
+    def test_slices(self):
+        n_slices = 12
+        names = [f'sample_{i}' for i in range(n_slices)]
+        ms_data = MSData(_data_list=[make_data(i, cell_prefix=f'cell_{i}') for i in range(n_slices)], _names=names)
+        output = os.path.join(self.tmp_dir.name, 'data.h5ms')
+        write_h5ms(ms_data, output)
+
+        full = read_h5ms(output)
+        self.assertEqual(list(full.names), names)
+        for data, expected in zip(full.data_list, ms_data.data_list):
+            self.assertTrue((data.cell_names == expected.cell_names).all())
+            self.assertEqual(abs(data.exp_matrix - expected.exp_matrix).max(), 0)
+
+        part = read_h5ms(output, slices=[2, 'sample_10', 'slice_11'], result_keys=['leiden'])
+        self.assertEqual(list(part.names), names)
+        for idx, (data, expected) in enumerate(zip(part.data_list, ms_data.data_list)):
+            requested = idx in (2, 10, 11)
+            self.assertEqual(isinstance(data.exp_matrix, LazyExpMatrix), not requested)
+            self.assertEqual(data.tl.result.is_loaded('leiden'), requested)
+            self.assertFalse(data.tl.result.is_loaded('pca'))
+            self.assertTrue((data.cell_names == expected.cell_names).all())
+            np.testing.assert_array_equal(data.exp_matrix.toarray(), expected.exp_matrix.toarray())
+            self.assertTrue(data.tl.result['leiden'].equals(full.data_list[idx].tl.result['leiden']))
+            self.assertTrue(data.tl.result['pca'].equals(full.data_list[idx].tl.result['pca']))
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.sparse import random as sparse_random
+
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.stereo_config import stereo_conf
+from stereo.utils.result_cache import ResultCache, get_result_cache
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        stereo_conf.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        rng = np.random.default_rng(0)
+        n_cells, n_genes = 300, 60
+        exp_matrix = sparse_random(n_cells, n_genes, density=0.3, format='csr', random_state=0)
+        exp_matrix.data = np.ceil(exp_matrix.data * 10)
+        self.data = StereoExpData(
+            exp_matrix=exp_matrix,
+            cells=np.array([f'cell_{i}' for i in range(n_cells)]),
+            genes=np.array([f'gene_{i}' for i in range(n_genes)]),
+            position=rng.integers(0, 1000, size=(n_cells, 2)),
+            bin_type='bins',
+        )
+        self.data.tl.raw_checkpoint()
+        self.data.tl.log1p()
+
+    def tearDown(self) -> None:
+        stereo_conf.cache_dir = None
+        self.tmp_dir.cleanup()
+
+    def assertHit(self, hit, func, *args, **kwargs):
+        cache = get_result_cache()
+        hits, misses = cache.hits, cache.misses
+        res = func(*args, **kwargs)
+        self.assertEqual((cache.hits - hits, cache.misses - misses), (1, 0) if hit else (0, 1))
+        return res
+
+    def test_hit_and_miss(self):
+        tl = self.data.tl
+        self.assertHit(False, tl.pca, n_pcs=10)
+        pca = tl.result['pca'].copy()
+        tl.result['pca'] = None
+        self.assertHit(True, tl.pca, n_pcs=10)
+        self.assertTrue(tl.result['pca'].equals(pca))
+        # another argument
+        self.assertHit(False, tl.pca, n_pcs=8, res_key='pca_8')
+
+        # `n_jobs` is not a part of the key
+        self.assertHit(False, tl.neighbors, n_pcs=10, n_neighbors=8, n_jobs=1)
+        self.assertHit(True, tl.neighbors, n_pcs=10, n_neighbors=8, n_jobs=2)
+        # another result of the input res_key
+        self.assertHit(False, tl.neighbors, pca_res_key='pca_8', n_pcs=8, n_neighbors=8, res_key='neighbors_8')
+        tl.result['pca_8'] = tl.result['pca_8'] * 2
+        self.assertHit(False, tl.neighbors, pca_res_key='pca_8', n_pcs=8, n_neighbors=8, res_key='neighbors_8')
+
+        # the clusters of the genes are read from the raw data
+        self.assertHit(False, tl.leiden)
+        leiden = tl.result['leiden'].copy()
+        gene_exp_leiden = tl.result['gene_exp_leiden'].copy()
+        self.assertHit(True, tl.leiden)
+        self.assertTrue(tl.result['leiden'].equals(leiden))
+        self.assertTrue(tl.result['gene_exp_leiden'].equals(gene_exp_leiden))
+        tl.raw.exp_matrix.data[0] += 1
+        self.assertHit(False, tl.leiden)
+        self.assertFalse(tl.result['gene_exp_leiden'].equals(gene_exp_leiden))
+
+        # another expression matrix
+        self.data.exp_matrix.data[0] += 1
+        self.assertHit(False, tl.pca, n_pcs=10)
+
+    def test_bypass_args(self):
+        tl = self.data.tl
+        tl.pca(n_pcs=10)
+        tl.neighbors(n_pcs=10, n_neighbors=8)
+        tl.leiden()
+        cache = get_result_cache()
+        hits, misses = cache.hits, cache.misses
+        entries = os.listdir(cache.cache_dir)
+        output = os.path.join(self.tmp_dir.name, 'marker_genes.csv')
+        for _ in range(2):
+            tl.find_marker_genes('leiden', use_highly_genes=False, output=output)
+            self.assertTrue(os.path.exists(output))
+            os.remove(output)
+        self.assertEqual((cache.hits, cache.misses), (hits, misses))
+        self.assertEqual(os.listdir(cache.cache_dir), entries)
+
+    def test_evict(self):
+        value = np.zeros(1000, dtype=np.uint8)
+        cache = ResultCache(os.path.join(self.tmp_dir.name, 'lru'), max_size=2500)
+        for i, key in enumerate(('a', 'b')):
+            cache.put(key, value)
+            # older entries are accessed earlier
+            os.utime(cache._path(key), (1e9 + i, 1e9 + i))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', value)
+        self.assertEqual(sorted(os.listdir(cache.cache_dir)), ['a.pkl', 'c.pkl'])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # an entry larger than the cache is not kept
+        cache.put('d', np.zeros(3000, dtype=np.uint8))
+        self.assertNotIn('d.pkl', os.listdir(cache.cache_dir))
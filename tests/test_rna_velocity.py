@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+import loompy
+import numpy as np
+import pandas as pd
+
+from stereo.tools.rna_velocity import RnaVelocity, generate_loom
+
+
+class TestLoomGenerate(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        n_records, n_genes = 3000, 30
+        genes = np.array([f'G{i}' for i in range(n_genes)])
+        df = pd.DataFrame({
+            'geneID': genes[rng.integers(0, n_genes, n_records)],
+            'x': rng.integers(1000, 1500, n_records),
+            'y': rng.integers(500, 900, n_records),
+            'MIDCount': rng.integers(1, 6, n_records),
+        })
+        df['ExonCount'] = rng.binomial(df['MIDCount'], 0.6)
+        self.df = df
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.gem_path = os.path.join(self.tmp_dir.name, 'demo.gem')
+        df.to_csv(self.gem_path, sep='\t', index=False)
+        # half of the genes are not in the GTF
+        self.gtf_path = os.path.join(self.tmp_dir.name, 'demo.gtf')
+        with open(self.gtf_path, 'w') as f:
+            for i in range(0, n_genes, 2):
+                f.write(f'chr1\tsrc\tgene\t{i * 100 + 1}\t{i * 100 + 50}\t.\t+\t.\t'
+                        f'gene_id "ID{i}"; gene_name "G{i}";\n')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    @staticmethod
+    def read_loom(file_path):
+        with loompy.connect(file_path) as ds:
+            layers = {key: ds.layers[key][:, :] for key in ds.layers.keys()}
+            return layers, {key: ds.ra[key] for key in ds.ra.keys()}, {key: ds.ca[key] for key in ds.ca.keys()}
+
+    def test_layers(self):
+        bin_size = 50
+        file_path = generate_loom(out_dir=self.tmp_dir.name, gem_path=self.gem_path, gtf_path=self.gtf_path,
+                                  bin_type='bins', bin_size=bin_size)
+        layers, row_attrs, col_attrs = self.read_loom(file_path)
+        df = self.df.copy()
+        df['cell'] = ((df['x'] - df['x'].min()) // bin_size).astype(str) + '_' + \
+                     ((df['y'] - df['y'].min()) // bin_size).astype(str)
+        df['intron'] = df['MIDCount'] - df['ExonCount']
+        for name, column in (('', 'MIDCount'), ('spliced', 'ExonCount'), ('unspliced', 'intron')):
+            expected = df.pivot_table(index='geneID', columns='cell', values=column, aggfunc='sum', fill_value=0)
+            expected = expected.reindex(index=row_attrs['Gene'], columns=col_attrs['CellID'], fill_value=0)
+            np.testing.assert_array_equal(layers[name], expected.values)
+        self.assertFalse(layers['ambiguous'].any())
+        self.assertEqual(list(row_attrs['Accession'][:2]), ['ID0', 'nan'])
+
+    def test_chunks(self):
+        rv = RnaVelocity(gem_path=self.gem_path, gtf_path=self.gtf_path, bin_size=50)
+        df = rv.colchange(pd.read_csv(self.gem_path, sep='\t'))
+        cell_codes, cell_names = rv.parse_bin_coor(df, rv.bin_size)
+        layers, gene_names = rv.get_layers(df, cell_codes, cell_names.size)
+        df_row_attrs = rv.get_row_attrs(gene_names)
+        n_cells = cell_names.size
+
+        rv.out_dir = os.path.join(self.tmp_dir.name, 'single')
+        os.makedirs(rv.out_dir)
+        expected_layers, expected_row_attrs, expected_col_attrs = self.read_loom(
+            rv.loom_generate(df_row_attrs, layers, cell_names, chunk_size=n_cells))
+        np.testing.assert_array_equal(expected_col_attrs['CellID'], cell_names)
+        # the chunks which do not divide the cells, a chunk of a single cell and the default chunk size
+        for chunk_size in (7, 1, n_cells - 1, None):
+            self.assertTrue(chunk_size is None or n_cells % chunk_size or chunk_size == 1)
+            with self.subTest(chunk_size=chunk_size):
+                rv.out_dir = os.path.join(self.tmp_dir.name, f'chunk_{chunk_size}')
+                os.makedirs(rv.out_dir)
+                result_layers, result_row_attrs, result_col_attrs = self.read_loom(
+                    rv.loom_generate(df_row_attrs, layers, cell_names, chunk_size=chunk_size))
+                self.assertEqual(result_layers.keys(), expected_layers.keys())
+                for key, layer in expected_layers.items():
+                    np.testing.assert_array_equal(result_layers[key], layer)
+                    self.assertEqual(result_layers[key].dtype, layer.dtype)
+                for attrs, expected_attrs in ((result_row_attrs, expected_row_attrs),
+                                              (result_col_attrs, expected_col_attrs)):
+                    self.assertEqual(attrs.keys(), expected_attrs.keys())
+                    for key, values in expected_attrs.items():
+                        np.testing.assert_array_equal(attrs[key], values)
+                        self.assertEqual(attrs[key].dtype, values.dtype)
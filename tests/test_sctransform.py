@@ -0,0 +1,153 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.special import digamma, polygamma
+
+from stereo.algorithm.sctransform import SCTransform
+from stereo.algorithm.sctransform.utils import fit_poisson, qpois_reg_batch, row_gmean, row_gmean_sparse
+from stereo.core.lazy_matrix import LazyExpMatrix
+
+
+def qpois_reg(x, y, tol, maxiters):
+    """
+    The Poisson regression of one gene by Newton's method.
+
+    :return: the coefficients and the fitted values of the last iteration.
+    """
+    n, pcols = x.shape
+    b_old = np.zeros(pcols)
+    for i in range(pcols):
+        unique_vals = np.unique(x[:, i])
+        if unique_vals.shape[0] == 1:
+            b_old[i] = np.log(np.mean(y))
+            break
+        if unique_vals.shape[0] == 2 and (unique_vals[0] == 0 or unique_vals[1] == 0):
+            b_old[i] = np.log(max(1e-9, y @ x[:, i] / np.sum(x[:, i])))
+    ij, dif = 2, 1.0
+    while dif > tol:
+        m = np.exp(x @ b_old)
+        b_new = b_old + np.linalg.inv(x.T @ (x * m[:, None])) @ (x.T @ (y - m))
+        dif = np.sum(np.abs(b_new - b_old))
+        b_old = b_new
+        ij += 1
+        if ij == maxiters:
+            break
+    return b_new, m
+
+
+def theta_ml(y, mu, limit=10, eps=0.0001220703):
+    """
+    The maximum likelihood estimate of the negative binomial theta of one gene.
+    """
+    n = y.size
+    t0 = n / np.sum((y / mu - 1) ** 2)
+    it, _del = 1, 1
+    while it < limit and np.abs(_del) > eps:
+        t0 = np.abs(t0)
+        a, b = t0 + y, t0 + mu
+        score = np.sum(digamma(a) - digamma(t0) + np.log(t0) + 1 - np.log(b) - a / b)
+        info = np.sum(-polygamma(1, a) + polygamma(1, t0) - 1 / t0 + 2 / b - a / b ** 2)
+        _del = score / info
+        t0 = t0 + _del
+        it += 1
+    return max(t0, 0)
+
+
+class TestSctransformUtils(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        n_cells, n_genes = 600, 80
+        log_umi = rng.normal(3, 0.4, n_cells)
+        beta = rng.normal(-4, 1.5, n_genes)
+        theta = rng.gamma(2, 2, n_genes)
+        mu = np.exp(beta[:, None] + np.log(10 ** log_umi)[None, :])
+        y = rng.negative_binomial(theta[:, None], theta[:, None] / (theta[:, None] + mu)).astype(np.float64)
+        # each gene is expressed in a few cells at least
+        y[(y > 0).sum(axis=1) < 5, :5] = 1
+        self.y = y
+        self.umi = csr_matrix(y)
+        self.cell_attr = pd.DataFrame({'log_umi': np.log10(y.sum(axis=0) + 1)},
+                                      index=[f'cell_{i}' for i in range(n_cells)])
+
+    def test_fit_poisson(self):
+        x = np.stack([np.ones(self.y.shape[1]), self.cell_attr['log_umi'].values], axis=1)
+        expected = []
+        for y in self.y:
+            coefficients, fitted = qpois_reg(x, y, 1e-9, 100)
+            expected.append((theta_ml(y, fitted), coefficients[0], coefficients[1]))
+        expected = pd.DataFrame(expected, columns=['theta', 'Intercept', 'log_umi'])
+        for gene_batch_size in (7, 500):
+            with self.subTest(gene_batch_size=gene_batch_size):
+                result = fit_poisson(self.umi, 'y ~ log_umi', self.cell_attr, gene_batch_size=gene_batch_size)
+                self.assertEqual(list(result.columns), list(expected.columns))
+                np.testing.assert_allclose(result[['Intercept', 'log_umi']].values,
+                                           expected[['Intercept', 'log_umi']].values, rtol=1e-8, atol=1e-10)
+                np.testing.assert_allclose(result['theta'].values, expected['theta'].values, rtol=1e-6)
+
+    def test_qpois_reg_batch(self):
+        # a binary regressor starts from the log mean of the cells where it is 1
+        rng = np.random.default_rng(1)
+        x = np.stack([np.ones(self.y.shape[1]), self.cell_attr['log_umi'].values,
+                      rng.integers(0, 2, self.y.shape[1])], axis=1)
+        coefficients, fitted = qpois_reg_batch(x, self.umi, 1e-9, 100)
+        for i, y in enumerate(self.y):
+            expected_coefficients, expected_fitted = qpois_reg(x, y, 1e-9, 100)
+            np.testing.assert_allclose(coefficients[i], expected_coefficients, rtol=1e-8, atol=1e-10)
+            np.testing.assert_allclose(np.exp(x @ fitted[i]), expected_fitted, rtol=1e-8)
+
+    def test_row_gmean(self):
+        for gmean_eps in (1, 0.5):
+            expected = row_gmean(self.y, gmean_eps)
+            np.testing.assert_allclose(row_gmean_sparse(self.umi, gmean_eps), expected, rtol=1e-10)
+
+
+class TestConserveMemory(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        n_cells, n_genes = 800, 300
+        log_umi = rng.normal(3, 0.4, n_cells)
+        beta = rng.normal(-4, 1.5, n_genes)
+        theta = rng.gamma(2, 2, n_genes)
+        mu = np.exp(beta[:, None] + np.log(10 ** log_umi)[None, :])
+        y = rng.negative_binomial(theta[:, None], theta[:, None] / (theta[:, None] + mu)).astype(np.float64)
+        y[(y > 0).sum(axis=1) < 5, :5] = 1
+        self.umi = csr_matrix(y)
+        self.genes = np.array([f'gene_{i}' for i in range(n_genes)])
+        self.cells = np.array([f'cell_{i}' for i in range(n_cells)])
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def sct(self, **kwargs):
+        return SCTransform(self.umi.copy(), self.genes, self.cells, n_cells=500, n_genes=200, variable_features_n=50,
+                           do_correct_umi=True, **kwargs)
+
+    def test_conserve_memory(self):
+        expected, expected_vst = self.sct()
+        for store in (None, os.path.join(self.tmp_dir.name, 'corrected_umi.h5')):
+            with self.subTest(corrected_umi_store=store):
+                result, vst_out = self.sct(conserve_memory=True, corrected_umi_store=store)
+                self.assertEqual(list(vst_out['top_features']), list(expected_vst['top_features']))
+                np.testing.assert_allclose(vst_out['gene_attr']['residual_variance'].values,
+                                           expected_vst['gene_attr']['residual_variance'].values, rtol=1e-10)
+                self.assertTrue(result['scale.data'].index.equals(expected['scale.data'].index))
+                np.testing.assert_allclose(result['scale.data'].values, expected['scale.data'].values,
+                                           rtol=1e-10, atol=1e-12)
+
+                counts = result['counts']
+                if store is None:
+                    self.assertIsInstance(counts, csr_matrix)
+                else:
+                    self.assertIsInstance(counts, LazyExpMatrix)
+                    self.assertTrue(os.path.exists(store))
+                    counts = counts.tocsr()
+                self.assertEqual(counts.shape, expected['counts'].shape)
+                self.assertEqual(abs(counts - expected['counts']).max(), 0)
+                np.testing.assert_allclose(result['data'].toarray(), expected['data'].toarray())
@@ -1,7 +1,13 @@
 import unittest
 
-from stereo.algorithm.single_r.single_r import SingleR
-from stereo.core.stereo_exp_data import AnnBasedStereoExpData
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.sparse import csr_matrix
+
+from stereo.algorithm.single_r.single_r import SingleR, _get_label_genes_set
+from stereo.algorithm.single_r.utils import corr_spearman_sparse, normalized_ranks, rank_sparse_rows
+from stereo.core.stereo_exp_data import AnnBasedStereoExpData, StereoExpData
 from stereo.utils._download import _download
 
 
@@ -27,4 +33,164 @@ class TestSingleR(unittest.TestCase, SingleR):
         self.test_data.tl.single_r(self.ref_data, ref_use_col="celltype")
 
     def test_example_single_r_cluster(self):
-        self.test_data.tl.single_r(self.ref_data, ref_use_col="celltype", cluster_res_key='leiden')
\ No newline at end of file
+        self.test_data.tl.single_r(self.ref_data, ref_use_col="celltype", cluster_res_key='leiden')
+
+
+class TestSparseRanks(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        # small integers make ties, the negative values rank before the zeros
+        x = rng.integers(-3, 5, size=(60, 40)).astype(np.float32)
+        x[rng.random(x.shape) < 0.6] = 0
+        x[3] = 0
+        x[5] = 2
+        self.x = x
+
+    def test_rank_sparse_rows(self):
+        mat = csr_matrix(self.x)
+        # explicit zeros and duplicates
+        mat.data[::7] = 0
+        mat = csr_matrix((np.append(mat.data, [1, -1]), np.append(mat.indices, [mat.indices[0], mat.indices[1]]),
+                          np.append(mat.indptr[:-1], mat.indptr[-1] + 2)), shape=mat.shape)
+        dense = mat.toarray()
+        ranks, zero_ranks = rank_sparse_rows(mat)
+        result = ranks.toarray()
+        result[dense == 0] = np.broadcast_to(zero_ranks[:, None], dense.shape)[dense == 0]
+        np.testing.assert_allclose(result, stats.rankdata(dense, axis=1))
+
+    def test_corr_spearman(self):
+        rng = np.random.default_rng(1)
+        query = rng.poisson(0.5, size=(30, 40)).astype(np.float32)
+        query[7] = 0
+        ref_ranks = normalized_ranks(csr_matrix(self.x))
+        self.assertEqual(ref_ranks.shape, (40, 60))
+        result = corr_spearman_sparse(csr_matrix(query), ref_ranks)
+        with np.errstate(invalid='ignore'):
+            expected = np.array([[stats.pearsonr(stats.rankdata(q), stats.rankdata(r))[0] if q.std() and r.std()
+                                  else np.nan for r in self.x] for q in query])
+        np.testing.assert_allclose(result, expected, rtol=1e-6, atol=1e-12)
+
+
+class TestSingleRBaseline(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        n_genes, n_labels = 650, 6
+        profiles = rng.gamma(0.3, 2, (n_labels, n_genes))
+        genes = np.array([f'gene_{i}' for i in range(n_genes)])
+
+        def sample(labels):
+            lam = profiles[labels] * rng.uniform(0.5, 2, (labels.size, 1))
+            return csr_matrix(rng.poisson(lam).astype(np.float32))
+
+        # the genes partly overlap and are in different orders
+        ref_labels = np.repeat(np.arange(n_labels), 25)
+        self.ref_genes = genes[:600]
+        self.ref_matrix = sample(ref_labels)[:, :600]
+        self.ref_groups = pd.Categorical([f'type_{i}' for i in ref_labels])
+        test_labels = rng.integers(0, n_labels, 300)
+        order = rng.permutation(np.arange(50, n_genes))
+        self.test_genes = genes[order]
+        self.test_matrix = sample(test_labels)[:, order]
+        # the clusters mix the cells of two labels
+        self.clusters = pd.Categorical((test_labels * 2 + rng.integers(0, 2, test_labels.size)).astype(str))
+
+    def make_ref(self):
+        ref = StereoExpData(exp_matrix=self.ref_matrix.copy(), genes=self.ref_genes.copy(),
+                            cells=np.array([f'ref_{i}' for i in range(self.ref_matrix.shape[0])]))
+        ref.tl.result['celltype'] = pd.DataFrame({'group': self.ref_groups}, index=ref.cell_names)
+        return ref
+
+    def make_test(self):
+        test = StereoExpData(exp_matrix=self.test_matrix.copy(), genes=self.test_genes.copy(),
+                             cells=np.array([f'cell_{i}' for i in range(self.test_matrix.shape[0])]))
+        test.tl.result['leiden'] = pd.DataFrame({'bins': test.cell_names, 'group': self.clusters})
+        return test
+
+    def shared_genes(self):
+        """
+        The columns of the test matrix of the genes shared with the reference, in the order used by `SingleR.main`.
+        """
+        interact_genes = list(set(self.test_genes) & set(self.ref_genes))
+        return pd.Index(self.test_genes).get_indexer(interact_genes)
+
+    @staticmethod
+    def dense_spearman(test, ref):
+        """
+        The Spearman correlation between the rows of two dense matrices.
+        """
+        test_ranks, ref_ranks = stats.rankdata(test, axis=1), stats.rankdata(ref, axis=1)
+        test_ranks -= test_ranks.mean(axis=1, keepdims=True)
+        ref_ranks -= ref_ranks.mean(axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (test_ranks @ ref_ranks.T) / np.outer(np.linalg.norm(test_ranks, axis=1),
+                                                          np.linalg.norm(ref_ranks, axis=1))
+
+    def baseline(self, single_r, test_matrix):
+        """
+        The labels of the dense path, scoring all cells at once and fine-tuning the cells one by one.
+        """
+        trained_data, common_gene = single_r._train_ref()
+        ref = single_r.ref_exp_data.exp_matrix.toarray()
+        ref_groups = single_r.group_data_frame['group'].values
+        test = test_matrix.toarray()
+        labels = [label for label in pd.Categorical(ref_groups).categories if (ref_groups == label).any()]
+        genes = np.isin(single_r.ref_exp_data.gene_names, common_gene)
+        scores = np.stack([
+            np.percentile(self.dense_spearman(test[:, genes], ref[ref_groups == label][:, genes]),
+                          single_r.quantile, axis=1)
+            for label in labels
+        ], axis=1)
+        first_labels = np.array(labels)[np.argmax(scores, axis=1)]
+
+        def fine_tune_one_time(top_labels, cell):
+            label_genes = _get_label_genes_set(top_labels, trained_data)
+            if len(label_genes) < 20:
+                return [top_labels[0]]
+            genes_filtered = list(label_genes)
+            if np.std(cell[genes_filtered]) <= 0:
+                return [top_labels[0]]
+            res_labels = {}
+            for label in top_labels:
+                ref_filtered = ref[ref_groups == label][:, genes_filtered]
+                sim = self.dense_spearman(cell[np.newaxis, genes_filtered], ref_filtered)
+                res_labels[label] = np.percentile(sim, single_r.quantile, axis=1)[0]
+            mid_value = np.median(list(res_labels.values()))
+            res_labels = {label: value for label, value in res_labels.items() if value > mid_value}
+            if not res_labels:
+                return [top_labels[0]]
+            max_value = max(res_labels.values())
+            return [label for label, value in res_labels.items()
+                    if value >= max_value - single_r.fine_tune_threshold]
+
+        fine_tuned = []
+        for cell, cell_scores in zip(test, scores):
+            top_labels = np.array(labels)[cell_scores >= cell_scores.max() - single_r.fine_tune_threshold]
+            while len(top_labels) > 1:
+                top_labels = fine_tune_one_time(list(top_labels), cell)
+            fine_tuned.append(top_labels[0])
+        return first_labels, np.array(fine_tuned)
+
+    def test_cells(self):
+        test = self.make_test()
+        single_r = SingleR(test, pipeline_res={})
+        res = single_r.main(self.make_ref(), n_jobs=2, batch_size=70)
+        first_labels, labels = self.baseline(single_r, self.test_matrix[:, self.shared_genes()])
+        self.assertEqual(list(res['bins']), list(test.cell_names))
+        np.testing.assert_array_equal(res['first_labels'].values, first_labels)
+        np.testing.assert_array_equal(res['group'].values, labels)
+        self.assertGreater(len(set(labels)), 1)
+
+    def test_clusters(self):
+        test = self.make_test()
+        single_r = SingleR(test, pipeline_res={})
+        res = single_r.main(self.make_ref(), cluster_res_key='leiden', n_jobs=2, batch_size=5)
+        cluster_sums = pd.DataFrame(self.test_matrix[:, self.shared_genes()].toarray()).groupby(
+            self.clusters, observed=False).sum()
+        first_labels, labels = self.baseline(single_r, csr_matrix(cluster_sums.values))
+        self.assertEqual(list(res['bins']), list(test.cell_names))
+        np.testing.assert_array_equal(res['group'].values,
+                                      pd.Series(labels, index=cluster_sums.index)[self.clusters].values)
+        np.testing.assert_array_equal(res['first_labels'].values,
+                                      pd.Series(first_labels, index=cluster_sums.index)[self.clusters].values)
@@ -0,0 +1,64 @@
+import random
+import unittest
+
+import numpy as np
+import pandas as pd
+from pysal.lib import weights
+from pysal.model import spreg
+from scipy.sparse import csr_matrix
+
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.tools.spatial_lag import SpatialLag
+
+
+class TestSpatialLag(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        # a jittered lattice of 20 x 15 bins
+        grid_x, grid_y = np.meshgrid(np.arange(20), np.arange(15))
+        self.position = np.stack([grid_x.ravel(), grid_y.ravel()], axis=1) * 10 + rng.random((300, 2)) * 4
+        n_cells, n_genes = self.position.shape[0], 12
+        x = (rng.random((n_cells, n_genes)) < 0.5) * rng.poisson(3, (n_cells, n_genes)).astype(np.float64)
+        # a gene with constant expression
+        x[:, 5] = 2
+        self.x = x
+        self.data = StereoExpData(
+            exp_matrix=csr_matrix(x),
+            cells=np.array([f'cell_{i}' for i in range(n_cells)]),
+            genes=np.array([f'gene_{i}' for i in range(n_genes)]),
+            position=self.position,
+        )
+        self.groups = pd.DataFrame({'bins': self.data.cell_names, 'group': rng.choice(['a', 'b', 'c'], n_cells)})
+
+    def test_gm_model(self):
+        random.seed(0)
+        tool = SpatialLag(self.data, groups=self.groups, random_drop=True, n_jobs=2, chunk_size=5)
+        x, _ = tool.get_data()
+        uniq_group = [column[len('group_'):] for column in x.columns]
+        result = tool.gm_model(x, uniq_group)
+        self.assertEqual(list(result.index), list(self.data.gene_names))
+        coeff = result.filter(like='_lag_coeff').values
+        z_stat = result.filter(like='_lag_zstat').values
+        p_val = result.filter(like='_lag_pval').values
+        self.assertEqual(coeff.shape, (self.x.shape[1], len(uniq_group) + 2))
+
+        # the same model fitted by spreg, one gene at a time
+        knn = weights.distance.KNN.from_array(self.position, k=8)
+        knn.transform = 'R'
+        for i in (0, 3, 11):
+            expected = spreg.GM_Lag(self.x[:, [i]], x.values.astype(np.float64), w=knn)
+            z, p = np.array(expected.z_stat).T
+            np.testing.assert_allclose(coeff[i], expected.betas[:, 0], rtol=1e-7, atol=1e-10)
+            np.testing.assert_allclose(coeff[i] / z_stat[i], expected.std_err, rtol=1e-7)
+            np.testing.assert_allclose(z_stat[i], z, rtol=1e-7)
+            np.testing.assert_allclose(p_val[i], p, rtol=1e-6, atol=1e-12)
+
+        # the design matrix of the constant gene is singular
+        self.assertTrue(np.isnan(coeff[5]).all())
+        self.assertTrue(np.isnan(p_val[5]).all())
+
+        # a dense expression matrix gives the same result
+        self.data.exp_matrix = self.x
+        dense_result = tool.gm_model(x, uniq_group)
+        np.testing.assert_allclose(dense_result.values, result.values, equal_nan=True)